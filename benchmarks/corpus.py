@@ -0,0 +1,95 @@
+"""Synthetic template corpora for the benchmarks. Every scenario is a
+function returning a dict of template name -> source, built from a seeded
+random generator so that runs are comparable.
+"""
+import random
+
+
+def _block(name, body):
+    return '{%% jinjerscore "%s" %%}\n%s\n{%% endjinjerscore %%}\n' % (name, body)
+
+
+def deep_nesting(scale=1):
+    """Ifs and loops nested a few dozen levels deep."""
+    rng = random.Random(1)
+    rv = {}
+    for t in range(4 * scale):
+        depth = 30
+        body = '{{ leaf }}'
+        for level in range(depth):
+            if rng.random() < 0.5:
+                body = '{%% if a%d %%}<i>%s</i>{%% else %%}-{%% endif %%}' % (level, body)
+            else:
+                body = '{%% for x%d in xs%d %%}<b>%s</b>{%% endfor %%}' % (level, level, body)
+        rv['deep%d.html' % t] = _block('deep%d.html' % t, body)
+    return rv
+
+
+def large_loops(scale=1):
+    """Long loop bodies that use the loop attributes."""
+    rv = {}
+    attrs = ['index', 'index0', 'first', 'last', 'length', 'revindex', 'revindex0']
+    for t in range(4 * scale):
+        rows = []
+        for i in range(150):
+            attr = attrs[i % len(attrs)]
+            rows.append('<td class="{{ loop.cycle(\'odd\', \'even\') }}">{{ row.c%d }}'
+                        '{{ loop.%s }}</td>' % (i, attr))
+        body = '{%% for row in rows if row.visible %%}<tr>%s</tr>{%% endfor %%}' % ''.join(rows)
+        rv['loops%d.html' % t] = _block('loops%d.html' % t, body)
+    return rv
+
+
+def membership(scale=1):
+    """Long chains of in / not in tests against literal and dynamic lists."""
+    rng = random.Random(3)
+    rv = {}
+    for t in range(4 * scale):
+        tests = []
+        for i in range(200):
+            items = ', '.join(repr('v%d' % rng.randint(0, 500)) for _ in range(rng.randint(2, 40)))
+            op = rng.choice(['in', 'not in'])
+            if rng.random() < 0.2:
+                tests.append('x%d %s dynamic%d' % (i, op, i))
+            else:
+                tests.append('x%d %s [%s]' % (i, op, items))
+        body = ''.join('{%% if %s and %s %%}<p>%d</p>{%% endif %%}\n' % (tests[i], tests[i + 1], i)
+                       for i in range(0, len(tests) - 1, 2))
+        rv['membership%d.html' % t] = _block('membership%d.html' % t, body)
+    return rv
+
+
+def long_output(scale=1):
+    """Big runs of markup interleaved with expressions."""
+    rng = random.Random(4)
+    rv = {}
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing']
+    for t in range(4 * scale):
+        parts = []
+        for i in range(2000):
+            if rng.random() < 0.3:
+                parts.append('{{ item.field%d }}' % i)
+            else:
+                parts.append('<span class="%s">%s</span>\n' % (rng.choice(words),
+                                                               ' '.join(rng.sample(words, 4))))
+        rv['output%d.html' % t] = _block('output%d.html' % t, ''.join(parts))
+    return rv
+
+
+def many_small(scale=1):
+    """Lots of tiny templates, where per-template overhead dominates."""
+    rv = {}
+    for t in range(400 * scale):
+        body = ('<div id="t%d">{%% if user %%}{{ user.name }}{%% else %%}anonymous{%% endif %%}'
+                '</div>' % t)
+        rv['small%d.html' % t] = _block('small%d.html' % t, body)
+    return rv
+
+
+SCENARIOS = {
+    'deep_nesting': deep_nesting,
+    'large_loops': large_loops,
+    'membership': membership,
+    'long_output': long_output,
+    'many_small': many_small,
+}
@@ -0,0 +1,194 @@
+"""Benchmarks for template generation.
+
+    python benchmarks/run.py [--update] [--threshold 0.25] [scenario ...]
+
+For every scenario in corpus.py this measures parse time, code generation
+time, end to end generation time (compiling and rendering every template,
+with its output written to a scratch directory), the peak memory that
+takes, and the number of bytes of Underscore output. Times are the best of
+a few repeats.
+
+Results are compared to baseline.json next to this file, and the run fails
+if any metric got worse by more than the threshold. --update stores the
+results as the new baseline instead.
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jinja2 import DictLoader
+from jinjerscore.build import generate_template
+from jinjerscore.compiler import generate
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.optimizer import optimize
+from corpus import SCENARIOS
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# How much worse than the baseline a metric may get, as a fraction. Output
+# size is deterministic, so any growth there is a real change.
+THRESHOLDS = {
+    'parse': 0.25,
+    'codegen': 0.25,
+    'end_to_end': 0.25,
+    'peak_memory_kb': 0.25,
+    'output_bytes': 0.0,
+}
+
+
+def environment(templates, base_path=None):
+    env = JinjerscoreEnvironment(loader=DictLoader(templates))
+    env.underscore_base_path = base_path
+    return env
+
+
+def best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def measure(name, scale, repeat):
+    """Run one scenario, returning a dict of metric -> value."""
+    templates = SCENARIOS[name](scale)
+    env = environment(templates)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def parse():
+        return [env.parse(source, template) for template, source in templates.iteritems()]
+    parse_time = best_time(parse, repeat)
+
+    trees = [(template, optimize(node, env)) for template, node in
+             zip(templates, parse())]
+
+    def codegen():
+        for template, node in trees:
+            generate(node, env, template, template)
+    codegen_time = best_time(codegen, repeat)
+
+    scratch = tempfile.mkdtemp()
+    try:
+        def end_to_end():
+            # a fresh environment, so nothing is served from its cache
+            fresh = environment(templates, scratch)
+            for template in templates:
+                generate_template(fresh, template)
+        end_to_end_time = best_time(end_to_end, repeat)
+        output_bytes = 0
+        for path in os.listdir(scratch):
+            output_bytes += os.path.getsize(os.path.join(scratch, path))
+    finally:
+        shutil.rmtree(scratch)
+
+    return {
+        'parse': parse_time,
+        'codegen': codegen_time,
+        'end_to_end': end_to_end_time,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss,
+        'output_bytes': output_bytes,
+    }
+
+
+def _measure_in_child(args):
+    return measure(*args)
+
+
+def run(names, scale=1, repeat=3):
+    """Measure every scenario in `names`. Each runs in a process of its own,
+    so that peak memory is that scenario's alone.
+    """
+    results = {}
+    for name in names:
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(_measure_in_child, ((name, scale, repeat),))
+        finally:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def compare(results, baseline, threshold=None):
+    """Return a list of (scenario, metric, baseline value, value) for every
+    metric that regressed past its threshold.
+    """
+    regressions = []
+    for name, metrics in sorted(results.iteritems()):
+        for metric, value in sorted(metrics.iteritems()):
+            base = baseline.get(name, {}).get(metric)
+            if base is None:
+                continue
+            limit = THRESHOLDS[metric] if threshold is None else threshold
+            if value > base * (1 + limit) and value - base > 1e-3:
+                regressions.append((name, metric, base, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--update', action='store_true', default=False,
+                      help='Store the results as the new baseline.')
+    parser.add_option('--threshold', type='float', default=None,
+                      help='Allowed regression for every metric, as a fraction.')
+    parser.add_option('--scale', type='int', default=1,
+                      help='Multiply the size of every corpus.')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Times to repeat each timing, keeping the best.')
+    parser.add_option('--baseline', default=BASELINE,
+                      help='Baseline file to compare with or update.')
+    options, names = parser.parse_args(argv)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %r' % name)
+    names = names or sorted(SCENARIOS)
+
+    results = run(names, options.scale, options.repeat)
+    for name in names:
+        print '%-14s %s' % (name, '  '.join('%s=%s' % (metric, _format(value))
+                                             for metric, value in sorted(results[name].iteritems())))
+
+    if options.update:
+        baseline = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print 'Baseline updated.'
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print 'No baseline to compare with; run with --update to store one.'
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, options.threshold)
+    for name, metric, base, value in regressions:
+        print 'REGRESSION %s %s: %s -> %s (%+.0f%%)' % (
+            name, metric, _format(base), _format(value), (value - base) * 100.0 / base)
+    return regressions and 1 or 0
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.4f' % value
+    return str(value)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""One parse for both the Underscore output and the server's templates.
+
+Deployments that render templates on the server with a plain Jinja
+environment, and generate Underscore from the same templates, can share
+their parse:
+
+    jenv = JinjerscoreEnvironment(loader=loader, **options)
+    jenv.underscore_ast_cache = cache = ASTCache(jenv)
+    server = Environment(loader=SharedParseLoader(cache), **options)
+
+Each template's source is then lexed and parsed once, by `jenv`, into a tree
+cached on its hash, and both environments compile copies of that tree: the
+server's with the jinjerscore tags reduced to their bodies, as if the
+extension weren't there. The server environment needs the same syntax
+settings and extensions as `jenv`, less jinjerscore's.
+"""
+import threading
+from jinja2 import nodes
+from jinja2.loaders import BaseLoader
+from jinja2.utils import LRUCache
+from jinjerscore.build import source_hash
+from jinjerscore.compiler import is_underscore_block
+from jinjerscore.ext import JinjerscoreExtension
+
+
+def copy_tree(node):
+    """A copy of a node tree that shares nothing mutable with it, so that
+    code generation, which rewrites trees in place, leaves the original be.
+    """
+    if isinstance(node, list):
+        return [copy_tree(child) for child in node]
+    elif not isinstance(node, nodes.Node):
+        return node
+    rv = object.__new__(node.__class__)
+    rv.__dict__.update(node.__dict__)
+    for field in node.fields:
+        setattr(rv, field, copy_tree(getattr(node, field, None)))
+    return rv
+
+
+def python_tree(node):
+    """Rewrite a tree parsed for Underscore into the tree Jinja's own parser
+    makes: jinjerscore blocks are replaced by their bodies, and comparison
+    chains split around `in` are joined again. Returns the new root.
+    """
+    for field in node.fields:
+        value = getattr(node, field, None)
+        if isinstance(value, list):
+            body = []
+            for child in value:
+                if isinstance(child, nodes.Node):
+                    child = python_tree(child)
+                if isinstance(child, nodes.CallBlock) and is_underscore_block(child):
+                    body.extend(child.body)
+                else:
+                    body.append(child)
+            setattr(node, field, body)
+        elif isinstance(value, nodes.Node):
+            setattr(node, field, python_tree(value))
+    if isinstance(node, nodes.Compare) and getattr(node, 'continues_chain', False):
+        return nodes.Compare(node.expr.expr, node.expr.ops + node.ops, lineno=node.lineno)
+    return node
+
+
+class ASTCache(object):
+    """A bounded cache of template trees, keyed on the hash of the source
+    they're parsed from. Trees are parsed by `environment`, a
+    JinjerscoreEnvironment, and every caller gets a copy of its own.
+    """
+
+    def __init__(self, environment, size=400):
+        self.environment = environment
+        self._cache = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def parse(self, source, name=None, filename=None):
+        key = source_hash(source)
+        with self._lock:
+            node = self._cache.get(key)
+        if node is None:
+            node = self.environment._parse_source(source, name, filename)
+            with self._lock:
+                self._cache[key] = node
+        return copy_tree(node)
+
+    def python_tree(self, source, name=None, filename=None):
+        """The tree for a plain Jinja environment to compile."""
+        return python_tree(self.parse(source, name, filename))
+
+    def check(self, environment):
+        """Raise ValueError unless `environment` parses templates the way the
+        cache's environment does.
+        """
+        ours = self.environment
+        settings = ['block_start_string', 'block_end_string', 'variable_start_string',
+                    'variable_end_string', 'comment_start_string', 'comment_end_string',
+                    'line_statement_prefix', 'line_comment_prefix', 'trim_blocks',
+                    'newline_sequence']
+        for setting in settings:
+            if getattr(environment, setting) != getattr(ours, setting):
+                raise ValueError('environments differ in %s' % setting)
+        extensions = set(ours.extensions) - set([JinjerscoreExtension.identifier])
+        if set(environment.extensions) != extensions:
+            raise ValueError('environments differ in their extensions')
+
+
+class SharedParseLoader(BaseLoader):
+    """Loads templates for a plain Jinja environment from an ASTCache's
+    trees, rather than parsing them again. Sources come from `loader`, by
+    default the cache environment's.
+    """
+
+    def __init__(self, cache, loader=None):
+        self.cache = cache
+        self.loader = loader or cache.environment.loader
+        self._checked = set()
+
+    def get_source(self, environment, template):
+        return self.loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        # BaseLoader.load, compiling from the shared tree
+        if id(environment) not in self._checked:
+            self.cache.check(environment)
+            self._checked.add(id(environment))
+        code = None
+        if globals is None:
+            globals = {}
+        source, filename, uptodate = self.get_source(environment, name)
+        bcc = environment.bytecode_cache
+        if bcc is not None:
+            bucket = bcc.get_bucket(environment, name, filename, source)
+            code = bucket.code
+        if code is None:
+            tree = self.cache.python_tree(source, name, filename)
+            # the tree's nodes belong to the environment that parsed it
+            tree.set_environment(environment)
+            code = environment.compile(tree, name, filename)
+        if bcc is not None and bucket.code is None:
+            bucket.code = code
+            bcc.set_bucket(bucket)
+        return environment.template_class.from_code(environment, code, globals, uptodate)
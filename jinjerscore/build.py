@@ -0,0 +1,514 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from jinja2 import meta
+from jinja2.exceptions import TemplateNotFound, TemplateSyntaxError
+from jinjerscore.bundle import write_bundles
+from jinjerscore.fingerprint import write_fingerprint_manifest
+from jinjerscore.flatten import Flattener
+from jinjerscore.runtime import write_runtime
+from jinjerscore.scan import ScanIndex
+from jinjerscore.sizes import budget, file_sizes
+
+
+MANIFEST_NAME = '.jinjerscore-manifest.json'
+
+
+def source_hash(source):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+
+class DependencyTracker(object):
+    """Hashes template sources and resolves their extends/include/import
+    dependencies. Results are cached, so a tracker should live for a
+    single build run only.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self._hashes = {}
+        self._references = {}
+
+    def hash(self, name):
+        if name not in self._hashes:
+            source = self.environment.loader.get_source(self.environment, name)[0]
+            self._hashes[name] = source_hash(source)
+        return self._hashes[name]
+
+    def references(self, name):
+        """The templates `name` refers to directly. A `None` entry means the
+        template uses a dynamic name we can't resolve at build time.
+        """
+        if name not in self._references:
+            source, filename = self.environment.loader.get_source(self.environment, name)[:2]
+            ast = self.environment.parse(source, name, filename)
+            self._references[name] = set(meta.find_referenced_templates(ast))
+        return self._references[name]
+
+    def dependencies(self, name):
+        """Return the transitive dependencies of `name` as a dict of
+        dependency name -> content hash, and whether any of them are dynamic.
+        Templates that don't exist, like those an `ignore missing` include
+        skipped, hash to None.
+        """
+        deps = {}
+        dynamic = False
+        pending = [name]
+        while pending:
+            for ref in self.references(pending.pop()):
+                if ref is None:
+                    dynamic = True
+                elif ref != name and ref not in deps:
+                    try:
+                        deps[ref] = self.hash(ref)
+                    except TemplateNotFound:
+                        deps[ref] = None
+                    else:
+                        pending.append(ref)
+        return deps, dynamic
+
+
+class BuildManifest(object):
+    """A persistent record of what the last build generated, used to skip
+    templates whose source and dependency chain haven't changed.
+    """
+
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = options
+        self.templates = {}
+        # the (index, count) of the shard built, if the build was split
+        self.shard = None
+        # the shard's templates the scan left out, which it accounts for too
+        self.ignored = []
+
+    @classmethod
+    def load(cls, path, options=None):
+        manifest = cls(path, options)
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            # Generator options affect every output, so if they've changed
+            # nothing from the previous build can be trusted.
+            if data.get('options') == options:
+                manifest.templates = data.get('templates', {})
+        return manifest
+
+    def save(self):
+        data = {'options': self.options, 'templates': self.templates}
+        if self.shard is not None:
+            data['shard'] = list(self.shard)
+            data['ignored'] = sorted(self.ignored)
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+    def is_fresh(self, name, tracker, base_path=None):
+        entry = self.templates.get(name)
+        if entry is None or entry['dynamic']:
+            return False
+        if entry['hash'] != tracker.hash(name):
+            return False
+        for dep, digest in entry['dependencies'].iteritems():
+            try:
+                if tracker.hash(dep) != digest:
+                    return False
+            except TemplateNotFound:
+                if digest is not None:
+                    return False
+            except Exception:
+                return False
+        if base_path is not None:
+            for path in entry['outputs']:
+                if not os.path.exists(os.path.join(base_path, path)):
+                    return False
+        return True
+
+    def record(self, name, digest, dependencies, dynamic, outputs, helpers=(), macros=(),
+               fingerprints=None):
+        self.templates[name] = {
+            'hash': digest,
+            'dependencies': dependencies,
+            'dynamic': dynamic,
+            'outputs': sorted(set(outputs)),
+            'helpers': sorted(set(helpers)),
+            'macros': sorted(set(macros)),
+            'fingerprints': fingerprints or {},
+        }
+
+    def references(self, names=None):
+        """The runtime helpers, (template, macro) pairs, fingerprinted files
+        and output files (see `output_files`) of the templates `names`, or
+        all of them, as recorded.
+        """
+        helpers = set()
+        macros = set()
+        fingerprints = {}
+        files = {}
+        for name, entry in self.templates.iteritems():
+            if names is None or name in names:
+                helpers.update(entry.get('helpers', ()))
+                macros.update(tuple(ref) for ref in entry.get('macros', ()))
+                fingerprints.update(entry.get('fingerprints', {}))
+                files.update(output_files(entry['outputs'], entry.get('fingerprints')))
+        return helpers, macros, fingerprints, files
+
+    def prune(self, names):
+        """Forget templates that no longer exist."""
+        for name in set(self.templates) - set(names):
+            del self.templates[name]
+
+
+def output_files(outputs, fingerprints=None):
+    """A template's output paths -> the files written for them, relative to
+    the base path, from the files it wrote and its fingerprinted files.
+    """
+    if fingerprints:
+        return dict(fingerprints)
+    return dict((path, path) for path in outputs)
+
+
+class GenerationError(Exception):
+    """Wraps any error raised while generating a template, with the
+    template's name and, where it can be found, the template line.
+    """
+
+    def __init__(self, name, lineno, message):
+        Exception.__init__(self, name, lineno, message)
+        self.name = name
+        self.lineno = lineno
+        self.message = message
+
+    def __str__(self):
+        if self.lineno is None:
+            return '%s: %s' % (self.name, self.message)
+        return '%s, line %d: %s' % (self.name, self.lineno, self.message)
+
+    @classmethod
+    def from_exc_info(cls, name, exc_info):
+        exc_type, exc_value, tb = exc_info
+        lineno = getattr(exc_value, 'lineno', None)
+        # Jinja rewrites tracebacks so that frames from compiled templates
+        # carry the template line; the innermost one is where it failed.
+        while lineno is None and tb is not None:
+            if '__jinja_template__' in tb.tb_frame.f_globals:
+                lineno = tb.tb_lineno
+            tb = tb.tb_next
+        return cls(name, lineno, '%s: %s' % (exc_type.__name__, exc_value))
+
+
+class BuildResult(object):
+
+    def __init__(self):
+        self.rebuilt = []
+        self.skipped = []
+        self.errors = []
+        # templates the pre-scan found nothing to generate in
+        self.ignored = []
+        # the runtime helpers and (template, macro) pairs used by the
+        # rebuilt and skipped templates
+        self.helpers = set()
+        self.macros = set()
+        # logical output path -> fingerprinted file, for all of those
+        self.fingerprints = {}
+        # logical output path -> the file written for it, for all of those
+        self.outputs = {}
+
+    def __repr__(self):
+        return '<BuildResult rebuilt=%d skipped=%d errors=%d>' % (
+            len(self.rebuilt), len(self.skipped), len(self.errors))
+
+
+def generate_template(environment, name):
+    """Render `name` so its jinjerscore blocks are generated, or with
+    `underscore_extract` generate them from its syntax tree, returning the
+    paths of the files it wrote, the runtime helpers and macros they call, and
+    the fingerprinted files of its logical output paths, if any. The rendered
+    text is thrown away, so output is streamed to its files.
+    """
+    environment.underscore_written = []
+    environment.underscore_helpers = set()
+    environment.underscore_macros = set()
+    environment.underscore_fingerprints = {}
+    environment.underscore_stream = True
+    try:
+        if environment.underscore_extract:
+            generate = lambda: environment.extract_underscore(name)
+        else:
+            generate = environment.get_template(name).render
+        if environment.underscore_sizes is not None:
+            with environment.underscore_sizes.rendering(name):
+                _profiled(environment, name, generate)
+            if not environment.underscore_extract:
+                _attribute(environment, name)
+        else:
+            _profiled(environment, name, generate)
+        return (environment.underscore_written, environment.underscore_helpers,
+                environment.underscore_macros, environment.underscore_fingerprints)
+    finally:
+        environment.underscore_written = None
+        environment.underscore_helpers = None
+        environment.underscore_macros = None
+        environment.underscore_fingerprints = None
+        environment.underscore_stream = False
+
+
+def _profiled(environment, name, generate):
+    if environment.underscore_profile is not None:
+        with environment.underscore_profile.rendering(name):
+            generate()
+    else:
+        generate()
+
+
+def _attribute(environment, name):
+    # Rendering runs the generated python, which yields the text of many
+    # nodes at once, so the emitter goes over the template again to find
+    # which wrote what. Templates it can't compile, for constructs outside
+    # their jinjerscore blocks, are left without.
+    try:
+        environment.underscore_source(name)
+    except TemplateSyntaxError:
+        pass
+
+
+def _build_one(environment, tracker, name):
+    """Generate one template, returning a `(name, record, error)` tuple where
+    `record` holds the arguments for `BuildManifest.record`.
+    """
+    try:
+        outputs, helpers, macros, fingerprints = generate_template(environment, name)
+        deps, dynamic = tracker.dependencies(name)
+        return name, (tracker.hash(name), deps, dynamic, outputs, helpers, macros,
+                      fingerprints), None
+    except Exception:
+        return name, None, GenerationError.from_exc_info(name, sys.exc_info())
+
+
+def underscore_settings(environment):
+    """The underscore_* attributes of an environment, so that another
+    environment can be configured the same way.
+    """
+    return dict((key, value) for key, value in vars(environment).iteritems()
+                if key.startswith('underscore_') and
+                key not in ('underscore_written', 'underscore_outputs', 'underscore_helpers',
+                            'underscore_macros', 'underscore_flattener',
+                            'underscore_stream', 'underscore_fingerprints',
+                            'underscore_ast_cache'))
+
+
+# Per-process state for parallel builds, set up once by _init_worker
+_worker = None
+
+
+def _init_worker(params, settings):
+    global _worker
+    from jinjerscore.astcache import ASTCache
+    from jinjerscore.environment import JinjerscoreEnvironment
+    environment = JinjerscoreEnvironment(**params)
+    for key, value in settings.iteritems():
+        setattr(environment, key, value)
+    # the worker's partials are cached for as long as the pool lives
+    environment.underscore_flattener = Flattener(environment)
+    environment.underscore_ast_cache = ASTCache(environment)
+    _worker = (environment, DependencyTracker(environment))
+
+
+def _build_in_worker(name):
+    """Build one template, returning its `_build_one` tuple, and the profile
+    and size report entries recorded since the last call, if the build is
+    profiled or measured.
+    """
+    environment = _worker[0]
+    rv = _build_one(environment, _worker[1], name)
+    profiled = measured = None
+    if environment.underscore_profile is not None:
+        profiled, environment.underscore_profile.templates = \
+            environment.underscore_profile.templates, {}
+    if environment.underscore_sizes is not None:
+        measured, environment.underscore_sizes.templates = \
+            environment.underscore_sizes.templates, {}
+    return rv, profiled, measured
+
+
+def build(environment, names=None, manifest=None, jobs=1, params=None, shard=None,
+          runtime=True):
+    """Generate the Underscore output for `names`, or every template the
+    environment's loader knows about. If a `BuildManifest` is given, templates
+    whose source and dependencies are unchanged since it was written are
+    skipped, and the manifest is updated (but not saved) as we go.
+
+    With `jobs` greater than one (or `None` for one per CPU) templates are
+    generated in a process pool. Every worker builds its own environment from
+    `params`, the keyword arguments `environment` was created with. Errors
+    don't stop the build; they're collected in the result's `errors`. Layouts
+    and partials are parsed once per run, or once per worker, and every
+    template once for both its dependencies and its output.
+
+    Finally `write_shared` writes the JS runtime, with the filter and test
+    helpers and the macros the generated templates call, skipped ones
+    included when there's a manifest to tell which those are, then the
+    bundles and the manifest of fingerprinted files. Building part of the
+    template set, pass `runtime=False` to leave those to the caller.
+
+    With `shard`, an (index, count) pair, only the templates that belong to
+    that shard are built, and the manifest records it, forgetting any
+    other templates; see jinjerscore.shards for putting shards back
+    together. With
+    `underscore_scan` set, templates that a pre-scan finds nothing to
+    generate in are left out, and listed in the result's `ignored`, and in
+    a shard's manifest.
+
+    If the environment has an `underscore_profile`, the timings of every
+    template generated, in workers too, are collected in it, and likewise
+    the output sizes in an `underscore_sizes` report. With
+    `underscore_size_budgets` set, templates whose output, skipped or not,
+    is over budget are listed in the result's `errors`.
+    """
+    from jinjerscore.astcache import ASTCache
+    result = BuildResult()
+    if names is None:
+        names = environment.list_templates()
+    if shard is not None:
+        from jinjerscore.shards import check_shard, select
+        check_shard(shard)
+        names = select(names, shard)
+    if environment.underscore_scan:
+        index = ScanIndex.load(environment)
+        selected = index.select(names)
+        result.ignored = sorted(set(names) - set(selected))
+        names = selected
+        index.prune()
+        index.save()
+    if shard is not None and manifest is not None:
+        # a shard's manifest lists its own templates only, built or
+        # ignored, so that between them the shards account for every one
+        manifest.shard = tuple(shard)
+        manifest.ignored = result.ignored
+        manifest.prune(names)
+    tracker = DependencyTracker(environment)
+    pending = []
+    # template name -> the files written for it, to check against budgets
+    written = {}
+    for name in names:
+        if manifest is not None and manifest.is_fresh(name, tracker,
+                                                       environment.underscore_base_path):
+            result.skipped.append(name)
+            entry = manifest.templates[name]
+            result.helpers.update(entry.get('helpers', ()))
+            result.macros.update(tuple(ref) for ref in entry.get('macros', ()))
+            result.fingerprints.update(entry.get('fingerprints', {}))
+            files = output_files(entry['outputs'], entry.get('fingerprints'))
+            result.outputs.update(files)
+            written[name] = files.values()
+        else:
+            pending.append(name)
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(pending) > 1:
+        if params is None:
+            raise TypeError('parallel builds need the environment params')
+        pool = multiprocessing.Pool(min(jobs, len(pending)), _init_worker,
+                                    (params, underscore_settings(environment)))
+        try:
+            # imap keeps results in submission order, so the outcome doesn't
+            # depend on which worker finishes first
+            chunksize = max(1, len(pending) // (jobs * 8))
+            built = []
+            for rv, profiled, measured in pool.imap(_build_in_worker, pending, chunksize):
+                built.append(rv)
+                for profiled_name, entry in (profiled or {}).iteritems():
+                    environment.underscore_profile.merge(profiled_name, entry)
+                for measured_name, entry in (measured or {}).iteritems():
+                    environment.underscore_sizes.merge(measured_name, entry)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        environment.underscore_flattener = Flattener(environment)
+        # the tracker and the compile share one parse of each template
+        shared = environment.underscore_ast_cache is None
+        if shared:
+            environment.underscore_ast_cache = ASTCache(environment)
+        try:
+            built = [_build_one(environment, tracker, name) for name in pending]
+        finally:
+            environment.underscore_flattener = None
+            if shared:
+                environment.underscore_ast_cache = None
+
+    for name, record, error in built:
+        if error is not None:
+            result.errors.append(error)
+            continue
+        if manifest is not None:
+            manifest.record(name, *record)
+        result.rebuilt.append(name)
+        result.helpers.update(record[4])
+        result.macros.update(record[5])
+        result.fingerprints.update(record[6])
+        files = output_files(record[3], record[6])
+        result.outputs.update(files)
+        written[name] = files.values()
+    if environment.underscore_size_budgets:
+        result.errors += check_budgets(environment, written)
+    if runtime:
+        result.errors += write_shared(environment, result.helpers, result.macros,
+                                      result.fingerprints, result.outputs, jobs)
+    return result
+
+
+def check_budgets(environment, templates):
+    """GenerationErrors for the templates in `templates`, a dict of template
+    name -> the files written for it, relative to the base path, whose output
+    is over its `underscore_size_budgets` limits.
+    """
+    errors = []
+    for name, files in sorted(templates.iteritems()):
+        limits = budget(environment, name)
+        if limits is None:
+            continue
+        raw = gzipped = 0
+        for path in files:
+            sizes = file_sizes(os.path.join(environment.underscore_base_path, path))
+            raw += sizes[0]
+            gzipped += sizes[1]
+        for size, limit, kind in zip((raw, gzipped), limits, ('', ' gzipped')):
+            if limit is not None and size > limit:
+                errors.append(GenerationError(name, None, 'output is %d bytes%s, over its '
+                                              'budget of %d' % (size, kind, limit)))
+    return errors
+
+
+def write_shared(environment, helpers, macros, fingerprints, files, jobs=1):
+    """Write the files covering the whole template set: the runtime with
+    `helpers` and `macros`, the bundles of the outputs in `files` (see
+    `output_files`), compressed in `jobs` processes, and the manifest of the
+    fingerprinted files in `fingerprints`, which the others are added to.
+    Returns a list of GenerationErrors for those that failed.
+    """
+    errors = []
+    try:
+        write_runtime(environment, helpers, macros, fingerprints)
+    except Exception:
+        errors.append(GenerationError.from_exc_info(
+            environment.underscore_runtime_path, sys.exc_info()))
+    if environment.underscore_bundles:
+        try:
+            write_bundles(environment, files, fingerprints, jobs)
+        except Exception:
+            errors.append(GenerationError.from_exc_info(
+                environment.underscore_bundle_path, sys.exc_info()))
+    try:
+        write_fingerprint_manifest(environment, fingerprints)
+    except Exception:
+        errors.append(GenerationError.from_exc_info(
+            environment.underscore_fingerprint_manifest, sys.exc_info()))
+    return errors
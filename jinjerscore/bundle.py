@@ -0,0 +1,165 @@
+"""Bundled output.
+
+With `underscore_bundles` set, builds also combine the outputs of all the
+templates into bundles, written under `underscore_bundle_path` in the base
+path, so that clients fetch one file per bundle rather than one per
+template. Outputs are grouped by `underscore_bundles`, which is
+
+- 'directory', to bundle the outputs in each top-level directory, and
+  those at the top level in one named 'default';
+- a list of (glob pattern, bundle name) pairs, where the first pattern an
+  output path matches names its bundle, and outputs matching none aren't
+  bundled;
+- or a callable, given an output path and returning its bundle's name, or
+  None.
+
+A 'jst' bundle is the JS of its templates, one after the other, in
+`<name>.js`; a 'template' bundle is a JSON object of template name (as
+JST names them) -> Underscore template, in `<name>.json`. ES modules
+import their runtime by path, so they aren't bundled.
+
+Each bundle gets a gzipped copy alongside, with `.gz` added to its name,
+and a brotli one with `.br` if the brotli module is installed (the
+'brotli' extra), for web servers that serve precompressed files, like
+nginx with gzip_static.
+"""
+import fnmatch
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+from cStringIO import StringIO
+from jinjerscore.files import fingerprinted_path, write_atomic
+from jinjerscore.jst import template_name
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULT_BUNDLE = 'default'
+
+_extensions = {'jst': '.js', 'template': '.json'}
+
+
+def bundle_name(environment, path):
+    """The bundle the output at `path` goes in, or None."""
+    bundles = environment.underscore_bundles
+    if bundles == 'directory':
+        parts = path.replace(os.sep, '/').split('/')
+        return len(parts) > 1 and parts[0] or DEFAULT_BUNDLE
+    elif callable(bundles):
+        return bundles(path)
+    for pattern, name in bundles:
+        if fnmatch.fnmatch(path, pattern):
+            return name
+    return None
+
+
+def bundles(environment, files):
+    """Group output paths into bundles, returning a dict of bundle path ->
+    the output paths in it, in order.
+    """
+    extension = _extensions.get(environment.underscore_output)
+    if extension is None:
+        raise ValueError('%s output can\'t be bundled' % environment.underscore_output)
+    rv = {}
+    for path in sorted(files):
+        name = bundle_name(environment, path)
+        if name is not None:
+            bundle = os.path.join(environment.underscore_bundle_path, name + extension)
+            rv.setdefault(bundle, []).append(path)
+    return rv
+
+
+def bundle_source(environment, outputs):
+    """Combine `outputs`, a list of (output path, output) pairs, into a
+    bundle.
+    """
+    if environment.underscore_output == 'jst':
+        return u''.join(output for path, output in outputs)
+    return json.dumps(dict((template_name(path), output) for path, output in outputs),
+                      sort_keys=True)
+
+
+def write_bundles(environment, files, fingerprints=None, jobs=1):
+    """Write the bundles of the outputs in `files`, a dict of output path ->
+    the file written for it, relative to the base path, and compress those
+    that changed, in `jobs` processes. Fingerprinted bundles' files are
+    added to `fingerprints`. Returns the paths of the bundles.
+    """
+    base_path = environment.underscore_base_path
+    paths = []
+    changed = []
+    for path, outputs in sorted(bundles(environment, files).iteritems()):
+        contents = []
+        for output in outputs:
+            with open(os.path.join(base_path, files[output]), 'rb') as f:
+                contents.append((output, f.read().decode('utf-8')))
+        source = bundle_source(environment, contents).encode('utf-8')
+        full_path = os.path.join(base_path, path)
+        directory = os.path.dirname(full_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if environment.underscore_fingerprint:
+            full_path = fingerprinted_path(full_path, hashlib.sha1(source).hexdigest())
+            if fingerprints is not None:
+                fingerprints[path] = os.path.relpath(full_path, base_path)
+        if write_atomic(full_path, [source]) or not _compressed(full_path):
+            changed.append(full_path)
+        paths.append(path)
+
+    tasks = [(path, extension) for path in changed for extension in _compressors()]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            pool.map(_compress, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for task in tasks:
+            _compress(task)
+    return paths
+
+
+def gzip_compress(data):
+    # no timestamp or file name in the header, so the same bundle always
+    # compresses to the same bytes
+    buf = StringIO()
+    f = gzip.GzipFile('', 'wb', 9, buf, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def compressed_extensions():
+    """The extensions of the compressed copies written of each bundle."""
+    return sorted(_compressors())
+
+
+def _compressors():
+    # sibling file extension -> compression function
+    rv = {'.gz': gzip_compress}
+    if brotli is not None:
+        rv['.br'] = brotli.compress
+    return rv
+
+
+def _compressed(path):
+    return all(os.path.exists(path + extension) for extension in _compressors())
+
+
+def _compress(task):
+    path, extension = task
+    with open(path, 'rb') as f:
+        write_atomic(path + extension, [_compressors()[extension](f.read())])
@@ -0,0 +1,76 @@
+"""A client for jinjerscore.daemon, light enough to run from an editor or a
+git hook on every save or commit:
+
+    python -m jinjerscore.client /tmp/jinjerscore.sock templates/a.html
+
+builds the template at templates/a.html and those that depend on it, or with
+no paths, every template that's changed. It imports nothing outside the
+standard library, and exits non-zero if any template failed to generate.
+"""
+import json
+import os
+import socket
+import sys
+from optparse import OptionParser
+
+
+def request(socket_path, message, timeout=None):
+    """Send `message` to the daemon at `socket_path`, returning its
+    response.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message) + '\n')
+        f = sock.makefile('rb')
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise IOError('no response from %s' % socket_path)
+    return json.loads(line)
+
+
+def build(socket_path, paths=None, force=False, timeout=None):
+    """Ask the daemon to build the templates at `paths`, or every template
+    that's changed.
+    """
+    return request(socket_path, {'command': 'build', 'paths': paths,
+                                 'cwd': os.getcwd(), 'force': force}, timeout)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] SOCKET [PATH...]')
+    parser.add_option('--force', action='store_true', default=False,
+                      help='Regenerate the templates even if they are unchanged.')
+    parser.add_option('--stop', action='store_true', default=False,
+                      help='Stop the daemon.')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no socket given')
+    socket_path, paths = args[0], args[1:]
+    try:
+        if options.stop:
+            response = request(socket_path, {'command': 'stop'})
+        else:
+            response = build(socket_path, paths or None, options.force)
+    except (IOError, socket.error), error:
+        sys.stderr.write('%s: %s\n' % (socket_path, error))
+        return 2
+    if 'error' in response:
+        sys.stderr.write('%s\n' % response['error'])
+        return 1
+    if not options.stop:
+        sys.stdout.write('Rebuilt %d templates, skipped %d unchanged.\n'
+                         % (len(response['rebuilt']), len(response['skipped'])))
+        for error in response['errors']:
+            sys.stderr.write('%s\n' % error)
+    return not response['ok'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,113 @@
+import inspect
 from itertools import chain
+from StringIO import StringIO
 from jinja2 import nodes
-from jinja2.compiler import CodeGenerator, operators, find_undeclared
-from jinja2.utils import concat, is_python_keyword
-
-
-js_non_output_nodes = set([nodes.Call])
+from jinja2.compiler import CodeGenerator, Frame, operators
+from jinja2.utils import concat, escape, is_python_keyword
+from jinjerscore.ext import JinjerscoreExtension
+from jinjerscore.flatten import free_names
+from jinjerscore.jst import macro_function
+from jinjerscore.minify import minify
+from jinjerscore.runtime import UNDEFINED_SAFE, filter_helper, test_helper
+
+
+_infinity = float('inf')
+
+_js_string_escapes = {
+    u'\\': u'\\\\',
+    u"'": u"\\'",
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+}
+
+
+def js_literal(value):
+    """Return the JS source for a constant value."""
+    if value is None:
+        return 'null'
+    elif isinstance(value, bool):
+        return value and 'true' or 'false'
+    elif isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        elif value in (_infinity, -_infinity):
+            return value > 0 and 'Infinity' or '-Infinity'
+        # repr, unlike str, keeps every digit a folded constant has
+        return repr(value)
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, basestring):
+        chars = []
+        for char in value:
+            if char in _js_string_escapes:
+                chars.append(_js_string_escapes[char])
+            elif not u' ' <= char <= u'~':
+                chars.append(u'\\u%04x' % ord(char))
+            else:
+                chars.append(char)
+        # a literal %> would end the Underscore tag the string is in
+        return u"'%s'" % u''.join(chars).replace(u'%>', u'%\\x3e')
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(js_literal(item) for item in value)
+    elif isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (js_literal(unicode(key)), js_literal(item))
+                                  for key, item in sorted(value.iteritems()))
+    raise TypeError('Can\'t write %r as a JS literal' % (value,))
+
+
+def literal_values(node):
+    """The items of a list or tuple whose contents are known at compile
+    time, or None.
+    """
+    if isinstance(node, nodes.Const) and isinstance(node.value, (list, tuple)):
+        values = list(node.value)
+    elif isinstance(node, (nodes.List, nodes.Tuple)) and \
+            all(isinstance(item, nodes.Const) for item in node.items):
+        values = [item.value for item in node.items]
+    else:
+        return None
+    try:
+        js_literal(values)
+    except TypeError:
+        return None
+    return values
+
+
+def literal_kind(values):
+    """How a list of constants can be looked up: as the keys of an object,
+    if they're all strings or all integers, and by scanning otherwise.
+    Other numbers are left out, as their JS string forms differ from
+    python's.
+    """
+    if values and all(isinstance(value, basestring) for value in values):
+        return 'string'
+    elif values and all(isinstance(value, (int, long)) and not isinstance(value, bool)
+                        and abs(value) < 2 ** 53 for value in values):
+        return 'number'
+    return 'array'
+
+
+def unique(values):
+    """Drop the values that would repeat one before them in JS."""
+    seen = set()
+    rv = []
+    for value in values:
+        literal = js_literal(value)
+        if literal not in seen:
+            seen.add(literal)
+            rv.append(value)
+    return rv
+
+
+def is_simple_reference(node):
+    """Whether an expression only reads a variable, or an attribute or
+    item of one, so that evaluating it twice costs next to nothing.
+    """
+    while isinstance(node, (nodes.Getattr, nodes.Getitem)):
+        if isinstance(node, nodes.Getitem) and not isinstance(node.arg, (nodes.Const, nodes.Name)):
+            return False
+        node = node.node
+    return isinstance(node, (nodes.Name, nodes.Const))
 
 
 def generate(node, environment, name, filename, stream=None, defer_init=False):
@@ -17,12 +120,67 @@ def generate(node, environment, name, filename, stream=None, defer_init=False):
         return generator.stream.getvalue()
 
 
-class JinjerscoreGenerator(CodeGenerator):
+def emit(node, environment, name, filename, stream=None):
+    """Write the Underscore source for a node tree, without generating python."""
+    if not isinstance(node, nodes.Template):
+        raise TypeError('Can\'t compile non template nodes')
+    emitter = JinjerscoreEmitter(environment, name, filename, stream)
+    emitter.visit(node)
+    if stream is None:
+        return emitter.stream.getvalue()
+
+
+def extract(node, environment, name, filename):
+    """Compile just the jinjerscore blocks of a node tree, returning a
+    (path, source, helpers, macros) tuple for each, in template order.
+    """
+    if not isinstance(node, nodes.Template):
+        raise TypeError('Can\'t compile non template nodes')
+    emitter = JinjerscoreEmitter(environment, name, filename)
+    emitter.extract(node)
+    return emitter.underscore_blocks
 
+
+class JinjerscoreGenerator(CodeGenerator):
     def __init__(self, *args, **kwargs):
         super(JinjerscoreGenerator, self).__init__(*args, **kwargs)
         self._js_indentation = 0
         self._js_new_lines = 0
+        # JS text waiting to be written as one python string: the escaped
+        # fragments, the buffer they go to (None to yield them), and the
+        # line state when the first was written
+        self._js_pending = []
+        self._js_pending_buffer = None
+        self._js_pending_state = None
+        # whether a JS statement or output is open, and the buffer of its
+        # frame: everything written then is JS, some of it by jinja's own
+        # expression visitors
+        self._js_open = False
+        self._js_buffer = None
+        # JS names and inline attribute expressions for the special loop
+        # variable, keyed by the id of the Name nodes referring to it
+        self._loop_aliases = {}
+        self._loop_attributes = {}
+        # how each `in` test is written, keyed by the id of its Operand
+        # node, as (kind, hoisted name, scratch variable name)
+        self._membership = {}
+        # the runtime helpers and (template, macro) pairs the current
+        # jinjerscore block calls
+        self.helpers = set()
+        self.macro_refs = set()
+        self.profile = self.environment.underscore_profile
+        # the macros, and the templates imported as modules, that names at
+        # the top level of the template refer to
+        self._macro_names = {}
+        self._macro_modules = {}
+        # the ids of the Name nodes that load one of those, rather than a
+        # loop variable, argument or assignment by the same name
+        self._macro_loads = set()
+
+    def visit(self, node, *args, **kwargs):
+        if self.profile is not None:
+            self.profile.visit(self.name, node)
+        return super(JinjerscoreGenerator, self).visit(node, *args, **kwargs)
 
     def signature(self, node, frame, extra_kwargs=None, python_call=False):
         write = python_call and self.write or (lambda x: self.write_js(x, frame))
@@ -99,13 +257,60 @@ class JinjerscoreGenerator(CodeGenerator):
             args = args + ['l_loop=l_loop']
         self.writeline('def macro(%s):' % ', '.join(args), node)
         self.indent()
-        self.buffer(frame)
+        underscore = isinstance(node, nodes.CallBlock) and is_underscore_block(node)
+        if underscore:
+            # jinjerscore blocks yield their output, so _generate_underscore
+            # can write it out as it's generated
+            self.writeline('if 0: yield None')
+        else:
+            self.buffer(frame)
         self.pull_locals(frame)
+        if underscore:
+            self.hoist_membership(node.body, frame)
         self.blockvisit(node.body, frame)
-        self.return_buffer_contents(frame)
+        if not underscore:
+            self.return_buffer_contents(frame)
         self.outdent()
         return frame
 
+    def macro_def(self, node, frame):
+        """Dump the macro definition for the def created by macro_body."""
+        # the defaults are JS, which only the runtime's macros use; the
+        # python Macro gets them too where they're constant
+        arg_tuple = ', '.join(repr(x.name) for x in node.args)
+        name = getattr(node, 'name', None)
+        if len(node.args) == 1:
+            arg_tuple += ','
+        defaults = []
+        for arg in node.defaults:
+            try:
+                defaults.append(repr(arg.as_const(frame.eval_ctx)))
+            except nodes.Impossible:
+                defaults.append('None')
+        self.write('Macro(environment, macro, %r, (%s), (%s), %r, %r, %r)' % (
+            name, arg_tuple, ''.join(x + ', ' for x in defaults),
+            bool(frame.accesses_kwargs),
+            bool(frame.accesses_varargs),
+            bool(frame.accesses_caller)
+        ))
+
+    def is_js_statement(self, node):
+        """Whether an output expression is run rather than printed. Calls
+        are, apart from those to the runtime's macros and to loop.cycle(),
+        which return the text to print.
+        """
+        if not isinstance(node, nodes.Call):
+            return False
+        callee = node.node
+        if isinstance(callee, nodes.Name):
+            return not (id(callee) in self._macro_loads and callee.name in self._macro_names)
+        if isinstance(callee, nodes.Getattr) and isinstance(callee.node, nodes.Name):
+            if callee.node.name == 'loop' and callee.attr == 'cycle':
+                return False
+            return not (id(callee.node) in self._macro_loads and
+                        callee.node.name in self._macro_modules)
+        return True
+
     def indent_js(self):
         self._js_indentation += 1
 
@@ -113,25 +318,79 @@ class JinjerscoreGenerator(CodeGenerator):
         self._js_indentation -= step
 
     def write_js(self, x, frame):
+        # we're writing into a python string literal
+        x = x.replace('\\', '\\\\').replace('"', '\\"') \
+             .replace('\n', '\\n').replace('\r', '\\r')
         if frame.buffer is not None:
-            x = '%s.append("%s")' % (frame.buffer, x)
-            self.writeline(x)
+            self.pend_js(x, frame.buffer)
         else:
             self.write(x)
 
+    def write_js_text(self, text, frame):
+        """Write template data, which unlike JS can hold any character."""
+        self.pend_js(text.encode('unicode_escape').replace('"', '\\"'), frame.buffer)
+
+    def pend_js(self, x, buffer):
+        # consecutive JS fragments are written as one string, when
+        # something else is written or the indentation changes
+        if self._js_pending and buffer != self._js_pending_buffer:
+            self.flush_js()
+        if not self._js_pending:
+            self._js_pending_buffer = buffer
+            self._js_pending_state = (self._new_lines, self._write_debug_info)
+        self._js_pending.append(x)
+
+    def flush_js(self):
+        if not self._js_pending:
+            return
+        x = ''.join(self._js_pending)
+        self._js_pending = []
+        state = self._new_lines, self._write_debug_info
+        self._new_lines, self._write_debug_info = self._js_pending_state
+        if self._js_pending_buffer is None:
+            self.write('yield u"%s"' % x)
+        else:
+            self.write('%s.append(u"%s")' % (self._js_pending_buffer, x))
+        self._new_lines, self._write_debug_info = state
+        if self._write_debug_info == self._js_pending_state[1]:
+            self._write_debug_info = None
+
+    def open_js(self, frame):
+        self._js_open = True
+        self._js_buffer = frame.buffer
+
+    def close_js(self):
+        self._js_open = False
+
+    def write(self, x):
+        if self._js_open:
+            self.pend_js(x, self._js_buffer)
+            return
+        if self._js_pending:
+            self.flush_js()
+        super(JinjerscoreGenerator, self).write(x)
+
+    def indent(self):
+        self.flush_js()
+        super(JinjerscoreGenerator, self).indent()
+
+    def outdent(self, step=1):
+        self.flush_js()
+        super(JinjerscoreGenerator, self).outdent(step)
+
     def writeline_js(self, x, frame, node=None, extra=0, js_extra=0, whitespace=False, output=False, end=False):
         """Combination of newline and write."""
         self.newline(node, extra)
         self.newline_js(js_extra)
-        js_str = frame.buffer is None and 'yield u"' or ''
-        if whitespace:
-            js_str += '%s%s' % (
-                '\\n' * self._js_new_lines,
+        self.open_js(frame)
+        # newlines and indentation are purely cosmetic, so minified
+        # output goes without
+        if whitespace and not self.environment.underscore_minify:
+            self.write_js('%s%s' % (
+                '\n' * self._js_new_lines,
                 '    ' * self._js_indentation,
-            )
+            ), frame)
             self._js_new_lines = 0
-        if js_str:
-            self.write_js(js_str, frame)
         self.write_js_stmt(x, frame, node, output, end, end)
 
     def write_js_stmt(self, x, frame, node=None, output=False, end=False, end_quote=False):
@@ -146,34 +405,249 @@ class JinjerscoreGenerator(CodeGenerator):
 
     def write_js_stmt_end(self, x, frame, node=None, end_quote=False):
         self.write_js(x + ' %>', frame)
-        if end_quote and frame.buffer is None:
-            self.write_js('"', frame)
+        if end_quote:
+            self.close_js()
 
     def newline_js(self, extra=0):
         """Add one or more newlines before the next write."""
         self._js_new_lines = max(self._js_new_lines, 1 + extra)
 
+    def blockvisit(self, body, frame):
+        if frame.rootlevel:
+            self.find_macros(body)
+            # a template that extends another one doesn't output its top level
+            if not any(isinstance(child, nodes.Extends) for child in body):
+                self.hoist_membership(body, frame)
+        super(JinjerscoreGenerator, self).blockvisit(body, frame)
+
+    def find_macros(self, body):
+        """Note the macros the top level of a template defines or imports,
+        which JS code refers to in the runtime's `macros` object, along with
+        those of the partials flattened into it.
+        """
+        def top_level(body):
+            for child in body:
+                if isinstance(child, nodes.Scope):
+                    for grandchild in top_level(child.body):
+                        yield grandchild
+                else:
+                    yield child
+
+        for child in top_level(body):
+            if isinstance(child, nodes.Macro):
+                self._macro_names[child.name] = (self.name, child.name)
+            elif isinstance(child, (nodes.Import, nodes.FromImport)):
+                if not isinstance(child.template, nodes.Const):
+                    continue
+                template = child.template.value
+                if isinstance(child, nodes.Import):
+                    self._macro_modules[child.target] = template
+                    continue
+                for name in child.names:
+                    if isinstance(name, tuple):
+                        name, alias = name
+                    else:
+                        alias = name
+                    self._macro_names[alias] = (template, name)
+        self.find_macro_loads(body)
+
+    def find_macro_loads(self, body):
+        """Note the names in `body` that still refer to a macro or module
+        where they're read, following Jinja's scoping: loop targets and
+        assignments in loops, and macro and call arguments, shadow them in
+        their own scope, and a top-level assignment from where it is.
+        """
+        bound = set(self._macro_names) | set(self._macro_modules)
+
+        def targets(node):
+            names = isinstance(node, nodes.Name) and [node] or node.find_all(nodes.Name)
+            return set(name.name for name in names if name.ctx in ('store', 'param'))
+
+        def walk(children, shadowed):
+            for child in children:
+                if not isinstance(child, nodes.Node):
+                    continue
+                if isinstance(child, nodes.Name):
+                    if child.ctx == 'load' and child.name in bound and \
+                            child.name not in shadowed:
+                        self._macro_loads.add(id(child))
+                elif isinstance(child, nodes.For):
+                    walk([child.iter], shadowed)
+                    inner = shadowed | targets(child.target)
+                    walk([child.test], inner)
+                    walk(child.body, inner)
+                    walk(child.else_, set(shadowed))
+                elif isinstance(child, (nodes.Macro, nodes.CallBlock)):
+                    walk(child.defaults, shadowed)
+                    if isinstance(child, nodes.CallBlock):
+                        walk([child.call], shadowed)
+                    walk(child.body, shadowed | set(arg.name for arg in child.args))
+                elif isinstance(child, nodes.Scope):
+                    walk(child.body, shadowed | set(getattr(child, 'hidden', ())))
+                elif isinstance(child, nodes.Assign):
+                    walk([child.node], shadowed)
+                    shadowed.update(targets(child.target))
+                elif isinstance(child, nodes.Import):
+                    shadowed.discard(child.target)
+                elif isinstance(child, nodes.FromImport):
+                    for name in child.names:
+                        shadowed.discard(isinstance(name, tuple) and name[1] or name)
+                else:
+                    walk(child.iter_child_nodes(), shadowed)
+                if isinstance(child, nodes.Macro):
+                    shadowed.discard(child.name)
+        walk(body, set())
+
+    def write_macro(self, template, name, frame):
+        self.write_js('%s.macros[%s]' % (self.environment.underscore_runtime,
+                                         js_literal(template)), frame)
+        if name is not None:
+            self.macro_refs.add((template, name))
+            self.write_js('[%s]' % js_literal(name), frame)
+
+    def hoist_membership(self, body, frame):
+        """Declare what the `in` tests in `body` need up front, so nothing is
+        rebuilt per evaluation: a lookup object for every literal list of
+        strings or numbers, the literal itself for other lists, and a helper
+        for tests against containers only known at runtime. jinjerscore
+        blocks in `body` are left to declare their own, and tests in blocks
+        and macros, which are rendered separately, are written inline.
+        """
+        tests = []
+
+        def walk(children):
+            for child in children:
+                if isinstance(child, (nodes.Block, nodes.Macro)) or \
+                        isinstance(child, nodes.CallBlock) and is_underscore_block(child):
+                    continue
+                if isinstance(child, nodes.Compare):
+                    tests.extend((child, op) for op in child.ops
+                                 if op.op in ('in', 'notin'))
+                walk(child.iter_child_nodes())
+        walk(body)
+        declarations = []
+        names = {}
+
+        def declare(key, code):
+            if key not in names:
+                names[key] = self.temporary_identifier()
+                declarations.append(code and '%s = %s' % (names[key], code) or names[key])
+            return names[key]
+
+        for node, op in tests:
+            values = literal_values(op.expr)
+            if isinstance(op.expr, nodes.Const) and isinstance(op.expr.value, basestring):
+                self._membership[id(op)] = ('substring', None, None)
+                continue
+            elif values is None:
+                helper = declare('helper', (
+                    'function(item, seq) { return seq == null ? false : '
+                    'typeof seq == \'string\' ? seq.indexOf(item) != -1 : '
+                    '_.isArray(seq) ? _.indexOf(seq, item) != -1 : _.has(seq, item) }'))
+                self._membership[id(op)] = ('helper', helper, None)
+                continue
+            values = unique(values)
+            kind = literal_kind(values)
+            if kind == 'array':
+                code = js_literal(values)
+            else:
+                code = '{%s}' % ', '.join('%s: true' % js_literal(unicode(value))
+                                          for value in values)
+            lookup = declare((kind, code), code)
+            # the item is read twice by a lookup, which is only worth
+            # avoiding when evaluating it does more than read a variable
+            scratch = None
+            if kind != 'array' and not is_simple_reference(node.expr):
+                scratch = declare('scratch', None)
+            self._membership[id(op)] = (kind, lookup, scratch)
+        if declarations:
+            self.writeline_js('var %s' % ', '.join(declarations), frame, end=True)
+
     # -- Statement Visitors
 
+    def loop_references(self, node):
+        """Find the uses of the special loop variable that belong to the
+        For `node`, as (name, parent) node pairs. Nested loops have a loop
+        variable of their own, except in their iterable.
+        """
+        refs = []
+
+        def walk(parent, children):
+            for child in children:
+                if isinstance(child, nodes.Name):
+                    if child.name == 'loop' and child.ctx == 'load':
+                        refs.append((child, parent))
+                elif isinstance(child, nodes.For):
+                    walk(child, [child.iter])
+                else:
+                    walk(child, child.iter_child_nodes())
+        walk(node, node.body)
+        return refs
+
+    def loop_locals(self, node):
+        """Find the names the For `node` binds, its targets and what its
+        body assigns, as a dict of name -> the Name nodes in its target,
+        test and body referring to them. Macros are left out, as are the
+        names an include without context hides.
+        """
+        names = set(name.name for name in [node.target] + list(node.target.find_all(nodes.Name))
+                    if isinstance(name, nodes.Name))
+        for assign in node.find_all(nodes.Assign):
+            names.update(name.name for name in [assign.target] +
+                         list(assign.target.find_all(nodes.Name))
+                         if isinstance(name, nodes.Name))
+        refs = dict((name, []) for name in names)
+
+        def walk(children, hidden):
+            for child in children:
+                if isinstance(child, nodes.Name):
+                    if child.name in refs and child.name not in hidden:
+                        refs[child.name].append(child)
+                elif isinstance(child, nodes.Scope):
+                    walk(child.body, hidden | set(getattr(child, 'hidden', ())))
+                elif not isinstance(child, nodes.Macro):
+                    walk(child.iter_child_nodes(), hidden)
+        walk([node.target] + (node.test and [node.test] or []) + node.body, set())
+        return refs
+
     def visit_For(self, node, frame):
-        # when calculating the nodes for the inner frame we have to exclude
-        # the iterator contents from it
         for name in node.find_all(nodes.Name):
             if name.ctx == 'store' and name.name == 'loop':
                 self.fail('Can\'t assign to special loop variable '
                           'in for-loop target', name.lineno)
 
+        # Work out which loop attributes the body reads. Calls to loop() in
+        # recursive loops refer to the loop function instead.
+        attributes = set()
+        variables = []
+        bare = False
+        for name, parent in self.loop_references(node):
+            if node.recursive and isinstance(parent, nodes.Call) and parent.node is name:
+                continue
+            variables.append(name)
+            if isinstance(parent, nodes.Getattr):
+                attributes.add(parent.attr)
+            else:
+                bare = True
+
+        if self.environment.underscore_native_loops:
+            self.native_loop(node, frame, variables, attributes, bare)
+        else:
+            self.each_loop(node, frame, variables)
+
+    def each_loop(self, node, frame, variables):
+        """Write a for loop as a call to _.each, with the loop variables
+        built for every iteration if the body uses them.
+        """
         # We rename the special loop variables, to distinguish them
         # from recursive loop() calls
-        for var in node.find_all(nodes.Getattr):
-            for name in var.find_all(nodes.Name):
-                if name.ctx == 'load':
-                    name.name = 'l_loop'
+        for name in variables:
+            self._loop_aliases[id(name)] = 'l_loop'
 
         if node.else_:
             iteration_indicator = self.temporary_identifier()
 
-        special_loop = 'l_loop' in find_undeclared(node.iter_child_nodes(only=('body',)), ('l_loop',))
+        special_loop = bool(variables)
 
         if node.recursive:
             self.writeline_js('var loop = function(iter) {', frame, node, whitespace=True, end=True)
@@ -190,7 +664,9 @@ class JinjerscoreGenerator(CodeGenerator):
                 self.write_js('iter', frame)
             else:
                 self.visit(node.iter, frame)
-            self.write_js(', function(item) { return ', frame)
+            self.write_js(', function(', frame)
+            self.visit(node.target, frame)
+            self.write_js(') { return ', frame)
             self.visit(node.test, frame)
             self.write_js_stmt_end(' })', frame, end_quote=True)
         self.writeline_js('_.each(', frame, node, whitespace=True)
@@ -207,17 +683,17 @@ class JinjerscoreGenerator(CodeGenerator):
         self.indent_js()
 
         # If we don't access the special loop variables inside this loop, then any filtering of the
-        # collection becomes a continue
+        # collection skips the rest of the iteration
         if not special_loop and node.test is not None:
             self.writeline_js('if(!(', frame, node, whitespace=True)
             self.visit(node.test, frame)
-            self.write_js_stmt_end(')) { continue; }', frame, end_quote=True)
+            self.write_js_stmt_end(')) { return; }', frame, end_quote=True)
         if special_loop:
             self.writeline_js('var l_loop = {index0: index0, index: index0 + 1, first: index0 == 0, length: iter.length}', frame, node, whitespace=True, end=True)
             self.writeline_js('l_loop.revindex = iter.length - l_loop.index0', frame, node, whitespace=True, end=True)
             self.writeline_js('l_loop.revindex0 = l_loop.revindex - 1', frame, node, whitespace=True, end=True)
             self.writeline_js('l_loop.last = l_loop.revindex0 == 0', frame, node, whitespace=True, end=True)
-            self.writeline_js('l_loop.cycle = function() { return arguments.length ? arguments[index0 % arguments.length] : \'\' }}', frame, node, whitespace=True, end=True)
+            self.writeline_js('l_loop.cycle = function() { return arguments.length ? arguments[index0 % arguments.length] : \'\' }', frame, node, whitespace=True, end=True)
         for body_node in node.body:
             self.visit(body_node, frame)
         if node.else_:
@@ -225,6 +701,133 @@ class JinjerscoreGenerator(CodeGenerator):
 
         self.outdent_js()
         self.writeline_js('})', frame, node, whitespace=True, end=True)
+        self.loop_else(node, frame, iteration_indicator if node.else_ else None)
+
+    def native_loop(self, node, frame, variables, attributes, bare):
+        """Write a for loop as a plain indexed loop over an array. Only the
+        loop attributes the body reads are computed, and they're written
+        inline where they're used, so no per-iteration object or closure is
+        needed unless the body uses the loop variable by itself. The
+        iterable has to be an array: objects, dicts in JS, aren't supported.
+
+        There's no function around the body to scope the names the loop
+        binds, so they're given temporary names instead, leaving the names
+        of the template and its data alone.
+        """
+        for name, refs in sorted(self.loop_locals(node).iteritems()):
+            alias = self.temporary_identifier()
+            for ref in refs:
+                self._loop_aliases[id(ref)] = alias
+        if node.recursive:
+            self.writeline_js('var loop = function(iter) {', frame, node, whitespace=True, end=True)
+            self.indent_js()
+        if node.else_:
+            iteration_indicator = self.temporary_identifier()
+            self.writeline_js('var %s = 1' % iteration_indicator, frame, node, whitespace=True, end=True)
+
+        def write_iter():
+            if node.recursive:
+                self.write_js('iter', frame)
+            else:
+                self.visit(node.iter, frame)
+
+        def write_target(item):
+            if isinstance(node.target, nodes.Name):
+                self.write_js('var ', frame)
+                self.visit(node.target, frame)
+                self.write_js(' = %s' % item, frame)
+            else:
+                unpacked = self.temporary_identifier()
+                self.write_js('var %s = %s' % (unpacked, item), frame)
+                for idx, target in enumerate(node.target.items):
+                    self.write_js(', ', frame)
+                    self.visit(target, frame)
+                    self.write_js(' = %s[%d]' % (unpacked, idx), frame)
+
+        seq = self.temporary_identifier()
+        index = self.temporary_identifier()
+        length = self.temporary_identifier()
+        # The attributes that count from the end need the length of the
+        # filtered sequence, which means filtering it up front. Otherwise
+        # the test is applied in the same pass, counting the items kept.
+        needs_length = bare or attributes & set(['length', 'revindex', 'revindex0', 'last'])
+        prefilter = node.test is not None and needs_length
+        counter = None
+        if prefilter:
+            source = self.temporary_identifier()
+            source_index = self.temporary_identifier()
+            self.writeline_js('var %s = ' % source, frame, node, whitespace=True)
+            write_iter()
+            self.write_js_stmt_end(', %s = []' % seq, frame, end_quote=True)
+            self.writeline_js('for (var %s = 0; %s < %s.length; %s++) { ' % (
+                source_index, source_index, source, source_index), frame, node, whitespace=True)
+            write_target('%s[%s]' % (source, source_index))
+            self.write_js('; if (', frame)
+            self.visit(node.test, frame)
+            self.write_js_stmt_end(') { %s.push(%s[%s]); } }' % (seq, source, source_index),
+                                   frame, end_quote=True)
+        else:
+            self.writeline_js('var %s = ' % seq, frame, node, whitespace=True)
+            write_iter()
+            if node.test is not None and variables:
+                counter = self.temporary_identifier()
+                self.write_js(', %s = -1' % counter, frame)
+            self.write_js_stmt_end('', frame, end_quote=True)
+
+        position = counter or index
+        cycle = None
+        if bare or 'cycle' in attributes:
+            cycle = self.temporary_identifier()
+            self.writeline_js('var %s = function() { return arguments.length ? '
+                              'arguments[%s %% arguments.length] : \'\' }' % (cycle, position),
+                              frame, node, whitespace=True, end=True)
+
+        self.writeline_js('for (var %s = 0, %s = %s.length; %s < %s; %s++) { ' % (
+            index, length, seq, index, length, index), frame, node, whitespace=True)
+        write_target('%s[%s]' % (seq, index))
+        if node.test is not None and not prefilter:
+            self.write_js('; if (!(', frame)
+            self.visit(node.test, frame)
+            self.write_js(')) { continue; }', frame)
+            if counter is not None:
+                self.write_js(' %s++' % counter, frame)
+        self.write_js_stmt_end('', frame, end_quote=True)
+        self.indent_js()
+
+        loop = {
+            'index0': position,
+            'index': '(%s + 1)' % position,
+            'first': '(%s == 0)' % position,
+            'cycle': cycle,
+        }
+        if counter is None:
+            loop.update({
+                'length': length,
+                'revindex': '(%s - %s)' % (length, position),
+                'revindex0': '(%s - %s - 1)' % (length, position),
+                'last': '(%s == %s - 1)' % (position, length),
+            })
+        if bare:
+            loop_var = self.temporary_identifier()
+            self.writeline_js('var %s = {%s}' % (loop_var, ', '.join(
+                '%s: %s' % item for item in sorted(loop.items()))),
+                frame, node, whitespace=True, end=True)
+            for name in variables:
+                self._loop_aliases[id(name)] = loop_var
+        else:
+            for name in variables:
+                self._loop_attributes[id(name)] = loop
+        if node.else_:
+            self.writeline_js('%s = 0' % iteration_indicator, frame, node, whitespace=True, end=True)
+
+        for body_node in node.body:
+            self.visit(body_node, frame)
+        self.outdent_js()
+        self.writeline_js('}', frame, node, whitespace=True, end=True)
+        self.loop_else(node, frame, iteration_indicator if node.else_ else None)
+
+    def loop_else(self, node, frame, iteration_indicator):
+        """Write the else block of a loop, and finish recursive loops."""
         if node.else_:
             self.writeline_js('if(%s) {' % iteration_indicator, frame, node, whitespace=True, end=True)
             self.indent_js()
@@ -245,44 +848,60 @@ class JinjerscoreGenerator(CodeGenerator):
         self.visit(node.test, if_frame)
         self.write_js_stmt_end(') {', frame, end_quote=True)
         self.indent_js()
-        self.blockvisit(node.body, if_frame)
+        for body_node in node.body:
+            self.visit(body_node, if_frame)
         self.outdent_js()
         self.writeline_js('}', frame, whitespace=True)
         if node.else_:
             self.write_js_stmt_end('else {', frame, end_quote=True)
             self.indent_js()
-            self.blockvisit(node.else_, if_frame)
+            for body_node in node.else_:
+                self.visit(body_node, if_frame)
             self.writeline_js('}', frame, whitespace=True)
         self.write_js_stmt_end('', frame, end_quote=True)
 
+    def visit_Scope(self, node, frame):
+        # a flattened partial, run in a function of its own so that what it
+        # assigns stays there; the names it mustn't see are its parameters
+        self.writeline_js('(function(%s) {' % ', '.join(getattr(node, 'hidden', ())),
+                          frame, node, end=True)
+        self.indent_js()
+        scope_frame = frame.soft()
+        for child in node.body:
+            self.visit(child, scope_frame)
+        self.outdent_js()
+        self.writeline_js('})();', frame, end=True)
+
     def visit_CallBlock(self, node, frame):
         children = node.iter_child_nodes(exclude=('call',))
-        call_frame = self.macro_body(node, frame, children)
+        extra_kwargs = None
+        if is_underscore_block(node):
+            # tell _generate_underscore what the block needs from the runtime
+            outer = self.helpers, self.macro_refs
+            self.helpers, self.macro_refs = set(), set()
+            call_frame = self.macro_body(node, frame, children)
+            extra_kwargs = {'helpers': repr(tuple(sorted(self.helpers))),
+                            'macros': repr(tuple(sorted(self.macro_refs)))}
+            self.helpers |= outer[0]
+            self.macro_refs |= outer[1]
+        else:
+            call_frame = self.macro_body(node, frame, children)
         self.writeline('caller = ')
         self.macro_def(node, call_frame)
         self.start_write(frame, node)
         call_frame.buffer = None
-        self.visit_Call(node.call, call_frame, forward_caller=True)
+        self.visit_Call(node.call, call_frame, forward_caller=True, extra_kwargs=extra_kwargs)
         self.end_write(frame)
 
-    def visit_Output(self, node, frame):
-        # if we have a known extends statement, we don't output anything
-        # if we are in a require_output_check section
-        if self.has_known_extends and frame.require_output_check:
-            return
-
+    def output_chunks(self, node, frame):
+        """Split the children of an Output node into lists of constant
+        strings and nodes that have to be evaluated by Underscore.
+        """
         if self.environment.finalize:
             finalize = lambda x: unicode(self.environment.finalize(x))
         else:
             finalize = unicode
 
-        # if we are inside a frame that requires output checking, we do so
-        outdent_later = False
-        if frame.require_output_check:
-            self.writeline('if parent_template is None:')
-            self.indent()
-            outdent_later = True
-
         # try to evaluate as many chunks as possible into a static
         # string at compile time.
         body = []
@@ -311,71 +930,32 @@ class JinjerscoreGenerator(CodeGenerator):
                 body[-1].append(const)
             else:
                 body.append([const])
+        return body
 
-        # if we have less than 3 nodes or a buffer we yield or extend/append
-        if len(body) < 3 or frame.buffer is not None:
-            if frame.buffer is not None:
-                # for one item we append, for more we extend
-                if len(body) == 1:
-                    self.writeline('%s.append(' % frame.buffer)
-                else:
-                    self.writeline('%s.extend((' % frame.buffer)
-                self.indent()
-            for item in body:
-                if isinstance(item, list):
-                    val = repr(concat(item))
-                    if frame.buffer is None:
-                        self.writeline('yield ' + val)
-                    else:
-                        self.writeline(val + ', ')
-                else:
-                    if frame.buffer is None:
-                        self.writeline('yield ', item)
-                    else:
-                        self.newline(item)
-                    self.write('u"<%')
-                    if item.__class__ not in js_non_output_nodes:
-                        self.write('=')
-                    self.write(' ')
-                    buffer_cache = frame.buffer
-                    frame.buffer = None
-                    self.visit(item, frame)
-                    frame.buffer = buffer_cache
-                    self.write(' %>"')
-                    if frame.buffer is not None:
-                        self.write(', ')
-            if frame.buffer is not None:
-                # close the open parentheses
-                self.outdent()
-                self.writeline(len(body) == 1 and ')' or '))')
-
-        # otherwise we create a format string as this is faster in that case
-        else:
-            format = []
-            arguments = []
-            for item in body:
-                if isinstance(item, list):
-                    format.append(concat(item).replace('%', '%%'))
-                else:
-                    format.append('%s')
-                    arguments.append(item)
-            self.writeline('yield ')
-            self.write(repr(concat(format)) + ' % (')
-            idx = -1
+    def visit_Output(self, node, frame):
+        # if we have a known extends statement, we don't output anything
+        # if we are in a require_output_check section
+        if self.has_known_extends and frame.require_output_check:
+            return
+
+        # if we are inside a frame that requires output checking, we do so
+        outdent_later = False
+        if frame.require_output_check:
+            self.writeline('if parent_template is None:')
             self.indent()
-            for i, argument in enumerate(arguments):
-                self.newline(argument)
-                self.write('u"<%')
-                if argument.__class__ not in js_non_output_nodes:
-                    self.write('=')
-                self.write(' ')
-                buffer_cache = frame.buffer
-                frame.buffer = None
-                self.visit(argument, frame)
-                frame.buffer = buffer_cache
-                self.write(' %>",')
-            self.outdent()
-            self.writeline(')')
+            outdent_later = True
+
+        # it's all text to python, so it goes in with the JS around it
+        self.newline(node)
+        self.open_js(frame)
+        for item in self.output_chunks(node, frame):
+            if isinstance(item, list):
+                self.write_js_text(concat(item), frame)
+            else:
+                self.write_js(self.is_js_statement(item) and '<% ' or '<%= ', frame)
+                self.visit(item, frame)
+                self.write_js(' %>', frame)
+        self.close_js()
 
         if outdent_later:
             self.outdent()
@@ -391,22 +971,23 @@ class JinjerscoreGenerator(CodeGenerator):
     # -- Expression Visitors
 
     def visit_Name(self, node, frame):
-        self.write_js(node.name, frame)
+        if id(node) in self._macro_loads and id(node) not in self._loop_aliases:
+            if node.name in self._macro_names:
+                return self.write_macro(*self._macro_names[node.name], frame=frame)
+            elif node.name in self._macro_modules:
+                return self.write_macro(self._macro_modules[node.name], None, frame)
+        self.write_js(self._loop_aliases.get(id(node), node.name), frame)
 
     def visit_Const(self, node, frame):
-        val = node.value
-        if isinstance(val, float):
-            self.write_js(str(val), frame)
-        else:
-            self.write_js(repr(val), frame)
+        self.write_js(js_literal(node.value), frame)
 
     def visit_List(self, node, frame):
-        self.write('[')
+        self.write_js('[', frame)
         for idx, item in enumerate(node.items):
             self.visit(item, frame)
             if idx != len(node.items) - 1:
                 self.write_js(', ', frame)
-        self.write(']')
+        self.write_js(']', frame)
 
     visit_Tuple = visit_List
 
@@ -455,7 +1036,7 @@ class JinjerscoreGenerator(CodeGenerator):
             self.write(', ')
             self.visit(node.right, frame)
         else:
-            self.write_js('~~(', frame)
+            self.write_js('Math.floor(', frame)
             self.visit(node.left, frame)
             self.write_js(' / ', frame)
             self.visit(node.right, frame)
@@ -496,13 +1077,50 @@ class JinjerscoreGenerator(CodeGenerator):
             if op.op in ['in', 'notin']:
                 if op.op == 'notin':
                     self.write_js('!', frame)
-                self.write_js('(_.indexOf(', frame)
+                self.write_js('(', frame)
+                self.membership(node, op, frame)
+                self.write_js(')', frame)
+            else:
                 self.visit(op, frame)
-                self.write_js(', ', frame)
+
+    def membership(self, node, op, frame):
+        """Write an `in` test using what hoist_membership declared for it."""
+        kind, name, scratch = self._membership.get(id(op), (None, None, None))
+        if kind == 'helper':
+            self.write_js('%s(' % name, frame)
+            self.visit(node.expr, frame)
+            self.write_js(', ', frame)
+            self.visit(op, frame)
+            self.write_js(')', frame)
+        elif kind == 'substring':
+            self.visit(op, frame)
+            self.write_js('.indexOf(', frame)
+            self.visit(node.expr, frame)
+            self.write_js(') != -1', frame)
+        elif kind in ('string', 'number'):
+            # object keys are strings, so the type has to be checked to tell
+            # 1 from '1'; comparing to true skips the prototype's properties
+            self.write_js('typeof ', frame)
+            if scratch is not None:
+                self.write_js('(%s = ' % scratch, frame)
                 self.visit(node.expr, frame)
-                self.write_js(') != -1)', frame)
+                self.write_js(')', frame)
+                item = lambda: self.write_js(scratch, frame)
+            else:
+                item = lambda: self.visit(node.expr, frame)
+                item()
+            self.write_js(' == \'%s\' && %s[' % (kind, name), frame)
+            item()
+            self.write_js('] === true', frame)
+        else:
+            self.write_js('_.indexOf(', frame)
+            if name is not None:
+                self.write_js(name, frame)
             else:
                 self.visit(op, frame)
+            self.write_js(', ', frame)
+            self.visit(node.expr, frame)
+            self.write_js(') != -1', frame)
 
     def visit_Operand(self, node, frame):
         if node.op not in ['in', 'notin']:
@@ -510,6 +1128,15 @@ class JinjerscoreGenerator(CodeGenerator):
         self.visit(node.expr, frame)
 
     def visit_Getattr(self, node, frame):
+        loop = self._loop_attributes.get(id(node.node))
+        if loop is not None:
+            if loop.get(node.attr) is None:
+                self.fail('loop.%s is not supported' % node.attr, node.lineno)
+            self.write_js(loop[node.attr], frame)
+            return
+        if isinstance(node.node, nodes.Name) and id(node.node) in self._macro_loads and \
+                node.node.name in self._macro_modules:
+            return self.write_macro(self._macro_modules[node.node.name], node.attr, frame)
         self.visit(node.node, frame)
         self.write_js('[%r]' % node.attr, frame)
 
@@ -544,47 +1171,72 @@ class JinjerscoreGenerator(CodeGenerator):
             self.write_js(', ', frame)
             self.visit(node.stop, frame)
 
-    # def visit_Filter(self, node, frame):
-    #     self.write(self.filters[node.name] + '(')
-    #     func = self.environment.filters.get(node.name)
-    #     if func is None:
-    #         self.fail('no filter named %r' % node.name, node.lineno)
-    #     if getattr(func, 'contextfilter', False):
-    #         self.write('context, ')
-    #     elif getattr(func, 'evalcontextfilter', False):
-    #         self.write('context.eval_ctx, ')
-    #     elif getattr(func, 'environmentfilter', False):
-    #         self.write('environment, ')
-
-    #     # if the filter node is None we are inside a filter block
-    #     # and want to write to the current buffer
-    #     if node.node is not None:
-    #         self.visit(node.node, frame)
-    #     elif frame.eval_ctx.volatile:
-    #         self.write('(context.eval_ctx.autoescape and'
-    #                    ' Markup(concat(%s)) or concat(%s))' %
-    #                    (frame.buffer, frame.buffer))
-    #     elif frame.eval_ctx.autoescape:
-    #         self.write('Markup(concat(%s))' % frame.buffer)
-    #     else:
-    #         self.write('concat(%s)' % frame.buffer)
-    #     self.signature(node, frame)
-    #     self.write(')')
-
-    # def visit_Test(self, node, frame):
-    #     self.write(self.tests[node.name] + '(')
-    #     if node.name not in self.environment.tests:
-    #         self.fail('no test named %r' % node.name, node.lineno)
-    #     self.visit(node.node, frame)
-    #     self.signature(node, frame)
-    #     self.write(')')
+    def visit_Filter(self, node, frame):
+        if node.node is None:
+            self.fail('Jinjerscore doesn\'t support filter blocks', node.lineno)
+        helper = filter_helper(node.name)
+        if helper is None:
+            self.fail('no JS implementation for the filter %r' % node.name, node.lineno)
+        self.runtime_call(helper, node, self.environment.filters.get(node.name), frame)
+
+    def visit_Test(self, node, frame):
+        helper = test_helper(node.name)
+        if helper is None:
+            self.fail('no JS implementation for the test %r' % node.name, node.lineno)
+        self.runtime_call(helper, node, self.environment.tests.get(node.name), frame)
+
+    def runtime_call(self, helper, node, func, frame):
+        """Write a filter or test as a call to its runtime helper. Keyword
+        arguments are put in place using the python function's signature.
+        """
+        if node.dyn_args or node.dyn_kwargs:
+            self.fail('Jinjerscore doesn\'t support dynamic arguments to filters and tests',
+                      node.lineno)
+        args = list(node.args)
+        if node.kwargs:
+            try:
+                names = inspect.getargspec(func)[0]
+            except TypeError:
+                self.fail('%s doesn\'t take keyword arguments' % node.name, node.lineno)
+            # skip the value, and whatever Jinja passes in front of it
+            for attr in 'contextfilter', 'evalcontextfilter', 'environmentfilter':
+                if getattr(func, attr, False):
+                    names = names[1:]
+            names = names[1:]
+            for kwarg in node.kwargs:
+                if kwarg.key not in names:
+                    self.fail('%s has no argument %r' % (node.name, kwarg.key),
+                              node.lineno)
+                idx = names.index(kwarg.key)
+                args.extend([None] * (idx + 1 - len(args)))
+                args[idx] = kwarg.value
+
+        self.helpers.add(helper)
+        self.write_js('%s.%s(' % (self.environment.underscore_runtime, helper), frame)
+        if helper in UNDEFINED_SAFE and isinstance(node.node, nodes.Name):
+            # with() scoping throws on missing names, rather than giving
+            # undefined
+            self.write_js('(typeof ', frame)
+            self.visit(node.node, frame)
+            self.write_js(' == \'undefined\' ? void 0 : ', frame)
+            self.visit(node.node, frame)
+            self.write_js(')', frame)
+        else:
+            self.visit(node.node, frame)
+        for arg in args:
+            self.write_js(', ', frame)
+            if arg is None:
+                self.write_js('void 0', frame)
+            else:
+                self.visit(arg, frame)
+        self.write_js(')', frame)
 
     def visit_CondExpr(self, node, frame):
         def write_expr2():
             if node.expr2 is not None:
                 return self.visit(node.expr2, frame)
-            self.write('throw "the ternary expression on %s evaluated to false and '
-                       'no else section was defined."' % self.position(node))
+            self.write_js('throw "the ternary expression on %s evaluated to false and '
+                          'no else section was defined."' % self.position(node), frame)
         self.write_js('(', frame)
         self.visit(node.test, frame)
         self.write_js(' ? ', frame)
@@ -593,7 +1245,7 @@ class JinjerscoreGenerator(CodeGenerator):
         write_expr2()
         self.write_js(')', frame)
 
-    def visit_Call(self, node, frame, forward_caller=False):
+    def visit_Call(self, node, frame, forward_caller=False, extra_kwargs=None):
         python_call = isinstance(node.node, nodes.ExtensionAttribute)
         if python_call:
             if self.environment.sandboxed:
@@ -601,7 +1253,10 @@ class JinjerscoreGenerator(CodeGenerator):
             else:
                 self.write('context.call(')
         self.visit(node.node, frame)
-        extra_kwargs = (python_call and forward_caller) and {'caller': 'caller'} or None
+        if python_call and forward_caller:
+            extra_kwargs = dict(extra_kwargs or (), caller='caller')
+        else:
+            extra_kwargs = None
         if not python_call:
             self.write_js('(', frame)
         self.signature(node, frame, extra_kwargs, python_call)
@@ -645,14 +1300,6 @@ class JinjerscoreGenerator(CodeGenerator):
     # def visit_Break(self, node, frame):
     #     self.writeline('break', node)
 
-    # def visit_Scope(self, node, frame):
-    #     scope_frame = frame.inner()
-    #     scope_frame.inspect(node.iter_child_nodes())
-    #     aliases = self.push_scope(scope_frame)
-    #     self.pull_locals(scope_frame)
-    #     self.blockvisit(node.body, scope_frame)
-    #     self.pop_scope(aliases, scope_frame)
-
     # def visit_EvalContextModifier(self, node, frame):
     #     for keyword in node.options:
     #         self.writeline('context.eval_ctx.%s = ' % keyword.key)
@@ -673,3 +1320,208 @@ class JinjerscoreGenerator(CodeGenerator):
     #         self.visit(child, frame)
     #     frame.eval_ctx.revert(safed_ctx)
     #     self.writeline('context.eval_ctx.revert(%s)' % old_ctx_name)
+
+
+def is_underscore_block(node):
+    """Whether a CallBlock node is a {% jinjerscore %} block."""
+    call = node.call.node
+    return isinstance(call, nodes.ExtensionAttribute) and \
+        call.identifier == JinjerscoreExtension.identifier and \
+        call.name == '_generate_underscore'
+
+
+def _unsupported(node_type):
+    def visitor(self, node, frame):
+        self.fail('The Underscore emitter doesn\'t support %s nodes' % node_type,
+                  node.lineno)
+    return visitor
+
+
+class JinjerscoreEmitter(JinjerscoreGenerator):
+    """Writes the Underscore text of a template straight to the stream,
+    rather than python source that yields it. Python-only statements are
+    dropped, while the JS visitors are shared with the generator, so the
+    output matches what rendering the generated code would produce.
+    """
+
+    def __init__(self, environment, name, filename, stream=None):
+        # template data is unicode, which cStringIO can't hold
+        if stream is None:
+            stream = StringIO()
+        super(JinjerscoreEmitter, self).__init__(environment, name, filename, stream)
+        # (path, source, helpers, macros) for each jinjerscore block, in
+        # template order
+        self.underscore_blocks = []
+        # the report the text of jinjerscore blocks is attributed in, the
+        # (node type, source template, line) of the nodes being visited, and
+        # the text written by each; see jinjerscore.sizes
+        self.sizes = environment.underscore_sizes
+        self._constructs = []
+        self._construct_text = {}
+        self._block_depth = 0
+
+    def visit(self, node, *args, **kwargs):
+        if self.sizes is None:
+            return super(JinjerscoreEmitter, self).visit(node, *args, **kwargs)
+        self.enter_construct(node)
+        try:
+            return super(JinjerscoreEmitter, self).visit(node, *args, **kwargs)
+        finally:
+            self._constructs.pop()
+
+    def enter_construct(self, node):
+        # nodes spliced in from layouts and partials know their source, and
+        # nodes made by the optimizer have their parent's
+        source = getattr(node, 'origin', None) or \
+            (self._constructs and self._constructs[-1][1]) or self.name
+        self._constructs.append((node.__class__.__name__, source, node.lineno))
+
+    def write(self, x):
+        if self._block_depth and self._constructs:
+            self._construct_text.setdefault(self._constructs[-1], []).append(x)
+        self.stream.write(x)
+
+    def writeline(self, x, node=None, extra=0):
+        pass
+
+    def newline(self, node=None, extra=0):
+        pass
+
+    def write_js(self, x, frame):
+        self.write(x)
+
+    def root_frame(self, node):
+        frame = Frame(nodes.EvalContext(self.environment, self.name))
+        frame.inspect(node.body)
+        frame.toplevel = frame.rootlevel = True
+        return frame
+
+    def capture(self, func, *args):
+        """Call `func`, returning what it wrote and its result."""
+        stream = self.stream
+        self.stream = StringIO()
+        try:
+            rv = func(*args)
+            return self.stream.getvalue(), rv
+        finally:
+            self.stream = stream
+
+    def visit_Template(self, node, frame=None):
+        assert frame is None, 'no root frame allowed'
+        frame = self.root_frame(node)
+        # the generator allocates temporary identifiers for these, which
+        # show up in the JS, so we have to follow suit
+        self.pull_dependencies(node.body)
+        self.blockvisit(node.body, frame)
+        if self.sizes is not None:
+            self.sizes.attribute(self.name, self._construct_text)
+
+    def extract(self, node):
+        """Compile a template into `underscore_blocks`, throwing away the
+        text around them. Block paths have to be constant.
+        """
+        self.visit(node)
+        for block in node.find_all(nodes.CallBlock):
+            try:
+                block.call.args[0].as_const(nodes.EvalContext(self.environment, self.name))
+            except nodes.Impossible:
+                self.fail('Extracting jinjerscore blocks needs constant output paths',
+                          block.lineno)
+
+    def visit_CallBlock(self, node, frame):
+        if not is_underscore_block(node):
+            self.fail('The Underscore emitter only supports jinjerscore call blocks',
+                      node.lineno)
+        try:
+            path = node.call.args[0].as_const(frame.eval_ctx)
+        except nodes.Impossible:
+            path = None
+        outer = self.helpers, self.macro_refs
+        self.helpers, self.macro_refs = set(), set()
+        self._block_depth += 1
+        try:
+            rv = self.capture(self.macro_body, node, frame,
+                              node.iter_child_nodes(exclude=('call',)))[0]
+        finally:
+            self._block_depth -= 1
+        self.underscore_blocks.append((path, rv, tuple(sorted(self.helpers)),
+                                       tuple(sorted(self.macro_refs))))
+        self.helpers |= outer[0]
+        self.macro_refs |= outer[1]
+        # already attributed, inside the block
+        self.stream.write(rv)
+
+    def macro_functions(self, node, names):
+        """Compile the top-level macros of a template named in `names` to JS
+        functions, returning a dict of macro name -> function source. The
+        helpers and macros they call are added to `helpers` and `macro_refs`.
+        """
+        frame = self.root_frame(node)
+        self.find_macros(node.body)
+        rv = {}
+        for child in node.body:
+            if isinstance(child, nodes.Macro) and child.name in names:
+                rv[child.name] = self.macro_function(child, frame)
+        for name in names:
+            if name not in rv:
+                self.fail('%s has no macro named %r' % (self.name, name))
+        return rv
+
+    def macro_function(self, node, frame):
+        text, macro_frame = self.capture(self.macro_body, node, frame)
+        if macro_frame.accesses_caller or macro_frame.accesses_kwargs or \
+                macro_frame.accesses_varargs:
+            self.fail('Jinjerscore doesn\'t support caller, kwargs or varargs in macros',
+                      node.lineno)
+        # the function sees its arguments and the runtime's macros, but not
+        # the data of the template calling it
+        free = set(free_names(node.defaults + node.body, self.environment)) - \
+            set(arg.name for arg in node.args) - set(self._macro_names) - \
+            set(self._macro_modules)
+        if free:
+            self.fail('Macro %r reads %s from the template context, which Jinjerscore '
+                      'macros can\'t see; pass what it needs as arguments'
+                      % (node.name, ', '.join(sorted(free))), node.lineno)
+        if self.environment.underscore_minify:
+            text = minify(text)
+        defaults = []
+        for arg, default in zip(node.args[len(node.args) - len(node.defaults):],
+                                node.defaults):
+            value = self.capture(self.visit, default, macro_frame)[0]
+            defaults.append('if (%s === void 0) %s = %s;' % (arg.name, arg.name, value))
+        return macro_function(text, [arg.name for arg in node.args], defaults)
+
+    def visit_Output(self, node, frame):
+        # attributing sizes, the children are written one at a time, so that
+        # template data counts against its own line
+        if self.sizes is None:
+            outputs = [node]
+        else:
+            outputs = [nodes.Output([child], lineno=child.lineno) for child in node.nodes]
+        for output in outputs:
+            for item in self.output_chunks(output, frame):
+                if isinstance(item, list):
+                    if self.sizes is not None:
+                        self.enter_construct(output.nodes[0])
+                    self.write(concat(item))
+                    if self.sizes is not None:
+                        self._constructs.pop()
+                else:
+                    self.write('<%')
+                    if not self.is_js_statement(item):
+                        self.write('=')
+                    self.write(' ')
+                    self.visit(item, frame)
+                    self.write(' %>')
+
+    # definitions and imports output nothing; the names they bind refer to
+    # the runtime's macros
+    def visit_Macro(self, node, frame):
+        pass
+
+    visit_Import = visit_FromImport = visit_Macro
+
+    visit_Extends = _unsupported('extends')
+    visit_Block = _unsupported('block')
+    visit_Include = _unsupported('include')
+    visit_FilterBlock = _unsupported('filter block')
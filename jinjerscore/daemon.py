@@ -0,0 +1,203 @@
+"""A long-lived build process, taking requests on a Unix socket.
+
+Every run of the management command sets up Django, builds an environment
+and imports the compiler before it looks at a template. The daemon pays for
+that once,
+
+    daemon = BuildDaemon(environment, '/tmp/jinjerscore.sock', manifest)
+    daemon.serve()
+
+and keeps the environment and its parsed templates in memory between
+requests, which jinjerscore.client sends. Templates are rebuilt when the
+mtime of their source, or of anything they depend on, has changed since the
+daemon last built them; the rest are skipped without reading their sources.
+
+Requests and responses are JSON objects, one per line.
+"""
+import errno
+import json
+import os
+import socket
+import SocketServer
+import threading
+from jinja2.exceptions import TemplateNotFound
+from jinjerscore.astcache import ASTCache
+from jinjerscore.build import build, write_shared
+from jinjerscore.scan import template_name
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            rv = self.server.respond(json.loads(line))
+        except Exception, error:
+            rv = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+        self.wfile.write(json.dumps(rv) + '\n')
+
+
+class BuildDaemon(SocketServer.UnixStreamServer):
+    """Serves builds of `environment` on the Unix socket `socket_path`,
+    recording them in `manifest`, a BuildManifest, which is saved after
+    every build. Requests are handled one at a time.
+    """
+
+    def __init__(self, environment, socket_path, manifest):
+        _claim(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _Handler)
+        self.environment = environment
+        self.manifest = manifest
+        if environment.underscore_ast_cache is None:
+            environment.underscore_ast_cache = ASTCache(environment)
+        # template name -> its loader's uptodate callable, from when it was
+        # last read for a build
+        self._uptodate = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def serve(self):
+        """Handle requests until one asks the daemon to stop."""
+        while not self._stopped:
+            self.handle_request()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    def respond(self, request):
+        command = request.get('command')
+        if command == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        elif command == 'stop':
+            self._stopped = True
+            return {'ok': True}
+        elif command == 'build':
+            return self.build(request.get('paths'), request.get('cwd'),
+                              request.get('force', False))
+        raise ValueError('unknown command %r' % command)
+
+    def build(self, paths=None, cwd=None, force=False):
+        """Build the templates at `paths`, file paths relative to `cwd` or
+        template names, and the templates depending on them; or every
+        template, if `paths` is None. Returns the response to send.
+        """
+        with self._lock:
+            all_names = self.environment.list_templates()
+            unknown = []
+            if paths is None:
+                names = all_names
+            else:
+                names = set()
+                for path in paths:
+                    name = self.template_name(path, cwd, all_names)
+                    if name is None:
+                        unknown.append(path)
+                    else:
+                        names.add(name)
+                names = sorted(names | self.dependents(names))
+            if force:
+                pending = names
+            else:
+                pending = [name for name in names if not self.is_current(name)]
+
+            for name in pending:
+                entry = self.manifest.templates.get(name, {})
+                for dep in [name] + list(entry.get('dependencies', ())):
+                    self.watch(dep)
+                if force:
+                    self.manifest.templates.pop(name, None)
+            # the compiled templates have their layouts and partials
+            # flattened in, which Jinja's auto reload doesn't know about
+            self.evict(pending)
+
+            result = build(self.environment, pending, self.manifest, runtime=False)
+            errors = [str(error) for error in result.errors]
+            if paths is None:
+                self.manifest.prune(all_names)
+            errors += [str(error) for error in write_shared(
+                self.environment, *self.manifest.references(set(all_names)))]
+            self.manifest.save()
+            return {
+                'ok': not errors,
+                'rebuilt': result.rebuilt,
+                'skipped': sorted(set(names) - set(pending)) + result.skipped,
+                'errors': errors,
+                'unknown': unknown,
+            }
+
+    def template_name(self, path, cwd, names):
+        """The name of the template at `path`, or None if it isn't one.
+        File paths are matched against the loader's search path.
+        """
+        if path in names:
+            return path
+        name = template_name(self.environment, os.path.join(cwd or os.getcwd(), path))
+        return name in names and name or None
+
+    def dependents(self, names):
+        """The templates that depend on any of `names`, as last built."""
+        return set(name for name, entry in self.manifest.templates.iteritems()
+                   if not names.isdisjoint(entry['dependencies']))
+
+    def is_current(self, name):
+        """Whether `name` was built, and neither it nor anything it depends
+        on has changed since, going by the loader's uptodate checks.
+        """
+        entry = self.manifest.templates.get(name)
+        if entry is None or entry['dynamic']:
+            return False
+        for dep in [name] + list(entry['dependencies']):
+            uptodate = self._uptodate.get(dep)
+            if uptodate is None or not uptodate():
+                return False
+        base_path = self.environment.underscore_base_path
+        for path in entry['outputs']:
+            if not os.path.exists(os.path.join(base_path, path)):
+                return False
+        return True
+
+    def evict(self, names):
+        """Drop the compiled templates `names` from the environment's cache.
+        Jinja 2.6 keys it on the name, and later versions on a (weakref to
+        the loader, name) tuple.
+        """
+        cache = self.environment.cache
+        if cache is None:
+            return
+        names = set(names)
+        for key in list(cache.keys()):
+            if (isinstance(key, tuple) and key[-1] or key) in names:
+                del cache[key]
+
+    def watch(self, name):
+        # Taken before the build reads the source, so that a change made
+        # while it runs is seen by the next request. Templates found only
+        # by the build are watched when they're next built, and until then
+        # left to the manifest's hashes.
+        try:
+            self._uptodate[name] = self.environment.loader.get_source(
+                self.environment, name)[2]
+        except TemplateNotFound:
+            self._uptodate.pop(name, None)
+
+
+def _claim(socket_path):
+    # remove the socket of a daemon that's gone, but not of a running one
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, error:
+        if error.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.remove(socket_path)
+    else:
+        raise socket.error(errno.EADDRINUSE,
+                           'a daemon is already listening on %s' % socket_path)
+    finally:
+        sock.close()
@@ -1,10 +1,68 @@
+import os
+import socket
+import subprocess
+from optparse import make_option
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError, NoArgsCommand
+from jinjerscore.build import BuildManifest, MANIFEST_NAME, build
+from jinjerscore.bundle import compressed_extensions
+from jinjerscore.daemon import BuildDaemon
 from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.hook import check_staged
+from jinjerscore.jst import OUTPUT_MODES
+from jinjerscore.profiling import Profile
+from jinjerscore.shards import ShardError, merge, parse_shard
+from jinjerscore.sizes import SizeReport
 
 
 class Command(NoArgsCommand):
     requires_model_validation = False
+    option_list = NoArgsCommand.option_list + (
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Regenerate every template, ignoring the build manifest.'),
+        make_option('--jobs', '-j', type='int', dest='jobs', default=1,
+                    help='Number of worker processes to generate templates with '
+                         '(0 for one per CPU).'),
+        make_option('--output', type='choice', choices=OUTPUT_MODES, dest='output',
+                    help='Write Underscore templates, or precompile them into a JST '
+                         'namespace or ES modules.'),
+        make_option('--bundle', action='store_true', dest='bundle', default=False,
+                    help='Also bundle the output of each top-level directory into one file, '
+                         'with gzip and brotli compressed copies, unless the settings '
+                         'bundle otherwise. Brotli copies need the brotli module.'),
+        make_option('--fingerprint', action='store_true', dest='fingerprint', default=False,
+                    help='Write output under content-hashed file names, with a JSON manifest '
+                         'mapping template paths to them.'),
+        make_option('--extract', action='store_true', dest='extract', default=False,
+                    help='Generate jinjerscore blocks from the parsed templates, without '
+                         'rendering the templates around them.'),
+        make_option('--no-scan', action='store_false', dest='scan', default=True,
+                    help='Build every template, rather than only those a quick scan finds '
+                         'jinjerscore tags in, or in the templates they refer to.'),
+        make_option('--profile', dest='profile', metavar='PATH',
+                    help='Time every compile phase of every template, writing a JSON '
+                         'report to PATH.'),
+        make_option('--profile-top', type='int', dest='profile_top', default=10,
+                    help='Number of slowest templates to list when profiling.'),
+        make_option('--sizes', dest='sizes', metavar='PATH',
+                    help='Measure the output of every template, raw and gzipped, and the '
+                         'constructs writing it, writing a JSON report to PATH.'),
+        make_option('--sizes-top', type='int', dest='sizes_top', default=10,
+                    help='Number of largest templates to list when measuring.'),
+        make_option('--shard', dest='shard', metavar='INDEX/COUNT',
+                    help='Only generate the templates in one shard of the template set, '
+                         'like 2/4 for the second of four.'),
+        make_option('--merge', action='append', dest='merge', metavar='DIR',
+                    help='Rather than generating, check and merge the shard builds in '
+                         'DIR (given once per shard) into the output directory.'),
+        make_option('--staged', action='store_true', dest='staged', default=False,
+                    help='For a git pre-commit hook: only generate the templates affected '
+                         'by staged changes, and fail if their output differs from what '
+                         'is staged.'),
+        make_option('--daemon', dest='daemon', metavar='SOCKET',
+                    help='Rather than generating once, keep serving build requests from '
+                         'jinjerscore.client on the Unix socket SOCKET.'),
+    )
 
     def handle_noargs(self, **options):
         params = {
@@ -12,9 +70,108 @@ class Command(NoArgsCommand):
             'loader': None
         }
         j_settings = settings.JINJERSCORE.copy()
-        base_path = j_settings.pop('underscore_base_path')
+        manifest_path = j_settings.pop('underscore_manifest', None)
+        # underscore_* settings configure the extension rather than Jinja
+        underscore_settings = dict((key, j_settings.pop(key)) for key in list(j_settings)
+                                   if key.startswith('underscore_'))
+        if options['output']:
+            underscore_settings['underscore_output'] = options['output']
+        if options['fingerprint']:
+            underscore_settings['underscore_fingerprint'] = True
+        if options['bundle'] and not underscore_settings.get('underscore_bundles'):
+            underscore_settings['underscore_bundles'] = 'directory'
+        if options['bundle'] and '.br' not in compressed_extensions():
+            self.stderr.write('The brotli module isn\'t installed (see the jinjerscore[brotli] '
+                              'extra), so bundles get no brotli compressed copies.\n')
+        if options['extract']:
+            underscore_settings['underscore_extract'] = True
+        if not options['scan']:
+            underscore_settings['underscore_scan'] = False
+        underscore_settings.setdefault('underscore_scan', True)
         params.update(j_settings)
         jenv = JinjerscoreEnvironment(**params)
-        jenv.underscore_base_path = base_path
-        for path in jenv.list_templates():
-            jenv.get_template(path).render()
+        for key, value in underscore_settings.iteritems():
+            setattr(jenv, key, value)
+        if options['profile']:
+            jenv.underscore_profile = Profile()
+        if options['sizes']:
+            jenv.underscore_sizes = SizeReport()
+
+        if options['merge']:
+            try:
+                manifest = merge(jenv, options['merge'], manifest_path=manifest_path)
+            except ShardError, e:
+                for problem in e.problems:
+                    self.stderr.write('%s\n' % problem)
+                raise CommandError('Shards failed to merge.')
+            self.stdout.write('Merged %d templates from %d shards.\n'
+                              % (len(manifest.templates), len(options['merge'])))
+            return
+
+        if manifest_path is None:
+            manifest_path = os.path.join(jenv.underscore_base_path, MANIFEST_NAME)
+        if options['staged']:
+            manifest = BuildManifest.load(manifest_path, jenv.generator_options())
+            try:
+                result, differ = check_staged(jenv, manifest)
+            except (OSError, subprocess.CalledProcessError), e:
+                raise CommandError('Couldn\'t read the staged changes: %s'
+                                   % (getattr(e, 'output', None) or e))
+            manifest.save()
+            for error in result.errors:
+                self.stderr.write('%s\n' % error)
+            if result.errors:
+                raise CommandError('%d templates failed to generate.' % len(result.errors))
+            for path in differ:
+                self.stderr.write('%s differs from what is staged\n' % path)
+            if differ:
+                raise CommandError('Generated output is out of date; review the files '
+                                   'above, stage them and commit again.')
+            self.stdout.write('Generated %d templates affected by staged changes.\n'
+                              % len(result.rebuilt + result.skipped))
+            return
+
+        if options['daemon']:
+            manifest = BuildManifest.load(manifest_path, jenv.generator_options())
+            try:
+                daemon = BuildDaemon(jenv, options['daemon'], manifest)
+            except socket.error, e:
+                raise CommandError(str(e))
+            self.stdout.write('Serving builds on %s.\n' % options['daemon'])
+            try:
+                daemon.serve()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                daemon.server_close()
+            return
+
+        shard = None
+        if options['shard']:
+            try:
+                shard = parse_shard(options['shard'])
+            except ValueError, e:
+                raise CommandError(str(e))
+        manifest = BuildManifest.load(manifest_path, jenv.generator_options())
+        if options['force']:
+            manifest.templates = {}
+        names = jenv.list_templates()
+        result = build(jenv, names, manifest, jobs=options['jobs'] or None, params=params,
+                       shard=shard)
+        manifest.prune(names)
+        manifest.save()
+        self.stdout.write('Rebuilt %d templates, skipped %d unchanged.\n'
+                          % (len(result.rebuilt), len(result.skipped)))
+        if result.ignored:
+            self.stdout.write('Ignored %d templates without jinjerscore tags.\n'
+                              % len(result.ignored))
+        if options['profile']:
+            jenv.underscore_profile.save(options['profile'], options['profile_top'])
+            self.stdout.write('%s\n' % jenv.underscore_profile.summary(options['profile_top']))
+        if options['sizes']:
+            jenv.underscore_sizes.save(options['sizes'], options['sizes_top'])
+            self.stdout.write('%s\n' % jenv.underscore_sizes.summary(options['sizes_top']))
+        if result.errors:
+            for error in result.errors:
+                self.stderr.write('%s\n' % error)
+            raise CommandError('%d templates failed to generate.' % len(result.errors))
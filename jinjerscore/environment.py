@@ -1,20 +1,138 @@
 from jinja2.environment import Environment
+from jinja2.lexer import TokenStream
 from jinja2.utils import _encode_filename
-from jinjerscore.compiler import generate
+from jinjerscore.compiler import emit, extract, generate
 from jinjerscore.ext import JinjerscoreExtension
+from jinjerscore.flatten import Flattener
+from jinjerscore.minify import minify
+from jinjerscore.optimizer import optimize
 from jinjerscore.parser import JinjerscoreParser
 
 
 class JinjerscoreEnvironment(Environment):
     def __init__(self, *args, **kwargs):
-        extensions = kwargs.get('extensions', [])
+        extensions = list(kwargs.get('extensions', []))
         extensions += [JinjerscoreExtension]
         kwargs['extensions'] = extensions
         super(JinjerscoreEnvironment, self).__init__(*args, **kwargs)
         self.generate_underscore = True
+        self._compiling = None
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        # _compile isn't told which template it's compiling, and profiles
+        # need to know
+        self._compiling = name
+        try:
+            return super(JinjerscoreEnvironment, self).compile(source, name, filename,
+                                                               raw, defer_init)
+        finally:
+            self._compiling = None
 
     def _parse(self, source, name, filename):
+        if self.underscore_ast_cache is not None:
+            return self.underscore_ast_cache.parse(source, name, filename)
+        return self._parse_source(source, name, filename)
+
+    def _parse_source(self, source, name, filename):
+        if self.underscore_profile is not None:
+            with self.underscore_profile.timer(name, 'parse'):
+                return JinjerscoreParser(self, source, name, _encode_filename(filename)).parse()
         return JinjerscoreParser(self, source, name, _encode_filename(filename)).parse()
 
+    def _tokenize(self, source, name, filename=None, state=None):
+        profile = self.underscore_profile
+        if profile is None:
+            return super(JinjerscoreEnvironment, self)._tokenize(source, name, filename, state)
+        # Environment._tokenize, with the lexer's tokens timed as they're
+        # consumed
+        source = self.preprocess(source, name, filename)
+        tokens = self.lexer.wrap(self.lexer.tokeniter(source, name, filename, state),
+                                 name, filename)
+        stream = TokenStream(profile.tokens(name, tokens), name, filename)
+        for ext in self.iter_extensions():
+            stream = ext.filter_stream(stream)
+            if not isinstance(stream, TokenStream):
+                stream = TokenStream(stream, name, filename)
+        return stream
+
     def _generate(self, source, name, filename, defer_init=False):
+        if self.underscore_profile is not None:
+            with self.underscore_profile.timer(name, 'codegen'):
+                return self._generate_source(source, name, filename, defer_init)
+        return self._generate_source(source, name, filename, defer_init)
+
+    def _generate_source(self, source, name, filename, defer_init=False):
+        source = self.flatten(source, name)
+        # Environment.compile has already run Jinja's optimizer, but ours
+        # folds more
+        if self.optimized:
+            source = optimize(source, self)
         return generate(source, self, name, filename, defer_init=defer_init)
+
+    def _compile(self, source, filename):
+        if self.underscore_profile is not None:
+            with self.underscore_profile.timer(self._compiling or filename, 'compile'):
+                return compile(source, filename, 'exec')
+        return compile(source, filename, 'exec')
+
+    def flatten(self, node, name):
+        """Resolve the static extends, blocks and includes of a parsed
+        template, if `underscore_flatten` is set. During a build, parents and
+        partials are parsed once by the run's `underscore_flattener`.
+        """
+        if not self.underscore_flatten:
+            return node
+        flattener = self.underscore_flattener or Flattener(self)
+        return flattener.flatten(node, name)
+
+    def generator_options(self):
+        """The settings that affect generated output. Build manifests store
+        these, so that changing any of them forces a full rebuild.
+        """
+        return {
+            'syntax': [self.block_start_string, self.block_end_string,
+                       self.variable_start_string, self.variable_end_string,
+                       self.comment_start_string, self.comment_end_string,
+                       self.line_statement_prefix, self.line_comment_prefix],
+            'trim_blocks': self.trim_blocks,
+            'newline_sequence': self.newline_sequence,
+            'optimized': self.optimized,
+            'autoescape': repr(self.autoescape),
+            'finalize': repr(self.finalize),
+            'extensions': sorted(self.extensions),
+            'output': [self.underscore_output, self.underscore_jst_namespace,
+                       self.underscore_variable],
+            'minify': self.underscore_minify,
+            'native_loops': self.underscore_native_loops,
+            'runtime': [self.underscore_runtime, self.underscore_runtime_path],
+            'flatten': self.underscore_flatten,
+            'extract': self.underscore_extract,
+            'fingerprint': [self.underscore_fingerprint, self.underscore_fingerprint_manifest],
+        }
+
+    def underscore_source(self, name):
+        """Return the Underscore source for the template `name`, written
+        directly from its syntax tree rather than by rendering generated code.
+        """
+        source, filename = self.loader.get_source(self, name)[:2]
+        node = self.flatten(self.parse(source, name, filename), name)
+        if self.optimized:
+            node = optimize(node, self)
+        rv = emit(node, self, name, filename)
+        if self.underscore_minify:
+            rv = minify(rv)
+        return rv
+
+    def extract_underscore(self, name):
+        """Generate the jinjerscore blocks of the template `name` from its
+        syntax tree, as rendering it would, but without running any of the
+        template around them. The output of blocks in loops or conditionals
+        is generated once, regardless.
+        """
+        source, filename = self.loader.get_source(self, name)[:2]
+        node = self.flatten(self.parse(source, name, filename), name)
+        if self.optimized:
+            node = optimize(node, self)
+        extension = self.extensions[JinjerscoreExtension.identifier]
+        for path, output, helpers, macros in extract(node, self, name, filename):
+            extension._generate_underscore(path, lambda: [output], helpers, macros)
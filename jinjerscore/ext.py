@@ -1,6 +1,14 @@
 import os
 from jinja2 import nodes
 from jinja2.ext import Extension
+from jinja2.utils import concat
+from jinjerscore.files import write_atomic, write_fingerprinted
+from jinjerscore.fingerprint import FINGERPRINT_MANIFEST_NAME
+from jinjerscore.jst import compile_output
+from jinjerscore.minify import minify
+from jinjerscore.runtime import RUNTIME_NAME
+from jinjerscore.scan import SCAN_INDEX_NAME
+from jinjerscore.sizes import Counter, output_sizes
 
 
 class JinjerscoreExtension(Extension):
@@ -11,6 +19,58 @@ class JinjerscoreExtension(Extension):
         environment.extend(
             generate_underscore=False,
             underscore_base_path=None,
+            underscore_written=None,
+            # a dict to collect output path -> output in, rather than
+            # writing files; see jinjerscore.serve
+            underscore_outputs=None,
+            # write plain template output to its file as it's generated,
+            # rather than returning it; the block then renders empty
+            underscore_stream=False,
+            # write output under content-hashed names, listed in a JSON
+            # manifest of logical path -> file; see jinjerscore.fingerprint
+            underscore_fingerprint=False,
+            underscore_fingerprint_manifest=FINGERPRINT_MANIFEST_NAME,
+            underscore_fingerprints=None,
+            # 'template' writes Underscore template text, 'jst' and 'esm'
+            # precompile it into JS functions; see jinjerscore.jst
+            underscore_output='template',
+            underscore_jst_namespace='JST',
+            underscore_variable=None,
+            underscore_minify=False,
+            # compile for loops to indexed loops over arrays, rather than
+            # _.each; unlike _.each, they can't iterate over objects, which
+            # is what dicts are in JS
+            underscore_native_loops=False,
+            # the global (or import) name of the JS runtime filters and tests
+            # call, and where it's written, relative to the base path
+            underscore_runtime='jinjerscore',
+            underscore_runtime_path=RUNTIME_NAME,
+            underscore_helpers=None,
+            underscore_macros=None,
+            # combine outputs into bundles, with precompressed copies; see
+            # jinjerscore.bundle
+            underscore_bundles=None,
+            underscore_bundle_path='bundles',
+            # resolve extends, blocks and includes with constant names when
+            # compiling; see jinjerscore.flatten
+            underscore_flatten=True,
+            underscore_flattener=None,
+            # generate jinjerscore blocks from the syntax tree, rather than by
+            # rendering the templates they're in
+            underscore_extract=False,
+            # only build templates a pre-scan finds jinjerscore tags in, or in
+            # the templates they refer to; see jinjerscore.scan
+            underscore_scan=False,
+            underscore_scan_index=SCAN_INDEX_NAME,
+            # a jinjerscore.profiling.Profile, to time every compile phase
+            underscore_profile=None,
+            # a jinjerscore.sizes.SizeReport, to measure output and attribute
+            # it to the constructs writing it, and limits on each template's
+            # output size; see jinjerscore.sizes
+            underscore_sizes=None,
+            underscore_size_budgets=None,
+            # a jinjerscore.astcache.ASTCache, to parse each source once
+            underscore_ast_cache=None,
         )
 
     def parse(self, parser):
@@ -24,8 +84,66 @@ class JinjerscoreExtension(Extension):
         else:
             return body
 
-    def _generate_underscore(self, path, caller):
-        rv = caller()
-        with open(os.path.join(self.environment.underscore_base_path, path), 'w') as f:
-            f.write(rv)
+    def _generate_underscore(self, path, caller, helpers=(), macros=()):
+        chunks = caller()
+        environment = self.environment
+        full_path = None
+        if environment.underscore_outputs is None:
+            full_path = os.path.join(environment.underscore_base_path, path)
+        if environment.underscore_stream and full_path is not None and \
+                environment.underscore_output == 'template' and \
+                not environment.underscore_minify:
+            # nothing to do to the output as a whole, so it needn't be held
+            # in memory
+            if environment.underscore_profile is not None:
+                chunks = self._counted(chunks)
+            if environment.underscore_sizes is not None:
+                counter = Counter()
+                chunks = self._measured(chunks, counter)
+            written = self._write(path, full_path, chunks)
+            if environment.underscore_sizes is not None:
+                environment.underscore_sizes.output(path, *counter.sizes())
+            rv = u''
+        else:
+            rv = concat(chunks)
+            if environment.underscore_minify:
+                rv = minify(rv)
+            output = compile_output(environment, path, rv, bool(helpers or macros))
+            if environment.underscore_profile is not None:
+                environment.underscore_profile.output(len(output))
+            if environment.underscore_sizes is not None:
+                environment.underscore_sizes.output(path, *output_sizes(output))
+            if full_path is None:
+                environment.underscore_outputs[path] = output
+                written = path
+            else:
+                written = self._write(path, full_path, [output])
+        if environment.underscore_written is not None:
+            environment.underscore_written.append(written)
+        if environment.underscore_helpers is not None:
+            environment.underscore_helpers.update(helpers)
+        if environment.underscore_macros is not None:
+            environment.underscore_macros.update(macros)
         return rv
+
+    def _write(self, path, full_path, chunks):
+        # returns the path written to, relative to the base path
+        environment = self.environment
+        if not environment.underscore_fingerprint:
+            write_atomic(full_path, chunks)
+            return path
+        written = os.path.relpath(write_fingerprinted(full_path, chunks),
+                                  environment.underscore_base_path)
+        if environment.underscore_fingerprints is not None:
+            environment.underscore_fingerprints[path] = written
+        return written
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.environment.underscore_profile.output(len(chunk))
+            yield chunk
+
+    def _measured(self, chunks, counter):
+        for chunk in chunks:
+            counter.update(chunk)
+            yield chunk
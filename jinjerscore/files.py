@@ -0,0 +1,81 @@
+import hashlib
+import os
+
+
+def file_hash(path, blocksize=65536):
+    """The sha1 hex digest of a file's contents, or None if it's missing."""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_temp(path, chunks):
+    # write `chunks` to a new file next to `path`, returning its path and
+    # the sha1 of what was written
+    temp = '%s.%d.%s.tmp' % (path, os.getpid(), os.urandom(4).encode('hex'))
+    digest = hashlib.sha1()
+    # os.open rather than tempfile, so the file gets the usual permissions
+    f = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), 'wb')
+    try:
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                f.write(chunk)
+        finally:
+            f.close()
+    except:
+        os.remove(temp)
+        raise
+    return temp, digest.hexdigest()
+
+
+def _replace(temp, digest, path):
+    try:
+        if file_hash(path) == digest:
+            os.remove(temp)
+            return False
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return True
+
+
+def write_atomic(path, chunks):
+    """Write the strings in the iterable `chunks` to `path` as they come,
+    through a temporary file renamed into place, so that readers never see
+    a partial file. Unicode is encoded as UTF-8. If the file already has
+    exactly this content it's left alone, mtime and all, and False is
+    returned.
+    """
+    temp, digest = _write_temp(path, chunks)
+    return _replace(temp, digest, path)
+
+
+def fingerprinted_path(path, digest):
+    """The content-addressed name for a file at `path` whose contents hash
+    to `digest`: the digest, in the same directory and with the same
+    extension, so identical files there share a name.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, digest[:16] + os.path.splitext(name)[1])
+
+
+def write_fingerprinted(path, chunks):
+    """Like `write_atomic`, but the file is written under its
+    `fingerprinted_path`, which is returned.
+    """
+    temp, digest = _write_temp(path, chunks)
+    path = fingerprinted_path(path, digest)
+    _replace(temp, digest, path)
+    return path
@@ -0,0 +1,33 @@
+"""Content-addressed output.
+
+With `underscore_fingerprint` set, every output file is written under a
+name made from the hash of its contents (see `files.fingerprinted_path`), so
+a file's URL changes exactly when its contents do, and it can be served as
+immutable. A JSON manifest in the base path, `underscore_fingerprint_manifest`,
+maps each logical output path, the one given to the jinjerscore tag, to its
+current file:
+
+    {"forms/login.html": "forms/3f2a9c0d1e4b5a67.html", ...}
+
+The runtime is fingerprinted too, except for ES modules, which import it by
+its plain path. Files from earlier builds are left in place, for clients
+still holding the old manifest.
+"""
+import json
+import os
+from jinjerscore.files import write_atomic
+
+
+FINGERPRINT_MANIFEST_NAME = 'jinjerscore-assets.json'
+
+
+def write_fingerprint_manifest(environment, fingerprints):
+    """Write the logical path -> file mapping `fingerprints`, if the
+    environment fingerprints its output. Returns whether anything was
+    written.
+    """
+    if not environment.underscore_fingerprint:
+        return False
+    output = json.dumps(fingerprints, indent=1, sort_keys=True) + '\n'
+    return write_atomic(os.path.join(environment.underscore_base_path,
+                                     environment.underscore_fingerprint_manifest), [output])
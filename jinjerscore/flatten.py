@@ -0,0 +1,207 @@
+from jinja2 import nodes
+from jinja2.exceptions import TemplateAssertionError, TemplateNotFound
+
+
+# top-level statements of a child template that still run when it extends
+# another one; its output is dropped
+_prelude_nodes = (nodes.Assign, nodes.Import, nodes.FromImport, nodes.Macro)
+
+
+def constant(node, environment):
+    """The value of an expression if it's known at compile time, else None."""
+    try:
+        return node.as_const(nodes.EvalContext(environment))
+    except nodes.Impossible:
+        return None
+
+
+def is_super_call(node):
+    return isinstance(node, nodes.Call) and isinstance(node.node, nodes.Name) and \
+        node.node.name == 'super' and not node.args
+
+
+def free_names(body, environment):
+    """The sorted names `body` reads without binding them itself, leaving
+    out globals and the special loop variable.
+    """
+    loaded = set()
+    bound = set(environment.globals) | set(['loop'])
+    for child in body:
+        if not isinstance(child, nodes.Node):
+            continue
+        for node in [child] + list(child.find_all((nodes.Name, nodes.Macro, nodes.Import,
+                                                    nodes.FromImport, nodes.CallBlock))):
+            if isinstance(node, nodes.Name) and node.ctx == 'load':
+                loaded.add(node.name)
+            elif isinstance(node, nodes.Name):
+                bound.add(node.name)
+            elif isinstance(node, nodes.Macro):
+                bound.add(node.name)
+                bound.update(['caller', 'varargs', 'kwargs'])
+            elif isinstance(node, nodes.CallBlock):
+                bound.update(['caller', 'varargs', 'kwargs'])
+            elif isinstance(node, nodes.Import):
+                bound.add(node.target)
+            elif isinstance(node, nodes.FromImport):
+                bound.update(isinstance(name, tuple) and name[1] or name for name in node.names)
+    return sorted(loaded - bound)
+
+
+class Flattener(object):
+    """Resolves extends, blocks and includes with constant template names
+    at compile time, splicing parents and partials into one flat tree.
+    Partials that assign names, or are included without context, go in a
+    Scope, which keeps their names apart from the includer's.
+    Parsed templates are cached and only ever copied from, so a flattener
+    should live for a single build run, and every template referring to a
+    layout or partial shares one parse of it.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self._parsed = {}
+
+    def parse(self, name):
+        if name not in self._parsed:
+            source, filename = self.environment.loader.get_source(self.environment, name)[:2]
+            self._parsed[name] = self.mark(self.environment.parse(source, name, filename),
+                                           name)
+        return self._parsed[name]
+
+    def mark(self, node, name):
+        # nodes spliced from other templates keep their source, so that
+        # output sizes are attributed to the right one
+        if self.environment.underscore_sizes is not None:
+            for child in node.find_all(nodes.Node):
+                child.origin = name
+        return node
+
+    def flatten(self, node, name=None):
+        """Return a flat copy of the Template `node`."""
+        self.mark(node, name)
+        return nodes.Template(self.template_body(node, [name]), lineno=node.lineno,
+                              environment=self.environment)
+
+    def template_body(self, node, stack):
+        # follow the extends chain up to the root layout
+        chain = [node]
+        names = [stack[-1]]
+        while True:
+            extends = [child for child in chain[-1].body if isinstance(child, nodes.Extends)]
+            parent = extends and constant(extends[0].template, self.environment)
+            if not isinstance(parent, basestring):
+                break
+            if parent in names or parent in stack:
+                raise TemplateAssertionError('%s extends itself' % parent, extends[0].lineno,
+                                             names[-1])
+            chain.append(self.parse(parent))
+            names.append(parent)
+
+        # every definition of a block, the child's first
+        blocks = {}
+        for template in chain:
+            for block in template.find_all(nodes.Block):
+                blocks.setdefault(block.name, []).append(block)
+
+        body = []
+        for template in chain[:-1]:
+            body.extend(child for child in template.body if isinstance(child, _prelude_nodes))
+        body.extend(chain[-1].body)
+        return self.expand(body, blocks, None, stack + names[1:])
+
+    def expand(self, body, blocks, block, stack):
+        """Copy a list of nodes, replacing blocks with their most derived
+        definition and includes with the partial's nodes. `block` is the
+        (name, level) of the block definition being expanded, for super().
+        """
+        rv = []
+        for node in body:
+            if not isinstance(node, nodes.Node):
+                rv.append(node)
+            elif isinstance(node, nodes.Block):
+                rv.extend(self.block_body(node.name, 0, blocks, stack))
+            elif isinstance(node, nodes.Extends) and \
+                    isinstance(constant(node.template, self.environment), basestring):
+                continue
+            elif isinstance(node, nodes.Include):
+                rv.extend(self.include(node, blocks, block, stack))
+            elif isinstance(node, nodes.Output) and block is not None and \
+                    any(is_super_call(child) for child in node.nodes):
+                # split the output around super(), which stands for the
+                # parent's definition of the block
+                output = []
+                for child in node.nodes:
+                    if is_super_call(child):
+                        if output:
+                            rv.append(nodes.Output(self.expand(output, blocks, block, stack),
+                                                   lineno=node.lineno,
+                                                   environment=self.environment))
+                            output = []
+                        rv.extend(self.block_body(block[0], block[1] + 1, blocks, stack,
+                                                  child.lineno))
+                    else:
+                        output.append(child)
+                if output:
+                    rv.append(nodes.Output(self.expand(output, blocks, block, stack),
+                                           lineno=node.lineno, environment=self.environment))
+            else:
+                rv.append(self.copy(node, blocks, block, stack))
+        return rv
+
+    def block_body(self, name, level, blocks, stack, lineno=None):
+        definitions = blocks[name]
+        if level >= len(definitions):
+            raise TemplateAssertionError('no parent definition of block %r for super()' % name,
+                                         lineno, stack[0])
+        return self.expand(definitions[level].body, blocks, (name, level), stack)
+
+    def include(self, node, blocks, block, stack):
+        names = constant(node.template, self.environment)
+        if isinstance(names, basestring):
+            names = [names]
+        elif not isinstance(names, (list, tuple)):
+            # resolved at render time, as Jinja does
+            return [self.copy(node, blocks, block, stack)]
+        for name in names:
+            if name in stack:
+                raise TemplateAssertionError('%s includes itself' % name, node.lineno, stack[0])
+            try:
+                partial = self.parse(name)
+            except TemplateNotFound:
+                continue
+            return self.scope(node, self.template_body(partial, stack + [name]))
+        if node.ignore_missing:
+            return []
+        raise TemplateNotFound(names[0])
+
+    def scope(self, node, body):
+        """Wrap the flattened `body` of the partial an Include `node`
+        includes in a Scope where need be, so that what it assigns doesn't
+        leak into the includer, as in Jinja. Without context, the names it
+        reads are hidden from it too, apart from globals and its own, and
+        are listed in the Scope's `hidden`.
+        """
+        hidden = []
+        if not node.with_context:
+            hidden = free_names(body, self.environment)
+        if not hidden and not any(child.find(nodes.Assign) or isinstance(child, nodes.Assign)
+                                  for child in body if isinstance(child, nodes.Node)):
+            return body
+        rv = nodes.Scope(body, lineno=node.lineno, environment=self.environment)
+        rv.hidden = hidden
+        return [rv]
+
+    def copy(self, node, blocks, block, stack):
+        rv = object.__new__(node.__class__)
+        for attr in node.attributes:
+            setattr(rv, attr, getattr(node, attr, None))
+        if hasattr(node, 'origin'):
+            rv.origin = node.origin
+        for field in node.fields:
+            value = getattr(node, field)
+            if isinstance(value, list):
+                value = self.expand(value, blocks, block, stack)
+            elif isinstance(value, nodes.Node):
+                value = self.copy(value, blocks, block, stack)
+            setattr(rv, field, value)
+        return rv
@@ -0,0 +1,131 @@
+"""Checking generated output from a git pre-commit hook:
+
+    #!/bin/sh
+    exec python manage.py generate_underscore --staged
+
+`check_staged` regenerates only the templates that staged changes can
+affect: the staged templates, and those extending, including or importing
+them, directly or not, as found by jinjerscore.scan. It then compares their
+output, and the runtime, bundles and fingerprint manifest, with what's
+staged, so that a commit changing templates without their output fails.
+
+Templates are read from the working tree; to check exactly what's staged,
+stash the rest first, with `git stash --keep-index`. The build manifest and
+scan index change with every build, and are best left out of the
+repository.
+"""
+import hashlib
+import os
+import subprocess
+import warnings
+from jinjerscore.build import BuildResult, build, write_shared
+from jinjerscore.bundle import bundles, compressed_extensions
+from jinjerscore.scan import ScanIndex, template_name
+
+
+def git(args, cwd=None):
+    """Run git with `args`, returning its output. Raises
+    CalledProcessError if it fails.
+    """
+    process = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, 'git ' + ' '.join(args), err)
+    return out
+
+
+def staged_paths(cwd=None):
+    """The top directory of the work tree, and the absolute paths of the
+    files added, changed or removed in the index.
+    """
+    top = os.path.realpath(git(['rev-parse', '--show-toplevel'], cwd).strip())
+    out = git(['diff', '--cached', '--name-only', '-z'], top)
+    return top, [os.path.join(top, path) for path in out.split('\0') if path]
+
+
+def staged_hashes(top, paths):
+    """The blob hashes of the files at `paths` in the index, by path.
+    Files that aren't in the index are left out.
+    """
+    if not paths:
+        return {}
+    out = git(['ls-files', '--stage', '-z', '--'] +
+              [os.path.relpath(path, top) for path in paths], top)
+    rv = {}
+    for line in out.split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            rv[os.path.join(top, path)] = info.split()[1]
+    return rv
+
+
+def blob_hash(path):
+    """The hash git would give the file at `path`."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+def affected_templates(environment, paths, index, names=None):
+    """The templates in `names`, or all of them, whose output could change
+    with the files at `paths`. Files are matched to templates on the
+    loader's search path; with a loader that has none, there's no telling
+    which files are templates, so every template is.
+    """
+    if names is None:
+        names = environment.list_templates()
+    if not paths:
+        return []
+    if getattr(environment.loader, 'searchpath', None):
+        changed = set(name for name in (template_name(environment, path) for path in paths)
+                      if name is not None)
+    else:
+        warnings.warn('Can\'t match changed files to templates without a loader search '
+                      'path; checking every template')
+        changed = set(names)
+    if not changed:
+        return []
+    changed |= index.dependents(changed, names)
+    names = set(names)
+    return [name for name in sorted(changed) if name in names and index.generates(name)]
+
+
+def check_staged(environment, manifest, cwd=None):
+    """Regenerate the templates affected by the changes staged in the
+    repository at `cwd`, recording them in `manifest`, a BuildManifest, and
+    the files covering all templates. Returns the BuildResult, and the
+    files, relative to the base path, whose contents differ from what's
+    staged.
+    """
+    top, paths = staged_paths(cwd)
+    all_names = environment.list_templates()
+    index = ScanIndex.load(environment)
+    names = affected_templates(environment, paths, index, all_names)
+    index.save()
+    if not names:
+        return BuildResult(), []
+
+    result = build(environment, names, manifest, runtime=False)
+    helpers, macros, fingerprints, files = manifest.references(set(all_names))
+    result.errors += write_shared(environment, helpers, macros, fingerprints, files)
+
+    written = set(result.outputs.values())
+    written.add(fingerprints.get(environment.underscore_runtime_path,
+                                 environment.underscore_runtime_path))
+    if environment.underscore_fingerprint:
+        written.add(environment.underscore_fingerprint_manifest)
+    if environment.underscore_bundles and not result.errors:
+        for bundle in bundles(environment, files):
+            bundle = fingerprints.get(bundle, bundle)
+            written.update(bundle + extension for extension in [''] + compressed_extensions())
+    base_path = os.path.realpath(environment.underscore_base_path)
+    # output outside the repository isn't committed, so there's nothing to
+    # compare
+    full_paths = [os.path.join(base_path, path) for path in written
+                  if os.path.exists(os.path.join(base_path, path))]
+    full_paths = [path for path in full_paths if path.startswith(top + os.sep)]
+    staged = staged_hashes(top, full_paths)
+    differ = [os.path.relpath(path, base_path) for path in sorted(full_paths)
+              if staged.get(path) != blob_hash(path)]
+    return result, differ
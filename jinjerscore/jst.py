@@ -0,0 +1,115 @@
+import json
+import os
+import re
+from jinjerscore.runtime import runtime_import
+
+
+OUTPUT_MODES = ('template', 'jst', 'esm')
+
+_matcher = re.compile(r'<%-([\s\S]+?)%>|<%=([\s\S]+?)%>|<%([\s\S]+?)%>|\Z')
+_escaper = re.compile(u'\\\\|\'|\r|\n|\u2028|\u2029')
+_escapes = {
+    u'\\': u'\\\\',
+    u"'": u"\\'",
+    u'\r': u'\\r',
+    u'\n': u'\\n',
+    u'\u2028': u'\\u2028',
+    u'\u2029': u'\\u2029',
+}
+
+
+def _escape(text):
+    return _escaper.sub(lambda m: _escapes[m.group(0)], text)
+
+
+def _render_source(text):
+    # the statements that build the output of `text` in __p
+    source = [u"__p+='"]
+    index = 0
+    for match in _matcher.finditer(text):
+        escape, interpolate, evaluate = match.groups()
+        source.append(_escape(text[index:match.start()]))
+        index = match.end()
+        if escape:
+            source.append(u"'+\n((__t=(%s))==null?'':_.escape(__t))+\n'" % escape)
+        elif interpolate:
+            source.append(u"'+\n((__t=(%s))==null?'':__t)+\n'" % interpolate)
+        elif evaluate:
+            source.append(u"';\n%s\n__p+='" % evaluate)
+    source.append(u"';\n")
+    return u''.join(source)
+
+
+_prelude = (u"var __t,__p='',__j=Array.prototype.join,"
+            u"print=function(){__p+=__j.call(arguments,'');};\n")
+
+
+def template_function(text, variable=None):
+    """Return the source of a JavaScript function equivalent to
+    `_.template(text).source`. This is a port of Underscore's own source
+    generation, so the precompiled function behaves exactly like the one
+    the browser would have built.
+    """
+    source = _render_source(text)
+    if not variable:
+        source = u'with(obj||{}){\n%s}\n' % source
+    return u'function(%s){\n%s%sreturn __p;\n}' % (variable or u'obj', _prelude, source)
+
+
+def macro_function(text, params, defaults=()):
+    """Return the source of a JavaScript function that renders `text` with
+    `params` as its arguments. `defaults` are statements run first, to fill
+    in missing arguments.
+    """
+    return u'function(%s){\n%s%s%sreturn __p;\n}' % (
+        u', '.join(params), u''.join(u'%s\n' % x for x in defaults), _prelude,
+        _render_source(text))
+
+
+def template_name(path):
+    """The JST key for an output path: the path without its extension."""
+    return os.path.splitext(path)[0].replace(os.sep, '/')
+
+
+def jst_module(path, text, namespace='JST', variable=None):
+    """Wrap a precompiled template so it registers itself in a global
+    namespace object, as the JST convention expects.
+    """
+    return (u'(function() {\n'
+            u'this.%(ns)s = this.%(ns)s || {};\n'
+            u'this.%(ns)s[%(name)s] = %(func)s;\n'
+            u'}).call(this);\n' % {
+                'ns': namespace,
+                'name': json.dumps(template_name(path)),
+                'func': template_function(text, variable),
+            })
+
+
+def es_module(path, text, variable=None, runtime=None):
+    """Wrap a precompiled template as an ES module with the render function
+    as its default export. `runtime` is a (name, import path) pair for
+    templates that call the filter and test runtime.
+    """
+    imports = u"import _ from 'underscore';\n"
+    if runtime is not None:
+        imports += u'import %s from %s;\n' % (runtime[0], json.dumps(runtime[1]))
+    return imports + u'export default %s;\n' % template_function(text, variable)
+
+
+def compile_output(environment, path, text, needs_runtime=False):
+    """Convert generated Underscore text according to the environment's
+    `underscore_output` mode. `needs_runtime` is whether the text calls the
+    runtime's helpers or macros, which ES modules then import.
+    """
+    mode = environment.underscore_output
+    if mode == 'template':
+        return text
+    elif mode == 'jst':
+        return jst_module(path, text, environment.underscore_jst_namespace,
+                          environment.underscore_variable)
+    elif mode == 'esm':
+        runtime = None
+        if needs_runtime:
+            runtime = (environment.underscore_runtime, runtime_import(environment, path))
+        return es_module(path, text, environment.underscore_variable, runtime)
+    raise ValueError('unknown underscore output mode %r' % mode)
@@ -0,0 +1,29 @@
+from jinjerscore.compiler import JinjerscoreEmitter
+from jinjerscore.optimizer import optimize
+
+
+def compile_macros(environment, refs):
+    """Compile the macros in `refs`, a collection of (template name, macro
+    name) pairs, and every macro those call in turn. Returns a dict of
+    template name -> {macro name: JS function source}, and the runtime
+    helpers the macros call.
+    """
+    functions = {}
+    helpers = set()
+    pending = set(refs)
+    while pending:
+        by_template = {}
+        for template, name in pending:
+            by_template.setdefault(template, set()).add(name)
+        pending = set()
+        for template, names in sorted(by_template.iteritems()):
+            source, filename = environment.loader.get_source(environment, template)[:2]
+            node = environment.flatten(environment.parse(source, template, filename), template)
+            if environment.optimized:
+                node = optimize(node, environment)
+            emitter = JinjerscoreEmitter(environment, template, filename)
+            functions.setdefault(template, {}).update(emitter.macro_functions(node, names))
+            helpers.update(emitter.helpers)
+            pending.update((t, n) for t, n in emitter.macro_refs
+                           if n not in functions.get(t, ()))
+    return functions, helpers
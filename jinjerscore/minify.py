@@ -0,0 +1,75 @@
+import re
+
+
+_tag = re.compile(r'<%([=-]?)([\s\S]+?)%>')
+_whitespace = re.compile(r'\s+')
+_preformatted = re.compile(r'<(/?)(?:pre|textarea)\b', re.I)
+
+
+def _collapse(match):
+    return '\n' in match.group(0) and u'\n' or u' '
+
+
+def _collapse_text(text, preformatted):
+    # collapse whitespace up to each <pre> or <textarea> tag, and from the
+    # tag closing it
+    chunks = []
+    index = 0
+    for match in _preformatted.finditer(text):
+        chunk = text[index:match.start()]
+        chunks.append(preformatted and chunk or _whitespace.sub(_collapse, chunk))
+        preformatted = not match.group(1)
+        index = match.start()
+    chunk = text[index:]
+    chunks.append(preformatted and chunk or _whitespace.sub(_collapse, chunk))
+    return u''.join(chunks), preformatted
+
+
+def _join_statements(first, second):
+    # Statements usually need a separator when merged into one tag, but not
+    # after an opening brace, and never in front of an else.
+    if first.endswith(('{', ';')) or second.startswith('else'):
+        return first + u' ' + second
+    return first + u'; ' + second
+
+
+def minify(text):
+    """Shrink Underscore template text: trim the code in every tag, merge
+    adjacent <% %> statements into one tag, and collapse whitespace runs in
+    the HTML to a single character, outside of <pre> and <textarea>.
+    """
+    tokens = []
+    index = 0
+    for match in _tag.finditer(text):
+        tokens.append((None, text[index:match.start()]))
+        tokens.append((match.group(1), match.group(2).strip()))
+        index = match.end()
+    tokens.append((None, text[index:]))
+
+    out = []
+    preformatted = False
+    # the code of a pending statement tag that later statements merge into
+    statement = None
+    for kind, value in tokens:
+        if kind is None:
+            value, preformatted = _collapse_text(value, preformatted)
+            if value:
+                if statement is not None:
+                    out.append(u'<%' + statement + u'%>')
+                    statement = None
+                out.append(value)
+        elif kind == '':
+            if not value:
+                continue
+            if statement is None:
+                statement = value
+            else:
+                statement = _join_statements(statement, value)
+        else:
+            if statement is not None:
+                out.append(u'<%' + statement + u'%>')
+                statement = None
+            out.append(u'<%' + kind + value + u'%>')
+    if statement is not None:
+        out.append(u'<%' + statement + u'%>')
+    return u''.join(out)
@@ -0,0 +1,137 @@
+from jinja2 import nodes
+from jinja2.optimizer import Optimizer
+
+
+def optimize(node, environment):
+    """Fold as much of the tree as possible at compile time, so that less
+    is left for Underscore to evaluate in the browser.
+    """
+    optimizer = JinjerscoreOptimizer(environment)
+    return optimizer.visit(node)
+
+
+def truthiness(node):
+    """Return whether an expression is truthy, if that's known at compile
+    time, and None if it isn't.
+    """
+    if isinstance(node, nodes.Const):
+        return bool(node.value)
+    elif isinstance(node, nodes.Not):
+        value = truthiness(node.node)
+        if value is not None:
+            return not value
+    elif isinstance(node, (nodes.And, nodes.Or)):
+        left, right = truthiness(node.left), truthiness(node.right)
+        decisive = isinstance(node, nodes.Or)
+        if left is decisive or right is decisive:
+            return decisive
+        if left is not None and right is not None:
+            return not decisive
+    return None
+
+
+class JinjerscoreOptimizer(Optimizer):
+    """Adds folding that Jinja's optimizer leaves to runtime: partially
+    constant concatenations, conditionals and boolean operators, and tests
+    whose truthiness is known even though their value isn't. The resulting
+    constant text is merged into the surrounding template data.
+    """
+
+    def generic_visit(self, node, *args, **kwargs):
+        node = super(JinjerscoreOptimizer, self).generic_visit(node, *args, **kwargs)
+        # removed branches leave runs of Output nodes behind, which read
+        # better as one
+        for field in 'body', 'else_':
+            body = getattr(node, field, None)
+            if body and isinstance(body, list):
+                setattr(node, field, self.merge_output(body))
+        return node
+
+    def merge_output(self, body):
+        rv = []
+        for child in body:
+            if isinstance(child, nodes.Output) and rv and isinstance(rv[-1], nodes.Output):
+                rv[-1] = nodes.Output(rv[-1].nodes + child.nodes, lineno=rv[-1].lineno,
+                                      environment=self.environment)
+            else:
+                rv.append(child)
+        return rv
+
+    def simplify_test(self, node):
+        """Drop the operands of a test that can't change its truthiness."""
+        if isinstance(node, (nodes.And, nodes.Or)):
+            node.left = self.simplify_test(node.left)
+            node.right = self.simplify_test(node.right)
+            if truthiness(node.right) is isinstance(node, nodes.And):
+                return node.left
+        return node
+
+    def visit_If(self, node):
+        if node.find(nodes.Block) is None:
+            node.test = self.simplify_test(self.visit(node.test))
+            value = truthiness(node.test)
+            if value is not None:
+                result = []
+                for child in (node.body if value else node.else_):
+                    result.extend(self.visit_list(child))
+                return result
+        return super(JinjerscoreOptimizer, self).visit_If(node)
+
+    def visit_Output(self, node):
+        node = self.generic_visit(node)
+        # printing a concatenation is the same as printing its parts, which
+        # lets the constant ones join the template data around them
+        children = []
+        for child in node.nodes:
+            if isinstance(child, nodes.Concat):
+                children.extend(child.nodes)
+            else:
+                children.append(child)
+        node.nodes = children
+        return node
+
+    def visit_Concat(self, node):
+        node = self.generic_visit(node)
+        # join runs of constants, then fold the whole thing if we can
+        parts = []
+        for child in node.nodes:
+            if isinstance(child, nodes.Concat):
+                parts.extend(child.nodes)
+            elif isinstance(child, nodes.Const) and parts and isinstance(parts[-1], nodes.Const):
+                value = unicode(parts[-1].value) + unicode(child.value)
+                parts[-1] = nodes.Const(value, lineno=parts[-1].lineno,
+                                        environment=self.environment)
+            else:
+                parts.append(child)
+        node.nodes = parts
+        try:
+            return nodes.Const.from_untrusted(node.as_const(), lineno=node.lineno,
+                                              environment=self.environment)
+        except nodes.Impossible:
+            if len(parts) == 1 and isinstance(parts[0], nodes.Const):
+                return parts[0]
+            return node
+
+    def visit_CondExpr(self, node):
+        node = super(JinjerscoreOptimizer, self).visit_CondExpr(node)
+        if isinstance(node, nodes.CondExpr):
+            value = truthiness(node.test)
+            if value:
+                return node.expr1
+            elif value is not None and node.expr2 is not None:
+                return node.expr2
+        return node
+
+    def fold_boolean(self, node):
+        # all of Jinja's folding visitors are the same function
+        node = Optimizer.visit_And(self, node)
+        if isinstance(node, (nodes.And, nodes.Or)):
+            # a constant left side either decides the result or drops out
+            left = truthiness(node.left)
+            if left is not None:
+                if left is isinstance(node, nodes.Or):
+                    return node.left
+                return node.right
+        return node
+
+    visit_And = visit_Or = fold_boolean
@@ -10,8 +10,19 @@ class JinjerscoreParser(Parser):
         # which generates a flat list of operands for a single Compare node in this case.
         # We do this for Underscore's syntactic needs - see
         # jinjerscore.compiler.JinjerscoreGenerator.visit_Compare
+        # Compare nodes that continue a chain Jinja's parser would keep in one
+        # node are marked as such, so that the chain can be put back together
+        # for python; see jinjerscore.astcache
         lineno = self.stream.current.lineno
         expr = self.parse_add()
+        chain = []
+
+        def compare(expr, ops, lineno):
+            node = nodes.Compare(expr, ops, lineno=lineno)
+            node.continues_chain = bool(chain) and expr is chain[-1]
+            chain.append(node)
+            return node
+
         ops = []
         is_compare = self.stream.current.type in _compare_operators
         while 1:
@@ -22,15 +33,15 @@ class JinjerscoreParser(Parser):
                 is_compare = True
             elif self.stream.skip_if('name:in'):
                 if is_compare:
-                    expr = nodes.Compare(expr, ops, lineno=lineno)
-                expr = nodes.Compare(expr, [nodes.Operand('in', self.parse_add())], lineno=lineno)
+                    expr = compare(expr, ops, lineno)
+                expr = compare(expr, [nodes.Operand('in', self.parse_add())], lineno)
                 ops = []
                 is_compare = False
             elif self.stream.current.test('name:not') and self.stream.look().test('name:in'):
                 if is_compare:
-                    expr = nodes.Compare(expr, ops, lineno=lineno)
+                    expr = compare(expr, ops, lineno)
                 self.stream.skip(2)
-                expr = nodes.Compare(expr, [nodes.Operand('notin', self.parse_add())], lineno=lineno)
+                expr = compare(expr, [nodes.Operand('notin', self.parse_add())], lineno)
                 ops = []
                 is_compare = False
             else:
@@ -38,4 +49,4 @@ class JinjerscoreParser(Parser):
             lineno = self.stream.current.lineno
         if not ops:
             return expr
-        return nodes.Compare(expr, ops, lineno=lineno)
+        return compare(expr, ops, lineno)
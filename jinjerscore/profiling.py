@@ -0,0 +1,135 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+PHASES = ('lex', 'parse', 'codegen', 'compile', 'render')
+
+
+class Profile(object):
+    """Per-template timings and counts, collected while a profiled
+    environment compiles and renders. Set one as the environment's
+    `underscore_profile` to turn profiling on.
+
+    Timers nest, and time counts against the innermost one running only,
+    so the parses of the layouts and partials flattened into a template
+    count against their own names rather than its `codegen`. Lexing happens
+    lazily as the parser consumes tokens, and is timed token by token, with
+    `parse` the rest of the parse time. `codegen` includes flattening and
+    optimizing the tree.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        # the template being rendered, which output is counted against
+        self.current = None
+        # [name, phase, time started or resumed] of the running timers,
+        # innermost last
+        self._running = []
+
+    def entry(self, name):
+        if name not in self.templates:
+            entry = dict((phase, 0.0) for phase in PHASES)
+            entry.update(visits={}, output_bytes=0)
+            self.templates[name] = entry
+        return self.templates[name]
+
+    def start(self, name, phase):
+        """Start timing `phase` of `name`, pausing the running timer."""
+        now = time.time()
+        if self._running:
+            outer = self._running[-1]
+            self.entry(outer[0])[outer[1]] += now - outer[2]
+        self._running.append([name, phase, now])
+
+    def stop(self):
+        """Stop the innermost timer, resuming the one it paused."""
+        now = time.time()
+        name, phase, start = self._running.pop()
+        self.entry(name)[phase] += now - start
+        if self._running:
+            self._running[-1][2] = now
+
+    @contextmanager
+    def timer(self, name, phase):
+        self.start(name, phase)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def tokens(self, name, stream):
+        """Iterate over the tokens of `stream`, timing the lexing of each
+        as `name`'s.
+        """
+        while True:
+            self.start(name, 'lex')
+            try:
+                token = next(stream, None)
+            finally:
+                self.stop()
+            if token is None:
+                return
+            yield token
+
+    @contextmanager
+    def rendering(self, name):
+        previous, self.current = self.current, name
+        try:
+            with self.timer(name, 'render'):
+                yield
+        finally:
+            self.current = previous
+
+    def visit(self, name, node):
+        visits = self.entry(name)['visits']
+        node_type = node.__class__.__name__
+        visits[node_type] = visits.get(node_type, 0) + 1
+
+    def output(self, size):
+        if self.current is not None:
+            self.entry(self.current)['output_bytes'] += size
+
+    def merge(self, name, entry):
+        """Add an entry recorded elsewhere, by a build worker, say."""
+        ours = self.entry(name)
+        for phase in PHASES:
+            ours[phase] += entry[phase]
+        ours['output_bytes'] += entry['output_bytes']
+        for node_type, count in entry['visits'].iteritems():
+            ours['visits'][node_type] = ours['visits'].get(node_type, 0) + count
+
+    def total(self, name):
+        entry = self.templates[name]
+        return sum(entry[phase] for phase in PHASES)
+
+    def slowest(self, n=10):
+        return sorted(self.templates, key=self.total, reverse=True)[:n]
+
+    def report(self, top=10):
+        """The profile as a JSON-serializable dict."""
+        templates = {}
+        for name, entry in self.templates.iteritems():
+            templates[name] = dict(entry, total=self.total(name))
+        totals = dict((phase, sum(entry[phase] for entry in self.templates.itervalues()))
+                      for phase in PHASES)
+        totals['output_bytes'] = sum(entry['output_bytes']
+                                     for entry in self.templates.itervalues())
+        return {'templates': templates, 'totals': totals, 'slowest': self.slowest(top)}
+
+    def save(self, path, top=10):
+        with open(path, 'w') as f:
+            json.dump(self.report(top), f, indent=1, sort_keys=True)
+
+    def summary(self, top=10):
+        """A table of the `top` slowest templates, with their phase times
+        in milliseconds.
+        """
+        lines = ['%-40s %8s ' % ('template', 'total') +
+                 ' '.join('%8s' % phase for phase in PHASES) + ' %10s' % 'bytes']
+        for name in self.slowest(top):
+            entry = self.templates[name]
+            lines.append('%-40s %8.1f ' % (name[-40:], self.total(name) * 1000) +
+                         ' '.join('%8.1f' % (entry[phase] * 1000) for phase in PHASES) +
+                         ' %10d' % entry['output_bytes'])
+        return '\n'.join(lines)
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from jinjerscore.files import fingerprinted_path, write_atomic
+
+
+RUNTIME_NAME = 'jinjerscore-runtime.js'
+
+# JS implementations of Jinja's filters and tests, as name -> (the helpers
+# the function calls, function source). Tests are named after the test with
+# an is_ prefix. Inside a function, `rt` is the runtime object itself.
+HELPERS = {
+    'str': ((), "function(x) { return x == null ? '' : String(x); }"),
+    'abs': ((), 'function(x) { return Math.abs(x); }'),
+    'attr': ((), 'function(obj, name) { '
+             'return obj == null || !_.has(obj, name) ? void 0 : obj[name]; }'),
+    'capitalize': (('str',), 'function(s) { s = rt.str(s); '
+                   'return s.charAt(0).toUpperCase() + s.slice(1).toLowerCase(); }'),
+    'center': (('str',), 'function(s, width) { s = rt.str(s); '
+               'width = width === void 0 ? 80 : width; '
+               'var pad = Math.max(0, width - s.length), '
+               'left = Math.floor(pad / 2) + (pad & width & 1); '
+               'return new Array(left + 1).join(\' \') + s + '
+               'new Array(pad - left + 1).join(\' \'); }'),
+    'default': ((), 'function(value, fallback, boolean) { '
+                'return value === void 0 || (boolean && !value) ? '
+                '(fallback === void 0 ? \'\' : fallback) : value; }'),
+    'escape': (('str',), 'function(s) { return _.escape(rt.str(s)); }'),
+    'first': ((), 'function(seq) { return seq == null ? void 0 : seq[0]; }'),
+    'float': ((), 'function(x, fallback) { x = parseFloat(x); '
+              'return isNaN(x) ? (fallback === void 0 ? 0 : fallback) : x; }'),
+    'int': ((), 'function(x, fallback) { x = parseInt(x, 10); '
+            'return isNaN(x) ? (fallback === void 0 ? 0 : fallback) : x; }'),
+    'join': (('str',), 'function(seq, sep, attribute) { '
+             'return _.map(seq, function(x) { '
+             'return rt.str(attribute === void 0 ? x : x[attribute]); }).join(sep || \'\'); }'),
+    'last': ((), 'function(seq) { return seq == null ? void 0 : seq[seq.length - 1]; }'),
+    'length': ((), 'function(x) { return _.size(x); }'),
+    'list': ((), 'function(x) { return typeof x == \'string\' ? x.split(\'\') : '
+             '_.isArray(x) ? x.slice() : _.keys(x); }'),
+    'lower': (('str',), 'function(s) { return rt.str(s).toLowerCase(); }'),
+    'replace': (('str',), 'function(s, old, replacement, count) { '
+                'var parts = rt.str(s).split(old); '
+                'if (count === void 0 || count < 0 || count >= parts.length - 1) '
+                'return parts.join(replacement); '
+                'return parts.slice(0, count + 1).join(replacement) + old + '
+                'parts.slice(count + 1).join(old); }'),
+    'reverse': ((), 'function(x) { return typeof x == \'string\' ? '
+                'x.split(\'\').reverse().join(\'\') : _.toArray(x).reverse(); }'),
+    'round': ((), 'function(x, precision, method) { '
+              'var scale = Math.pow(10, precision || 0), round; '
+              'if (method === void 0 || method == \'common\') '
+              'round = function(x) { return x < 0 ? -Math.round(-x) : Math.round(x); }; '
+              'else if (method == \'ceil\' || method == \'floor\') round = Math[method]; '
+              'else throw new Error(\'method must be common, ceil or floor\'); '
+              'return round(x * scale) / scale; }'),
+    'safe': ((), 'function(x) { return x; }'),
+    'sort': ((), 'function(seq, reverse, caseSensitive, attribute) { '
+             'var rv = _.sortBy(seq, function(x) { '
+             'if (attribute !== void 0) x = x[attribute]; '
+             'return !caseSensitive && typeof x == \'string\' ? x.toLowerCase() : x; }); '
+             'return reverse ? rv.reverse() : rv; }'),
+    'striptags': (('str',), 'function(s) { return rt.str(s).replace(/<!--[\\s\\S]*?-->|<[^>]*>/g, \'\')'
+                  '.replace(/\\s+/g, \' \').replace(/^ | $/g, \'\'); }'),
+    'sum': ((), 'function(seq, attribute, start) { '
+            'return _.reduce(seq, function(total, x) { '
+            'return total + (attribute === void 0 ? x : x[attribute]); }, start || 0); }'),
+    'title': (('str',), 'function(s) { s = rt.str(s); var rv = \'\', cased = false; '
+              'for (var i = 0; i < s.length; i++) { var c = s.charAt(i); '
+              'rv += cased ? c.toLowerCase() : c.toUpperCase(); '
+              'cased = c.toLowerCase() != c.toUpperCase(); } return rv; }'),
+    'trim': (('str',), 'function(s) { return rt.str(s).replace(/^\\s+|\\s+$/g, \'\'); }'),
+    'truncate': (('str',), 'function(s, length, killwords, end) { s = rt.str(s); '
+                 'length = length === void 0 ? 255 : length; '
+                 'end = end === void 0 ? \'...\' : end; '
+                 'if (s.length <= length) return s; '
+                 'if (killwords) return s.slice(0, length) + end; '
+                 'var words = s.split(\' \'), rv = [], m = 0; '
+                 'for (var i = 0; i < words.length; i++) { m += words[i].length + 1; '
+                 'if (m > length) break; rv.push(words[i]); } '
+                 'rv.push(end); return rv.join(\' \'); }'),
+    'upper': (('str',), 'function(s) { return rt.str(s).toUpperCase(); }'),
+    'wordcount': (('str',), 'function(s) { return (rt.str(s).match(/\\w+/g) || []).length; }'),
+
+    'is_callable': ((), 'function(x) { return _.isFunction(x); }'),
+    'is_defined': ((), 'function(x) { return x !== void 0; }'),
+    'is_divisibleby': ((), 'function(x, n) { return x % n == 0; }'),
+    'is_even': ((), 'function(x) { return x % 2 == 0; }'),
+    'is_iterable': ((), 'function(x) { return typeof x == \'string\' || _.isObject(x); }'),
+    'is_lower': (('str',), 'function(s) { s = rt.str(s); return s.toLowerCase() == s; }'),
+    'is_mapping': ((), 'function(x) { return _.isObject(x) && !_.isArray(x) && '
+                   '!_.isFunction(x); }'),
+    'is_none': ((), 'function(x) { return x === null; }'),
+    'is_number': ((), 'function(x) { return typeof x == \'number\'; }'),
+    'is_odd': ((), 'function(x) { return Math.abs(x % 2) == 1; }'),
+    'is_sameas': ((), 'function(x, other) { return x === other; }'),
+    'is_sequence': ((), 'function(x) { return typeof x == \'string\' || _.isArray(x) || '
+                    '_.isObject(x) && !_.isFunction(x); }'),
+    'is_string': ((), 'function(x) { return typeof x == \'string\'; }'),
+    'is_undefined': ((), 'function(x) { return x === void 0; }'),
+    'is_upper': (('str',), 'function(s) { s = rt.str(s); return s.toUpperCase() == s; }'),
+}
+
+FILTER_ALIASES = {
+    'count': 'length',
+    'd': 'default',
+    'e': 'escape',
+    'string': 'str',
+}
+
+# Filters and tests that make sense of undefined values, so that reading a
+# missing variable for them mustn't throw
+UNDEFINED_SAFE = set(['default', 'is_defined', 'is_undefined'])
+
+
+def filter_helper(name):
+    """The runtime helper for the filter `name`, or None if there's no JS
+    implementation.
+    """
+    name = FILTER_ALIASES.get(name, name)
+    if name in HELPERS and not name.startswith('is_'):
+        return name
+    return None
+
+
+def test_helper(name):
+    """The runtime helper for the test `name`, or None."""
+    name = 'is_' + name
+    if name in HELPERS:
+        return name
+    return None
+
+
+def resolve(names):
+    """`names` and every helper they depend on, sorted."""
+    rv = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in rv:
+            rv.add(name)
+            pending.extend(HELPERS[name][0])
+    return sorted(rv)
+
+
+def runtime_module(names, namespace='jinjerscore', esm=False, macros=None):
+    """Return the source of a runtime holding only the helpers in `names`
+    and their dependencies, and the compiled `macros`, a dict of template
+    name -> {macro name: JS function source}. It's a script defining the
+    global `namespace`, or with `esm`, an ES module exporting the runtime
+    object.
+    """
+    body = [u'rt.%s = %s;\n' % (name, HELPERS[name][1]) for name in resolve(names)]
+    if macros:
+        body.append(u'rt.macros = rt.macros || {};\n')
+        for template, functions in sorted(macros.iteritems()):
+            body.append(u'rt.macros[%s] = {\n%s\n};\n' % (json.dumps(template), u',\n'.join(
+                u'%s: %s' % (json.dumps(name), func)
+                for name, func in sorted(functions.iteritems()))))
+    if esm:
+        # macros refer to the runtime by its name
+        return (u"import _ from 'underscore';\n"
+                u'var rt = {}, %s = rt;\n%s'
+                u'export default rt;\n' % (namespace, u''.join(body)))
+    return (u'(function() {\n'
+            u'var rt = this.%(ns)s = this.%(ns)s || {};\n'
+            u'%(body)s'
+            u'}).call(this);\n' % {'ns': namespace, 'body': u''.join(body)})
+
+
+def runtime_import(environment, path):
+    """The import path of the runtime module from the output `path`."""
+    rv = os.path.relpath(environment.underscore_runtime_path,
+                         os.path.dirname(path) or os.curdir).replace(os.sep, '/')
+    if not rv.startswith('.'):
+        rv = './' + rv
+    return rv
+
+
+def runtime_source(environment, names, macros=()):
+    """The runtime for the helpers in `names` and the macros in `macros`,
+    (template name, macro name) pairs, or None if there's nothing to write.
+    """
+    from jinjerscore.macros import compile_macros
+    if not (names or macros):
+        return None
+    functions, macro_helpers = compile_macros(environment, macros)
+    return runtime_module(set(names) | macro_helpers, environment.underscore_runtime,
+                          environment.underscore_output == 'esm', functions)
+
+
+def write_runtime(environment, names, macros=(), fingerprints=None):
+    """Write the runtime for the helpers in `names` and the macros in
+    `macros` to the environment's `underscore_runtime_path`, under its base
+    path. Returns whether anything was written: an unchanged runtime is left
+    alone, like template output. A fingerprinted runtime's file is added to
+    the dict `fingerprints`.
+    """
+    if environment.underscore_runtime_path is None:
+        return False
+    output = runtime_source(environment, names, macros)
+    if output is None:
+        return False
+    full_path = os.path.join(environment.underscore_base_path,
+                             environment.underscore_runtime_path)
+    if environment.underscore_fingerprint and environment.underscore_output != 'esm':
+        digest = hashlib.sha1(output.encode('utf-8')).hexdigest()
+        full_path = fingerprinted_path(full_path, digest)
+        if fingerprints is not None:
+            fingerprints[environment.underscore_runtime_path] = os.path.relpath(
+                full_path, environment.underscore_base_path)
+    return write_atomic(full_path, [output])
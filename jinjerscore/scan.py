@@ -0,0 +1,201 @@
+"""A quick look at every template, before the real work, for the ones that
+generate anything.
+
+Most templates in a project usually have no jinjerscore tag, and neither do
+the templates they extend, include or import, so rendering them generates
+nothing. With `underscore_scan` set, builds lex each template once, and only
+lex, to find those that might, and leave the rest alone. What was found is
+kept in `underscore_scan_index`, a JSON file in the base path, by each
+template file's mtime and size, so unchanged templates aren't even read by
+the next build.
+"""
+import json
+import os
+from jinja2.exceptions import TemplateNotFound, TemplateSyntaxError
+from jinjerscore.files import write_atomic
+
+
+SCAN_INDEX_NAME = '.jinjerscore-scan.json'
+
+# bumped when scan_source changes what it finds, so older indexes are
+# thrown away
+SCAN_VERSION = 2
+
+# every template that generates output, or refers to another template, has
+# one of these in its source
+_KEYWORDS = ('jinjerscore', 'extends', 'include', 'import')
+
+# the names that can follow a constant template name in a tag that refers to
+# a template
+_MODIFIERS = ('ignore', 'import', 'as', 'with', 'without')
+
+
+def scan_source(environment, source, name=None, filename=None):
+    """Lex a template's source, returning whether it has a jinjerscore tag,
+    the templates it extends, includes or imports by constant name, and
+    whether it refers to any by a name that isn't constant. Being the lexer's
+    tokens, tags in comments and raw blocks don't count.
+    """
+    blocks = False
+    references = set()
+    dynamic = False
+    if not any(keyword in source for keyword in _KEYWORDS):
+        return blocks, [], dynamic
+    tokens = list(environment._tokenize(source, name, filename))
+    for i, token in enumerate(tokens[:-1]):
+        if token.type != 'block_begin' or tokens[i + 1].type != 'name':
+            continue
+        tag = tokens[i + 1].value
+        if tag == 'jinjerscore':
+            blocks = True
+        elif tag in ('extends', 'include', 'import', 'from'):
+            # `{% include "a.html" ignore missing %}` is constant,
+            # `{% include "a" ~ b %}` and `{% extends "a" if b else "c" %}`
+            # aren't
+            if i + 3 < len(tokens) and tokens[i + 2].type == 'string' and \
+                    (tokens[i + 3].type == 'block_end' or
+                     tokens[i + 3].type == 'name' and tokens[i + 3].value in _MODIFIERS):
+                references.add(tokens[i + 2].value)
+            else:
+                dynamic = True
+    return blocks, sorted(references), dynamic
+
+
+def template_file(environment, name):
+    """The file the loader loads the template `name` from, or None if it
+    isn't a file on the loader's search path.
+    """
+    for root in getattr(environment.loader, 'searchpath', ()):
+        path = os.path.join(root, *name.split('/'))
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def template_name(environment, path):
+    """The name the template file at `path` is loaded by, whether or not it
+    exists, or None if it's outside the loader's search path. Symlinks are
+    resolved on both sides.
+    """
+    path = os.path.realpath(path)
+    for root in getattr(environment.loader, 'searchpath', ()):
+        name = os.path.relpath(path, os.path.realpath(root))
+        if name.split(os.sep)[0] != os.pardir:
+            return name.replace(os.sep, '/')
+    return None
+
+
+class ScanIndex(object):
+    """What `scan_source` found in each template, by the mtime and size of
+    its file when it was scanned.
+    """
+
+    def __init__(self, environment, path, options=None):
+        self.environment = environment
+        self.path = path
+        self.options = options
+        self.templates = {}
+
+    @classmethod
+    def load(cls, environment, path=None):
+        if path is None:
+            path = os.path.join(environment.underscore_base_path,
+                                environment.underscore_scan_index)
+        # the syntax settings decide what the lexer finds
+        index = cls(environment, path,
+                    [SCAN_VERSION, environment.generator_options()['syntax']])
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('options') == index.options:
+                index.templates = data.get('templates', {})
+        return index
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_atomic(self.path, [json.dumps({'options': self.options,
+                                             'templates': self.templates},
+                                            indent=1, sort_keys=True)])
+
+    def entry(self, name):
+        """What the scan of `name` found, scanning it again if its file has
+        changed since. Raises TemplateNotFound for missing templates.
+        """
+        environment = self.environment
+        stat = self._stat(name)
+        entry = self.templates.get(name)
+        if entry is not None and stat is not None and entry['stat'] == stat:
+            return entry
+        source, filename = environment.loader.get_source(environment, name)[:2]
+        try:
+            blocks, references, dynamic = scan_source(environment, source, name, filename)
+        except TemplateSyntaxError:
+            # leave it to the build to report
+            blocks, references, dynamic = True, [], False
+        entry = {'stat': stat, 'blocks': blocks, 'references': references,
+                 'dynamic': dynamic}
+        if stat is not None:
+            self.templates[name] = entry
+        return entry
+
+    def _stat(self, name):
+        # the [mtime, size] of the template's file, if the loader has one
+        path = template_file(self.environment, name)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+
+    def generates(self, name, _seen=None):
+        """Whether rendering `name` could generate anything: it has a
+        jinjerscore tag, or a template it refers to does, or it refers to
+        one we can't tell.
+        """
+        if _seen is None:
+            _seen = set()
+        _seen.add(name)
+        try:
+            entry = self.entry(name)
+        except TemplateNotFound:
+            return False
+        if entry['blocks'] or entry['dynamic']:
+            return True
+        for reference in entry['references']:
+            if reference not in _seen and self.generates(reference, _seen):
+                return True
+        return False
+
+    def dependents(self, names, all_names):
+        """The templates in `all_names` that extend, include or import any of
+        `names`, directly or through others, and those that refer to
+        templates by names that aren't constant, which might be any of them.
+        """
+        referrers = {}
+        rv = set()
+        for name in all_names:
+            entry = self.entry(name)
+            if entry['dynamic']:
+                rv.add(name)
+            for reference in entry['references']:
+                referrers.setdefault(reference, set()).add(name)
+        pending = list(names)
+        seen = set(pending)
+        while pending:
+            for referrer in referrers.get(pending.pop(), ()):
+                rv.add(referrer)
+                if referrer not in seen:
+                    seen.add(referrer)
+                    pending.append(referrer)
+        return rv
+
+    def select(self, names):
+        """The templates in `names` that could generate anything."""
+        return [name for name in names if self.generates(name)]
+
+    def prune(self):
+        """Forget templates whose files are gone."""
+        for name in list(self.templates):
+            if self._stat(name) is None:
+                del self.templates[name]
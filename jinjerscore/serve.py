@@ -0,0 +1,304 @@
+"""Generate Underscore output in memory, and serve it over WSGI.
+
+    from jinjerscore.serve import UnderscoreApp
+    application = UnderscoreApp(environment)
+
+The app serves every output path of every template the environment's loader
+knows about, and the JS runtime at `underscore_runtime_path`, with strong
+ETags, so clients revalidate cheaply and get a `304 Not Modified` until the
+source changes.
+"""
+import hashlib
+import sys
+import threading
+from jinja2.exceptions import TemplateNotFound
+from jinja2.utils import LRUCache
+from jinjerscore.build import DependencyTracker, GenerationError, source_hash
+from jinjerscore.runtime import runtime_source
+
+
+def generate_outputs(environment, name):
+    """Generate the template `name` without touching disk. Returns a dict
+    of output path -> output, and the runtime helpers and macros it calls.
+
+    The template is compiled afresh rather than taken from the environment's
+    template cache, which doesn't know about the layouts and partials
+    flattened into it.
+    """
+    environment.underscore_outputs = {}
+    environment.underscore_helpers = set()
+    environment.underscore_macros = set()
+    try:
+        if environment.underscore_extract:
+            environment.extract_underscore(name)
+        else:
+            source, filename, uptodate = environment.loader.get_source(environment, name)
+            code = environment.compile(source, name, filename)
+            environment.template_class.from_code(environment, code,
+                                                 environment.make_globals(None),
+                                                 uptodate).render()
+        return (environment.underscore_outputs, environment.underscore_helpers,
+                environment.underscore_macros)
+    finally:
+        environment.underscore_outputs = None
+        environment.underscore_helpers = None
+        environment.underscore_macros = None
+
+
+class OutputCache(object):
+    """A bounded cache of generated templates, keyed on the hash of their
+    source and the sources of everything they extend, include or import, so
+    that an entry is never served after any of them changes.
+
+    Generation sets state on the environment, so it's serialized; give the
+    cache an environment of its own.
+    """
+
+    def __init__(self, environment, size=100):
+        self.environment = environment
+        self._cache = LRUCache(size)
+        self._lock = threading.Lock()
+        # the dependencies of each template when it was last generated
+        self._dependencies = {}
+        # the (helpers, macros) each template calls, as last generated
+        self._used = {}
+
+    @property
+    def helpers(self):
+        """The helpers the templates generated so far call."""
+        return set().union(*[helpers for helpers, macros in self._used.values()])
+
+    @property
+    def macros(self):
+        """The macros the templates generated so far call."""
+        return set().union(*[macros for helpers, macros in self._used.values()])
+
+    def digest(self, names):
+        """The combined hash of the sources of `names`; missing templates
+        hash as such, as adding one changes the output.
+        """
+        tracker = DependencyTracker(self.environment)
+        digest = hashlib.sha1()
+        for name in sorted(names):
+            try:
+                digest.update('%s\0%s\0' % (name.encode('utf-8'), tracker.hash(name)))
+            except TemplateNotFound:
+                digest.update('%s\0\0' % name.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, name):
+        """Return the outputs, helpers and macros of the template `name`,
+        generating it if it's not cached or has changed since.
+        """
+        with self._lock:
+            # raises TemplateNotFound for templates that are gone
+            self.environment.loader.get_source(self.environment, name)
+            key = (name, self.digest([name] + self._dependencies.get(name, [])))
+            rv = self._cache.get(key)
+            if rv is None:
+                rv = generate_outputs(self.environment, name)
+                deps = DependencyTracker(self.environment).dependencies(name)[0]
+                self._dependencies[name] = sorted(deps)
+                # the dependencies found may differ from the ones hashed
+                key = (name, self.digest([name] + self._dependencies[name]))
+                self._cache[key] = rv
+                self._used[name] = (set(rv[1]), set(rv[2]))
+            return rv
+
+    def dependencies(self, name):
+        """The dependencies of `name` when it was last generated."""
+        return self._dependencies.get(name, [])
+
+    def forget(self, name):
+        """Stop counting a template that's gone towards the runtime."""
+        with self._lock:
+            self._dependencies.pop(name, None)
+            self._used.pop(name, None)
+
+    def output(self, name, path):
+        """The output the template `name` generates at `path`, as a string."""
+        return self.get(name)[0][path]
+
+    def runtime(self):
+        """The runtime for every helper and macro the templates generated so
+        far call, or None.
+        """
+        with self._lock:
+            helpers, macros = self.helpers, self.macros
+            templates = set(template for template, macro in macros)
+            for template in list(templates):
+                templates.update(self._dependencies.get(template, ()))
+            key = ('', frozenset(helpers), frozenset(macros), self.digest(templates))
+            rv = self._cache.get(key)
+            if rv is None:
+                rv = runtime_source(self.environment, helpers, macros)
+                self._cache[key] = rv
+            return rv
+
+
+class UnderscoreApp(object):
+    """A WSGI app serving generated output by its output path. Outputs are
+    regenerated when their template, or anything it depends on, changes.
+
+    Responses carry `Cache-Control: max-age=...` if `max_age` is given, and
+    `no-cache` otherwise, so clients always revalidate with the ETag.
+
+    Which template generates which path is found by generating them all on
+    the first request for one that isn't known, and again whenever the set of
+    templates changes. After that, only templates that the loader's uptodate
+    checks find changed are generated again, so a request for a path nothing
+    generates costs a listing of the templates and the checks, and reads no
+    sources. Templates whose loader has no uptodate check are only generated
+    again when the set of templates changes.
+    """
+
+    content_types = {
+        'template': 'text/html; charset=utf-8',
+        'jst': 'application/javascript; charset=utf-8',
+        'esm': 'application/javascript; charset=utf-8',
+    }
+
+    def __init__(self, environment, cache_size=100, max_age=None):
+        self.environment = environment
+        self.cache = OutputCache(environment, cache_size)
+        self.max_age = max_age
+        # output path -> the template that generates it
+        self._paths = {}
+        # the templates whose paths are known, and for each, the loader's
+        # uptodate checks for it and its dependencies when it was generated
+        self._templates = None
+        self._checks = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD')])
+            return []
+        path = environ.get('PATH_INFO', '').lstrip('/')
+        try:
+            output = self.find(path)
+        except GenerationError, error:
+            return self.error(start_response, '500 Internal Server Error', str(error))
+        if output is None:
+            return self.error(start_response, '404 Not Found', 'No template generates %s' % path)
+
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        etag = '"%s"' % source_hash(output)
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', self.max_age is None and 'no-cache' or
+                              'max-age=%d' % self.max_age),
+        ]
+        if self.etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            start_response('304 Not Modified', headers)
+            return []
+        headers += [
+            ('Content-Type', self.content_type(path)),
+            ('Content-Length', str(len(output))),
+        ]
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [output]
+
+    def find(self, path):
+        """The output at `path`, or None if no template generates it."""
+        if path == self.environment.underscore_runtime_path:
+            # the runtime has to cover every template
+            self.refresh()
+            return self.cache.runtime()
+        output = self.lookup(path)
+        if output is None:
+            # a new template, or one that's moved its output
+            self.refresh()
+            output = self.lookup(path)
+        return output
+
+    def lookup(self, path):
+        # the output at `path` of the template last known to generate it
+        name = self._paths.get(path)
+        if name is None:
+            return None
+        outputs = self.generate(name)
+        if outputs is None or path not in outputs:
+            self._paths.pop(path, None)
+            return None
+        return outputs[path]
+
+    def refresh(self):
+        """Generate the templates that are new, or have changed since their
+        paths were recorded, or every template if the set of them has
+        changed. Templates that fail are left until they change.
+        """
+        with self._lock:
+            names = set(self.environment.list_templates())
+            if names != self._templates:
+                for name in set(self._checks) - names:
+                    self.forget(name)
+                self._templates = names
+                self._checks = {}
+            for name in sorted(names):
+                checks = self._checks.get(name)
+                if checks is not None and all(check() for check in checks):
+                    continue
+                # taken before generating, so that changes made meanwhile
+                # are seen next time
+                self._checks[name] = self.uptodate_checks([name] +
+                                                          self.cache.dependencies(name))
+                try:
+                    self.generate(name)
+                except GenerationError:
+                    continue
+                self._checks[name] += self.uptodate_checks(self.cache.dependencies(name))
+
+    def uptodate_checks(self, names):
+        rv = []
+        for name in names:
+            try:
+                uptodate = self.environment.loader.get_source(self.environment, name)[2]
+            except TemplateNotFound:
+                continue
+            if uptodate is not None:
+                rv.append(uptodate)
+        return rv
+
+    def forget(self, name):
+        # the template is gone
+        self.cache.forget(name)
+        for path, generator in self._paths.items():
+            if generator == name:
+                del self._paths[path]
+
+    def generate(self, name):
+        """Generate `name`, recording the paths it outputs to. Returns None
+        if the template no longer exists.
+        """
+        try:
+            outputs = self.cache.get(name)[0]
+        except TemplateNotFound, error:
+            if error.name != name:
+                raise GenerationError.from_exc_info(name, sys.exc_info())
+            return None
+        except Exception:
+            raise GenerationError.from_exc_info(name, sys.exc_info())
+        for path in outputs:
+            self._paths[path] = name
+        return outputs
+
+    def content_type(self, path):
+        if path == self.environment.underscore_runtime_path:
+            return self.content_types['esm']
+        return self.content_types[self.environment.underscore_output]
+
+    def etag_matches(self, header, etag):
+        if not header:
+            return False
+        # If-None-Match compares weakly
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def error(self, start_response, status, message):
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                                ('Content-Length', str(len(message)))])
+        return [message]
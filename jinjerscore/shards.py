@@ -0,0 +1,169 @@
+"""Splitting a build across machines.
+
+Every machine builds one shard of the template set into its own base path:
+
+    build(environment, manifest=manifest, shard=(1, 4))
+
+Shards are chosen by a stable hash of the template name, so every machine
+agrees on them without talking to the others. `merge` then checks the
+shards' manifests against each other and combines their outputs into one
+tree, with one manifest and runtime, as a single build would have made.
+"""
+import hashlib
+import json
+import os
+from jinjerscore.build import BuildManifest, MANIFEST_NAME, write_shared
+from jinjerscore.files import write_atomic
+
+
+class ShardError(Exception):
+    """Raised when shards don't add up to the whole template set. `problems`
+    lists everything that's wrong.
+    """
+
+    def __init__(self, problems):
+        Exception.__init__(self, '\n'.join(problems))
+        self.problems = problems
+
+
+def parse_shard(spec):
+    """Parse a shard specification like '2/4', the second of four shards,
+    into an (index, count) pair.
+    """
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError('shard %r should look like INDEX/COUNT' % spec)
+    check_shard((index, count))
+    return index, count
+
+
+def check_shard(shard):
+    index, count = shard
+    if not 1 <= index <= count:
+        raise ValueError('shard %d/%d is out of range; shards count from 1' % (index, count))
+
+
+def shard_of(name, count):
+    """The shard, counting from 1, the template `name` belongs to."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(hashlib.sha1(name).hexdigest()[:8], 16) % count + 1
+
+
+def select(names, shard):
+    """The templates in `names` that belong to `shard`, an (index, count)
+    pair.
+    """
+    index, count = shard
+    return [name for name in names if shard_of(name, count) == index]
+
+
+def _load(path):
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def check(environment, paths, names=None):
+    """Check that the shard builds in `paths`, their base paths, make up
+    exactly the template set `names`, or every template the environment
+    knows about. Returns the shards' manifest data, in the order of `paths`;
+    raises ShardError listing every problem found.
+    """
+    if names is None:
+        names = environment.list_templates()
+    options = environment.generator_options()
+    problems = []
+    shards = []
+    owners = {}
+    for path in paths:
+        data = _load(path)
+        if data is None:
+            problems.append('%s: no manifest' % path)
+            continue
+        shards.append(data)
+        if data.get('options') != options:
+            problems.append('%s: built with different generator options' % path)
+        if not data.get('shard'):
+            problems.append('%s: not a shard build' % path)
+        # templates the shard's scan found nothing to generate in are its
+        # too, though it didn't build them
+        for name in set(data.get('templates', {})) | set(data.get('ignored', ())):
+            owners.setdefault(name, []).append(path)
+
+    specs = sorted(tuple(data['shard']) for data in shards if data.get('shard'))
+    counts = set(count for index, count in specs)
+    if len(counts) > 1:
+        problems.append('shards of different splits: %s' % ', '.join(
+            '%d/%d' % spec for spec in specs))
+    elif counts:
+        count = counts.pop()
+        indexes = [index for index, count in specs]
+        for index in range(1, count + 1):
+            if indexes.count(index) == 0:
+                problems.append('shard %d/%d is missing' % (index, count))
+            elif indexes.count(index) > 1:
+                problems.append('shard %d/%d is given more than once' % (index, count))
+
+    for name in sorted(names):
+        if name not in owners:
+            problems.append('%s: not built by any shard' % name)
+        elif len(owners[name]) > 1:
+            problems.append('%s: built by more than one shard: %s' % (
+                name, ', '.join(owners[name])))
+    for name in sorted(set(owners) - set(names)):
+        problems.append('%s: built by %s, but not a known template' % (
+            name, ', '.join(owners[name])))
+
+    if problems:
+        raise ShardError(problems)
+    return shards
+
+
+def merge(environment, paths, names=None, manifest_path=None):
+    """Combine the shard builds in `paths` into the environment's base
+    path, after checking them with `check`. Outputs are copied, the shards'
+    manifests are merged into one at `manifest_path` (by default in the base
+    path), and the runtime, bundles and fingerprint manifest are written for
+    every template. Returns the merged BuildManifest.
+    """
+    shards = check(environment, paths, names)
+    base_path = environment.underscore_base_path
+    if manifest_path is None:
+        manifest_path = os.path.join(base_path, MANIFEST_NAME)
+    manifest = BuildManifest(manifest_path, environment.generator_options())
+    sources = {}
+    problems = []
+    for path, data in zip(paths, shards):
+        for name, entry in data['templates'].iteritems():
+            manifest.templates[name] = entry
+            for output in entry['outputs']:
+                source = os.path.join(path, output)
+                if not os.path.exists(source):
+                    problems.append('%s: output %s is missing from %s' % (name, output, path))
+                elif output in sources and _read(sources[output]) != _read(source):
+                    problems.append('%s: output %s differs from the one in %s' % (
+                        name, output, sources[output]))
+                else:
+                    sources[output] = source
+    if problems:
+        raise ShardError(problems)
+
+    for output, source in sorted(sources.iteritems()):
+        target = os.path.join(base_path, output)
+        if os.path.abspath(target) != os.path.abspath(source):
+            with open(source, 'rb') as f:
+                write_atomic(target, iter(lambda: f.read(65536), ''))
+    errors = write_shared(environment, *manifest.references())
+    if errors:
+        raise ShardError([str(error) for error in errors])
+    manifest.save()
+    return manifest
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
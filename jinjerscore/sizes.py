@@ -0,0 +1,183 @@
+"""Where the bytes of the generated output come from.
+
+A SizeReport set as the environment's `underscore_sizes` records, for every
+template a build generates, the size of each of its outputs, raw and
+gzipped, and which constructs of the template wrote them. Every byte of a
+jinjerscore block's Underscore text counts against the innermost node that
+wrote it, by node type and source line, so the constructs of a template add
+up to its text; with flattening, the lines of layouts and partials are
+those of their own sources. Rendered templates are attributed by compiling
+them once more with the emitter, which writes the same text.
+
+Output sizes are of the files written, after minifying and precompiling,
+while constructs are measured in the Underscore text before either. Their
+gzipped sizes are of their text compressed on its own, without gzip's
+header, which overstates what repetitive constructs cost within the whole.
+
+With `underscore_size_budgets` set, builds also check the output of every
+template against it, and fail those over budget. It's a list of (glob
+pattern, raw bytes, gzipped bytes) limits, where the first pattern a
+template name matches sets its limits, and either may be None.
+"""
+import fnmatch
+import json
+import os
+import zlib
+from contextlib import contextmanager
+
+
+# the header and trailer jinjerscore.bundle.gzip_compress adds to the
+# deflated data
+GZIP_OVERHEAD = 18
+
+
+class Counter(object):
+    """The raw and gzipped size of data given in chunks."""
+
+    def __init__(self):
+        self.raw = 0
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._deflated = 0
+
+    def update(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.raw += len(data)
+        self._deflated += len(self._compressor.compress(data))
+
+    def sizes(self):
+        """The (raw, gzipped) sizes. Nothing can be added after."""
+        return self.raw, self._deflated + len(self._compressor.flush()) + GZIP_OVERHEAD
+
+
+def output_sizes(data):
+    counter = Counter()
+    counter.update(data)
+    return counter.sizes()
+
+
+def file_sizes(path):
+    with open(path, 'rb') as f:
+        return output_sizes(f.read())
+
+
+def deflated_size(text):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return len(compressor.compress(text)) + len(compressor.flush())
+
+
+def budget(environment, name):
+    """The (raw, gzipped) limits on the output of `name`, or None."""
+    for pattern, raw, gzipped in environment.underscore_size_budgets or ():
+        if fnmatch.fnmatch(name, pattern):
+            return raw, gzipped
+    return None
+
+
+class SizeReport(object):
+    """Per-template output sizes and their attribution, collected while an
+    environment generates.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        # the template being generated, which outputs are counted against
+        self.current = None
+
+    def entry(self, name):
+        if name not in self.templates:
+            self.templates[name] = {'outputs': {}, 'constructs': [], 'nodes': {}}
+        return self.templates[name]
+
+    @contextmanager
+    def rendering(self, name):
+        # a template's sizes are those of its latest build
+        self.templates.pop(name, None)
+        previous, self.current = self.current, name
+        try:
+            yield
+        finally:
+            self.current = previous
+
+    def output(self, path, raw, gzipped):
+        if self.current is not None:
+            self.entry(self.current)['outputs'][path] = [raw, gzipped]
+
+    def attribute(self, name, texts):
+        """Record the text written for `name` by each construct, a dict of
+        (node type, source template, line) -> list of text.
+        """
+        entry = self.entry(name)
+        by_node = {}
+        constructs = []
+        for (node_type, source, lineno), text in texts.iteritems():
+            text = u''.join(text).encode('utf-8')
+            by_node.setdefault(node_type, []).append(text)
+            constructs.append({'node': node_type, 'source': source, 'line': lineno,
+                               'raw': len(text), 'gzip': deflated_size(text)})
+        entry['constructs'] = sorted(constructs, key=lambda c: (-c['raw'], c['source'],
+                                                                c['line'], c['node']))
+        entry['nodes'] = dict((node_type, [sum(len(text) for text in texts),
+                                           deflated_size(''.join(texts))])
+                              for node_type, texts in by_node.iteritems())
+
+    def merge(self, name, entry):
+        """Add an entry recorded elsewhere, by a build worker, say."""
+        self.templates[name] = entry
+
+    def total(self, name):
+        """The (raw, gzipped) size of all the outputs of `name`."""
+        outputs = self.templates[name]['outputs'].values()
+        return sum(raw for raw, gzipped in outputs), sum(gzipped for raw, gzipped in outputs)
+
+    def nodes(self):
+        """The [raw, gzipped] size of the text written by each node type,
+        over all templates.
+        """
+        rv = {}
+        for entry in self.templates.itervalues():
+            for node_type, (raw, gzipped) in entry['nodes'].iteritems():
+                sizes = rv.setdefault(node_type, [0, 0])
+                sizes[0] += raw
+                sizes[1] += gzipped
+        return rv
+
+    def largest(self, n=10):
+        return sorted(self.templates, key=lambda name: self.total(name)[1], reverse=True)[:n]
+
+    def report(self, top=10):
+        """The report as a JSON-serializable dict."""
+        templates = {}
+        for name, entry in self.templates.iteritems():
+            raw, gzipped = self.total(name)
+            templates[name] = dict(entry, raw=raw, gzip=gzipped)
+        return {
+            'templates': templates,
+            'nodes': self.nodes(),
+            'totals': {'raw': sum(entry['raw'] for entry in templates.itervalues()),
+                       'gzip': sum(entry['gzip'] for entry in templates.itervalues())},
+            'largest': self.largest(top),
+        }
+
+    def save(self, path, top=10):
+        with open(path, 'w') as f:
+            json.dump(self.report(top), f, indent=1, sort_keys=True)
+
+    def summary(self, top=10):
+        """Tables of the `top` largest templates, with the constructs writing
+        the most of each, and of the node types writing the most overall.
+        """
+        lines = ['%-40s %10s %10s' % ('template', 'bytes', 'gzipped')]
+        for name in self.largest(top):
+            lines.append('%-40s %10d %10d' % ((name[-40:],) + self.total(name)))
+            for construct in self.templates[name]['constructs'][:3]:
+                where = '%s:%s' % (os.path.basename(construct['source']), construct['line'])
+                lines.append('  %-22s %-15s %10d %10d' % (where[-22:], construct['node'][:15],
+                                                          construct['raw'], construct['gzip']))
+        nodes = self.nodes()
+        lines.append('')
+        lines.append('%-40s %10s %10s' % ('node', 'bytes', 'gzipped'))
+        for node_type in sorted(nodes, key=lambda node_type: nodes[node_type][0],
+                                reverse=True)[:top]:
+            lines.append('%-40s %10d %10d' % ((node_type,) + tuple(nodes[node_type])))
+        return '\n'.join(lines)
@@ -31,6 +31,10 @@ setup(
     install_requires=[
         'Jinja2 >= 2.6',
     ],
+    extras_require={
+        # brotli compressed copies of bundles
+        'brotli': ['brotli'],
+    },
 )
 
 
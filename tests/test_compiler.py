@@ -0,0 +1,26 @@
+import unittest
+from jinjerscore.compiler import js_literal
+
+
+class JSLiteralTestCase(unittest.TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(js_literal(3), '3')
+        self.assertEqual(js_literal(2.5), '2.5')
+        self.assertEqual(js_literal(0.1 + 0.2), '0.30000000000000004')
+
+    def test_non_finite_numbers(self):
+        self.assertEqual(js_literal(float('inf')), 'Infinity')
+        self.assertEqual(js_literal(-float('inf')), '-Infinity')
+        self.assertEqual(js_literal(float('nan')), 'NaN')
+        self.assertEqual(js_literal([1, float('inf')]), '[1, Infinity]')
+
+    def test_strings(self):
+        self.assertEqual(js_literal(u'it\'s\n%>\xe9'), u"'it\\'s\\n%\\x3e\\u00e9'")
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, js_literal, object())
+
+
+if __name__ == '__main__':
+    unittest.main()
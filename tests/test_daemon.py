@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+from jinja2 import DictLoader
+from jinjerscore.build import BuildManifest
+from jinjerscore.daemon import BuildDaemon
+from jinjerscore.environment import JinjerscoreEnvironment
+
+
+class BuildDaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.environment = JinjerscoreEnvironment(loader=DictLoader({}))
+        self.daemon = BuildDaemon(self.environment, os.path.join(self.path, 'socket'),
+                                  BuildManifest(os.path.join(self.path, 'manifest.json')))
+
+    def tearDown(self):
+        self.daemon.server_close()
+        shutil.rmtree(self.path)
+
+    def test_evict_by_name(self):
+        cache = self.environment.cache
+        cache['a.html'] = cache['b.html'] = object()
+        self.daemon.evict(['a.html'])
+        self.assertEqual(cache.keys(), ['b.html'])
+
+    def test_evict_by_loader_and_name(self):
+        # the cache keys of Jinja 2.7 and later
+        cache = self.environment.cache
+        loader = weakref.ref(self.environment.loader)
+        cache[loader, 'a.html'] = cache[loader, 'b.html'] = object()
+        self.daemon.evict(['a.html'])
+        self.assertEqual(cache.keys(), [(loader, 'b.html')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from jinja2 import DictLoader
+from jinjerscore.environment import JinjerscoreEnvironment
+
+
+def source(template, partial):
+    environment = JinjerscoreEnvironment(loader=DictLoader({'p.html': partial,
+                                                            'a.html': template}))
+    return environment.underscore_source('a.html')
+
+
+class IncludeTestCase(unittest.TestCase):
+
+    def test_include_without_context_hides_the_includers_names(self):
+        self.assertEqual(source('{% set x = 1 %}{% include "p.html" without context %}',
+                                '[{{ x }}{{ range(2)|first }}]'),
+                         '<% var x = 1 %><% (function(x) { %>[<%= x %>'
+                         '<%= jinjerscore.first(range(2)) %>]<% })(); %>')
+
+    def test_include_assignments_stay_in_the_partial(self):
+        self.assertEqual(source('{% set x = 1 %}{% include "p.html" %}{{ y }}',
+                                '[{{ x }}]{% set y = 2 %}'),
+                         '<% var x = 1 %><% (function() { %>[<%= x %>]'
+                         '<% var y = 2 %><% })(); %><%= y %>')
+
+    def test_include_without_assignments_is_inlined(self):
+        self.assertEqual(source('{% set x = 1 %}{% include "p.html" %}', '[{{ x }}]'),
+                         '<% var x = 1 %>[<%= x %>]')
+
+    def test_partial_keeps_its_macros(self):
+        rv = source('{% include "p.html" without context %}',
+                    '{% from "m.html" import item %}{% set y = 2 %}{{ item(y) }}')
+        self.assertEqual(rv, "<% (function() { %><% var y = 2 %>"
+                             "<%= jinjerscore.macros['m.html']['item'](y) %><% })(); %>")
+
+
+if __name__ == '__main__':
+    unittest.main()
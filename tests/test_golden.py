@@ -0,0 +1,91 @@
+"""The outputs of the templates in templates/, in every output mode,
+compared byte for byte with those stored under golden/, as
+golden/<mode>/<template>/<output path>. After a change meant to alter the
+output, run with JINJERSCORE_UPDATE_GOLDEN=1 set to store the new outputs,
+and review their diff.
+"""
+import os
+import unittest
+from jinja2 import FileSystemLoader
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.serve import generate_outputs
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES = os.path.join(HERE, 'templates')
+GOLDEN = os.path.join(HERE, 'golden')
+
+MODES = {
+    'default': {},
+    'native_loops': {'underscore_native_loops': True},
+    'minify': {'underscore_minify': True},
+    'jst': {'underscore_output': 'jst'},
+    'esm': {'underscore_output': 'esm'},
+}
+
+
+def outputs(mode):
+    """Template name -> output path -> output, in `mode`."""
+    environment = JinjerscoreEnvironment(loader=FileSystemLoader(TEMPLATES))
+    for setting, value in MODES[mode].iteritems():
+        setattr(environment, setting, value)
+    return dict((name, generate_outputs(environment, name)[0])
+                for name in environment.list_templates())
+
+
+def golden(mode):
+    rv = {}
+    root = os.path.join(GOLDEN, mode)
+    for directory, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(directory, filename), root)
+            name, output_path = path.replace(os.sep, '/').split('/', 1)
+            with open(os.path.join(directory, filename), 'rb') as f:
+                rv.setdefault(name, {})[output_path] = f.read().decode('utf-8')
+    return rv
+
+
+def update(mode, generated):
+    for name, files in generated.iteritems():
+        for output_path, output in files.iteritems():
+            path = os.path.join(GOLDEN, mode, name, *output_path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(output.encode('utf-8'))
+
+
+class GoldenOutputTestCase(unittest.TestCase):
+
+    def check(self, mode):
+        generated = outputs(mode)
+        if os.environ.get('JINJERSCORE_UPDATE_GOLDEN'):
+            update(mode, generated)
+        expected = golden(mode)
+        self.assertEqual(sorted(name for name in generated if generated[name]),
+                         sorted(expected))
+        for name in sorted(generated):
+            self.assertEqual(sorted(generated[name]), sorted(expected.get(name, ())),
+                             '%s: %s outputs differ' % (mode, name))
+            for output_path, output in sorted(generated[name].iteritems()):
+                self.assertEqual(output, expected[name][output_path],
+                                 '%s: %s of %s differs' % (mode, output_path, name))
+
+    def test_default(self):
+        self.check('default')
+
+    def test_native_loops(self):
+        self.check('native_loops')
+
+    def test_minify(self):
+        self.check('minify')
+
+    def test_jst(self):
+        self.check('jst')
+
+    def test_esm(self):
+        self.check('esm')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from jinja2 import ChoiceLoader, FileSystemLoader
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.hook import affected_templates
+from jinjerscore.scan import ScanIndex
+
+
+class AffectedTemplatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.templates = os.path.join(self.path, 'templates')
+        os.mkdir(self.templates)
+        for name, source in [('a.html', '{% jinjerscore "a.us" %}{{ a }}{% endjinjerscore %}'),
+                             ('b.html', '{% include "part.html" %}'),
+                             ('part.html', '{% jinjerscore "p.us" %}{{ p }}{% endjinjerscore %}')]:
+            with open(os.path.join(self.templates, name), 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def affected(self, loader, *names):
+        environment = JinjerscoreEnvironment(loader=loader)
+        environment.underscore_base_path = os.path.join(self.path, 'out')
+        paths = [os.path.join(self.templates, name) for name in names]
+        return affected_templates(environment, paths, ScanIndex.load(environment))
+
+    def test_search_path(self):
+        self.assertEqual(self.affected(FileSystemLoader(self.templates), 'part.html'),
+                         ['b.html', 'part.html'])
+        self.assertEqual(self.affected(FileSystemLoader(self.templates), '../setup.py'), [])
+
+    def test_search_path_through_symlink(self):
+        link = os.path.join(self.path, 'link')
+        os.symlink(self.templates, link)
+        self.assertEqual(self.affected(FileSystemLoader(link), 'a.html'), ['a.html'])
+
+    def test_loader_without_search_path(self):
+        loader = ChoiceLoader([FileSystemLoader(self.templates)])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(self.affected(loader, 'a.html'), ['a.html', 'b.html', 'part.html'])
+        self.assertEqual(len(caught), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Native loops and _.each loops, rendered with Underscore in node, against
+each other and Jinja. Skipped without node, or Underscore where
+UNDERSCORE_JS or the Debian package puts it.
+"""
+import json
+import os
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+from jinja2 import DictLoader, Environment
+from jinjerscore.environment import JinjerscoreEnvironment
+
+
+NODE = find_executable('node') or find_executable('nodejs')
+UNDERSCORE = os.environ.get('UNDERSCORE_JS', '/usr/share/javascript/underscore/underscore.js')
+
+RENDER = '''
+var _ = global._ = require(process.argv[1]);
+var input = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+require('vm').runInThisContext(input.runtime);
+process.stdout.write(JSON.stringify(_.template(input.source)(input.data)));
+'''
+
+DATA = {
+    'xs': [{'n': 'a', 'v': 1}, {'n': 'b', 'v': 0}, {'n': 'c', 'v': 2}, {'n': 'd', 'v': 3}],
+    'empty': [],
+    'tree': [{'name': 'a', 'children': [{'name': 'b', 'children': []},
+                                        {'name': 'c', 'children': [{'name': 'd'}]}]},
+             {'name': 'e'}],
+    'x': {'n': 'outer', 'kids': [{'n': 'k1', 'kids': [1, 2]}, {'n': 'k2', 'kids': [3]}]},
+    'name': 'context',
+    'names': ['a', 'b'],
+}
+
+
+def render(source, data, runtime=''):
+    """Render the Underscore template `source` with `data` in node, after
+    running the script `runtime`.
+    """
+    process = subprocess.Popen([NODE, '-e', RENDER, UNDERSCORE], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate(json.dumps({'source': source, 'data': data,
+                                               'runtime': runtime}))
+    if process.returncode:
+        raise AssertionError(err)
+    return json.loads(out)
+
+
+def underscore_source(template, native_loops):
+    environment = JinjerscoreEnvironment(loader=DictLoader({'a.html': template}))
+    environment.underscore_native_loops = native_loops
+    # without the newlines and indentation written around statements, which
+    # Jinja doesn't print
+    environment.underscore_minify = True
+    return environment.underscore_source('a.html')
+
+
+@unittest.skipUnless(NODE and os.path.exists(UNDERSCORE), 'needs node and Underscore')
+class NativeLoopTestCase(unittest.TestCase):
+
+    def check(self, template):
+        expected = Environment().from_string(template).render(DATA)
+        self.assertEqual(render(underscore_source(template, False), DATA), expected)
+        self.assertEqual(render(underscore_source(template, True), DATA), expected)
+
+    def test_loop_attributes(self):
+        self.check('{% for x in xs %}{{ loop.index }}{{ loop.index0 }}{{ loop.revindex }}'
+                   '{{ loop.revindex0 }}{{ loop.length }}{% if loop.first %}F{% endif %}'
+                   '{% if loop.last %}L{% endif %}{{ x.n }};{% endfor %}')
+
+    def test_filtered_loop(self):
+        self.check('{% for x in xs if x.v %}{{ loop.index }}/{{ loop.length }}{{ x.n }}'
+                   '{% if loop.last %}L{% endif %};{% endfor %}')
+        self.check('{% for x in xs if x.v > 1 %}{{ loop.index0 }}{{ x.n }};{% endfor %}')
+
+    def test_else(self):
+        self.check('{% for x in empty %}{{ x }}{% else %}none{% endfor %}')
+        self.check('{% for x in xs if x.v > 5 %}{{ x.n }}{% else %}none{% endfor %}')
+        self.check('{% for x in xs %}{{ x.n }}{% else %}none{% endfor %}')
+
+    def test_cycle(self):
+        self.check('{% for x in xs %}{{ loop.cycle("odd", "even", "third") }};{% endfor %}')
+        self.check('{% for x in xs if x.v %}{{ loop.cycle("odd", "even") }};{% endfor %}')
+
+    def test_nested_loops(self):
+        self.check('{% for x in xs %}{% for y in xs %}{{ loop.index }}{% endfor %}'
+                   '|{{ loop.index }};{% endfor %}')
+
+    def test_targets_shadow_outer_names(self):
+        self.check('{% for name in names %}{{ name }}{% endfor %}{{ name }}')
+        self.check('{% for x in x.kids %}{{ x.n }}{% endfor %}{{ x.n }}')
+        self.check('{% for x in x.kids if x.n %}{{ loop.length }}{{ x.n }}{% endfor %}{{ x.n }}')
+
+    def test_nested_loops_with_the_same_target(self):
+        self.check('{% for x in x.kids %}{{ x.n }}({% for x in x.kids %}{{ x }}{% endfor %})'
+                   '{{ x.n }};{% endfor %}{{ x.n }}')
+
+    def test_assignments_stay_in_the_loop(self):
+        self.check('{% for n in names %}{% set name = n ~ "!" %}{{ name }}{% endfor %}{{ name }}')
+
+    def test_recursive_loop(self):
+        self.check('{% for node in tree recursive %}[{{ loop.index }}{{ node.name }}'
+                   '{% if node.children %}{{ loop(node.children) }}{% endif %}]{% endfor %}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from jinja2 import DictLoader
+from jinja2.exceptions import TemplateAssertionError
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.macros import compile_macros
+
+
+MACROS = '{% macro item(x) %}<i>{{ x }}</i>{% endmacro %}'
+
+
+def source(template):
+    environment = JinjerscoreEnvironment(loader=DictLoader({'m.html': MACROS,
+                                                            'a.html': template}))
+    return environment.underscore_source('a.html')
+
+
+class MacroNameTestCase(unittest.TestCase):
+
+    def test_imported_macro(self):
+        self.assertEqual(source('{% from "m.html" import item %}'
+                                '{% jinjerscore "a" %}{{ item(1) }}{% endjinjerscore %}'),
+                         "<%= jinjerscore.macros['m.html']['item'](1) %>")
+
+    def test_loop_target_shadows_macro(self):
+        rv = source('{% from "m.html" import item %}{% jinjerscore "a" %}'
+                    '{% for item in rows %}{{ item.n }}{% endfor %}{{ item(2) }}'
+                    '{% endjinjerscore %}')
+        self.assertTrue("<%= item['n'] %>" in rv)
+        self.assertTrue("<%= jinjerscore.macros['m.html']['item'](2) %>" in rv)
+
+    def test_assignment_shadows_macro_after_it(self):
+        rv = source('{% from "m.html" import item %}{% jinjerscore "a" %}'
+                    '{{ item(1) }}{% set item = 3 %}{{ item }}{% endjinjerscore %}')
+        self.assertEqual(rv, "<%= jinjerscore.macros['m.html']['item'](1) %>"
+                             "<% var item = 3 %><%= item %>")
+
+    def test_loop_target_shadows_module(self):
+        rv = source('{% import "m.html" as forms %}{% jinjerscore "a" %}'
+                    '{% for forms in rows %}{{ forms.item }}{% endfor %}'
+                    '{{ forms.item(1) }}{% endjinjerscore %}')
+        self.assertTrue("<%= forms['item'] %>" in rv)
+        self.assertTrue("<%= jinjerscore.macros['m.html']['item'](1) %>" in rv)
+
+
+class MacroFunctionTestCase(unittest.TestCase):
+
+    def compile(self, macros):
+        environment = JinjerscoreEnvironment(loader=DictLoader({'m.html': macros}))
+        return compile_macros(environment, [('m.html', 'm')])[0]['m.html']['m']
+
+    def test_local_names(self):
+        rv = self.compile('{% macro other() %}-{% endmacro %}'
+                          '{% macro m(xs, sep=", ") %}{% for x in xs %}{% set y = x ~ sep %}'
+                          '{{ y }}{{ loop.index }}{% endfor %}{{ other() }}{% endmacro %}')
+        self.assertTrue(rv.startswith('function(xs, sep){'))
+
+    def test_context_names(self):
+        self.assertRaises(TemplateAssertionError, self.compile,
+                          '{% macro m(x) %}{{ x }}{{ title }}{% endmacro %}')
+        self.assertRaises(TemplateAssertionError, self.compile,
+                          '{% macro m(x=title) %}{{ x }}{% endmacro %}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+from jinjerscore.minify import minify
+
+
+class MinifyTestCase(unittest.TestCase):
+
+    def test_merges_adjacent_statements(self):
+        self.assertEqual(minify(u'<% var a = 1 %><%  if (a) { %>x<% } %>'),
+                         u'<%var a = 1; if (a) {%>x<%}%>')
+
+    def test_collapses_whitespace(self):
+        self.assertEqual(minify(u'<p>\n    a  b\n</p>  <%= c %>'),
+                         u'<p>\na b\n</p> <%=c%>')
+
+    def test_keeps_whitespace_between_statements(self):
+        # the line break is printed between the two conditionals
+        self.assertEqual(minify(u'<% if (a) { %><b>x</b><% } %>\n'
+                                u'<% if (b) { %><b>y</b><% } %>'),
+                         u'<%if (a) {%><b>x</b><%}%>\n<%if (b) {%><b>y</b><%}%>')
+
+    def test_leaves_preformatted_text(self):
+        self.assertEqual(minify(u'<pre>  a\n\n b</pre>  c'), u'<pre>  a\n\n b</pre> c')
+
+
+if __name__ == '__main__':
+    unittest.main()
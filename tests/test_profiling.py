@@ -0,0 +1,60 @@
+import unittest
+from jinja2 import DictLoader
+from jinjerscore import profiling
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.profiling import Profile
+
+
+class Clock(object):
+
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def time(self):
+        return self.times.pop(0)
+
+
+class CountingProfile(Profile):
+
+    def __init__(self):
+        Profile.__init__(self)
+        self.lexed = []
+
+    def tokens(self, name, stream):
+        self.lexed.append(name)
+        return Profile.tokens(self, name, stream)
+
+
+class ProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.time = profiling.time
+
+    def tearDown(self):
+        profiling.time = self.time
+
+    def test_nested_timers_count_once(self):
+        profiling.time = Clock(0, 1, 3, 6, 10, 15)
+        profile = Profile()
+        with profile.timer('a.html', 'codegen'):
+            with profile.timer('b.html', 'parse'):
+                with profile.timer('b.html', 'lex'):
+                    pass
+        self.assertEqual(profile.templates['a.html']['codegen'], 6)
+        self.assertEqual(profile.templates['b.html']['parse'], 6)
+        self.assertEqual(profile.templates['b.html']['lex'], 3)
+
+    def test_sources_are_lexed_once_by_name(self):
+        environment = JinjerscoreEnvironment(loader=DictLoader({
+            'base.html': '<p>{% block a %}{% endblock %}</p>',
+            'child.html': '{% extends "base.html" %}{% block a %}{{ a }}{% endblock %}',
+        }))
+        environment.underscore_profile = profile = CountingProfile()
+        environment.get_template('child.html')
+        self.assertEqual(profile.lexed, ['child.html', 'base.html'])
+        self.assertTrue(profile.templates['base.html']['lex'] > 0)
+        self.assertEqual(profile.templates['base.html']['codegen'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""The runtime's filter and test helpers, and the JS for operators, rendered
+with Underscore in node, against Jinja. Skipped without node or Underscore.
+"""
+import os
+import unittest
+from jinja2 import DictLoader, Environment
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.runtime import HELPERS, runtime_module
+from tests.test_loops import NODE, UNDERSCORE, render
+
+
+# in the data rather than the templates, where filters on constants are
+# evaluated at compile time
+DATA = {
+    'numbers': [-3, -2, -1, 0, 1, 2, 3],
+    'halves': [2.5, -2.5, -0.5, 0.5],
+    'tenths': [-2.45, 2.75, 2.41, -2.41, 2.49, -2.49],
+    'text': "they're bill's FRIENDS from the UK, hello-world 1st",
+    'words': ['ab', 'abc', 'a', ''],
+    'x': {'n': 1},
+    'pairs': [[7, 2], [-7, 2], [7, -2], [-7, -2]],
+}
+
+
+@unittest.skipUnless(NODE and os.path.exists(UNDERSCORE), 'needs node and Underscore')
+class HelperTestCase(unittest.TestCase):
+
+    def check(self, template):
+        environment = JinjerscoreEnvironment(loader=DictLoader({'a.html': template}))
+        environment.underscore_minify = True
+        source = environment.underscore_source('a.html')
+        expected = Environment().from_string(template).render(DATA)
+        self.assertEqual(render(source, DATA, runtime_module(HELPERS)), expected)
+
+    def test_odd_and_even(self):
+        self.check('{% for n in numbers %}{{ n }}{% if n is odd %}o{% endif %}'
+                   '{% if n is even %}e{% endif %};{% endfor %}')
+
+    def test_round(self):
+        self.check('{% for n in halves %}{{ n|round|int }} {{ n|round(0, "ceil")|int }} '
+                   '{{ n|round(0, "floor")|int }};{% endfor %}')
+        self.check('{% for n in tenths %}{{ n|round(1) }} {{ n|round(1, "ceil") }} '
+                   '{{ n|round(1, "floor") }};{% endfor %}')
+        self.check('{% for n in numbers %}{{ (n * 625)|round(-2)|int }};{% endfor %}')
+
+    def test_title(self):
+        self.check('{{ text|title }}')
+
+    def test_center(self):
+        self.check('{% for w in words %}[{{ w|center(5) }}][{{ w|center(6) }}]'
+                   '[{{ w|center(2) }}]{% endfor %}')
+
+    def test_missing_attributes(self):
+        self.check('[{{ x|attr("missing") }}][{{ x|attr("constructor") }}]'
+                   '{% if x|attr("missing") is undefined %}u{% endif %}'
+                   '{% if x|attr("toString") is defined %}d{% endif %}')
+
+    def test_floor_division(self):
+        # evaluated at runtime, and folded at compile time by Python
+        self.check('{% for a, b in pairs %}{{ a // b }};{% endfor %}')
+        self.check('{{ -7 // 2 }};{{ 7 // -2 }};{{ -7 // -2 }}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+from jinja2 import FileSystemLoader
+from jinjerscore.build import build
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.scan import ScanIndex, scan_source
+
+
+class ScanSourceTestCase(unittest.TestCase):
+
+    def scan(self, source):
+        return scan_source(JinjerscoreEnvironment(), source)
+
+    def test_constant_references(self):
+        self.assertEqual(self.scan('{% extends "base.html" %}{% include "a.html" ignore missing %}'
+                                   '{% include "b.html" without context %}'
+                                   '{% from "c.html" import m %}{% import "d.html" as d %}'),
+                         (False, ['a.html', 'b.html', 'base.html', 'c.html', 'd.html'], False))
+
+    def test_dynamic_references(self):
+        self.assertEqual(self.scan('{% extends "x.html" if c else "a.html" %}'),
+                         (False, [], True))
+        self.assertEqual(self.scan('{% include "a" ~ b %}'), (False, [], True))
+        self.assertEqual(self.scan('{% include name %}'), (False, [], True))
+
+    def test_blocks(self):
+        self.assertEqual(self.scan('{% raw %}{% jinjerscore "a" %}{% endraw %}'),
+                         (False, [], False))
+        self.assertEqual(self.scan('{% jinjerscore "a" %}{% endjinjerscore %}'),
+                         (True, [], False))
+
+
+class ScanIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        templates = os.path.join(self.path, 'templates')
+        os.mkdir(templates)
+        with open(os.path.join(templates, 'a.html'), 'w') as f:
+            f.write('{% jinjerscore "a.us" %}{{ a }}{% endjinjerscore %}')
+        with open(os.path.join(templates, 'plain.html'), 'w') as f:
+            f.write('<p>nothing to generate</p>')
+        self.environment = JinjerscoreEnvironment(loader=FileSystemLoader(templates))
+        self.environment.underscore_base_path = os.path.join(self.path, 'out', 'js')
+        self.environment.underscore_scan = True
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_build_into_fresh_directory(self):
+        result = build(self.environment)
+        self.assertEqual(result.ignored, ['plain.html'])
+        index = ScanIndex.load(self.environment)
+        self.assertEqual(sorted(index.templates), ['a.html', 'plain.html'])
+
+
+if __name__ == '__main__':
+    unittest.main()
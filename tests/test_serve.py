@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+from jinja2 import FileSystemLoader
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.serve import UnderscoreApp
+
+
+class CountingLoader(FileSystemLoader):
+
+    reads = 0
+
+    def get_source(self, environment, template):
+        self.reads += 1
+        return FileSystemLoader.get_source(self, environment, template)
+
+
+class UnderscoreAppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write('a.html', '{% jinjerscore "a.us" %}{{ a|upper }}{% endjinjerscore %}')
+        self.write('b.html', '{% jinjerscore "b.us" %}{{ b }}{% endjinjerscore %}')
+        self.write('plain.html', '<p>nothing to generate</p>')
+        self.loader = CountingLoader(self.path)
+        self.app = UnderscoreApp(JinjerscoreEnvironment(loader=self.loader))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, source, mtime=None):
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write(source)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def get(self, path):
+        status = []
+        body = ''.join(self.app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/' + path},
+                                lambda s, headers: status.append(s)))
+        return status[0], body
+
+    def test_unknown_paths_read_no_sources(self):
+        self.assertEqual(self.get('a.us')[0], '200 OK')
+        self.loader.reads = 0
+        for i in range(5):
+            self.assertEqual(self.get('missing%d.us' % i)[0], '404 Not Found')
+        self.assertEqual(self.loader.reads, 0)
+
+    def test_runtime_reads_no_sources(self):
+        runtime_path = self.app.environment.underscore_runtime_path
+        self.assertTrue('upper' in self.get(runtime_path)[1])
+        self.loader.reads = 0
+        self.get(runtime_path)
+        self.assertEqual(self.loader.reads, 0)
+
+    def test_changed_output_path(self):
+        self.get('a.us')
+        self.write('b.html', '{% jinjerscore "c.us" %}{{ c }}{% endjinjerscore %}',
+                   os.path.getmtime(os.path.join(self.path, 'b.html')) + 10)
+        self.assertEqual(self.get('c.us'), ('200 OK', '<%= c %>'))
+        self.assertEqual(self.get('b.us')[0], '404 Not Found')
+
+    def test_added_and_removed_templates(self):
+        runtime_path = self.app.environment.underscore_runtime_path
+        self.get('a.us')
+        self.write('d.html', '{% jinjerscore "d.us" %}{{ d }}{% endjinjerscore %}')
+        self.assertEqual(self.get('d.us'), ('200 OK', '<%= d %>'))
+        self.assertTrue('upper' in self.get(runtime_path)[1])
+        os.remove(os.path.join(self.path, 'a.html'))
+        self.assertEqual(self.get('a.us')[0], '404 Not Found')
+        self.assertFalse('upper' in self.get(runtime_path)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
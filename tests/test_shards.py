@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from jinja2 import FileSystemLoader
+from jinjerscore.build import BuildManifest, MANIFEST_NAME, build
+from jinjerscore.environment import JinjerscoreEnvironment
+from jinjerscore.shards import ShardError, check, merge
+
+
+class ShardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.templates = os.path.join(self.path, 'templates')
+        os.mkdir(self.templates)
+        for name in 'abcdef':
+            self.write('%s.html' % name,
+                       '{%% jinjerscore "%s.us" %%}{{ %s }}{%% endjinjerscore %%}' % (name, name))
+        self.write('plain.html', '<p>nothing to generate</p>')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates, name), 'w') as f:
+            f.write(source)
+
+    def environment(self, base_path):
+        environment = JinjerscoreEnvironment(loader=FileSystemLoader(self.templates))
+        environment.underscore_base_path = os.path.join(self.path, base_path)
+        environment.underscore_scan = True
+        return environment
+
+    def build_shards(self, count):
+        paths = []
+        for index in range(1, count + 1):
+            environment = self.environment('shard%d' % index)
+            path = environment.underscore_base_path
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            manifest = BuildManifest.load(os.path.join(path, MANIFEST_NAME),
+                                          environment.generator_options())
+            build(environment, manifest=manifest, shard=(index, count), runtime=False)
+            manifest.save()
+            paths.append(path)
+        return paths
+
+    def test_merge_with_ignored_templates(self):
+        paths = self.build_shards(2)
+        environment = self.environment('out')
+        os.makedirs(environment.underscore_base_path)
+        manifest = merge(environment, paths)
+        self.assertEqual(sorted(manifest.templates),
+                         ['%s.html' % name for name in 'abcdef'])
+        for name in 'abcdef':
+            self.assertTrue(os.path.exists(
+                os.path.join(environment.underscore_base_path, '%s.us' % name)))
+
+    def test_shard_forgets_other_templates(self):
+        # a full build first, into what becomes the first shard
+        environment = self.environment('shard1')
+        os.makedirs(environment.underscore_base_path)
+        manifest = BuildManifest(os.path.join(environment.underscore_base_path, MANIFEST_NAME),
+                                 environment.generator_options())
+        build(environment, manifest=manifest, runtime=False)
+        manifest.save()
+        paths = self.build_shards(2)
+        self.assertEqual(len(check(self.environment('out'), paths)), 2)
+
+    def test_missing_shard(self):
+        paths = self.build_shards(2)
+        try:
+            check(self.environment('out'), paths[:1])
+        except ShardError, e:
+            self.assertTrue('shard 2/2 is missing' in e.problems)
+        else:
+            self.fail('a missing shard went unnoticed')
+
+
+if __name__ == '__main__':
+    unittest.main()